@@ -1,13 +1,23 @@
 
+import os
 import re
+import glob
+import json
+import hashlib
 import datetime
-import pytz
 
 SEARCH_PATTERNS = [
     ('.travis.yml', r'(?P<pre>.*TAG=)(?P<date>\d{4}-\d{2}-\d{2})\.?(?P<ver>\d{2})?(?P<post>[.\s]*)$'),
     ('notebook/worker-template.yml', r'(?P<pre>.*image: rhodium/worker:)(?P<date>\d{4}-\d{2}-\d{2})\.?(?P<ver>\d{2})?(?P<post>[.\s]*)$'),
     ('jupyter-config.yml', r'(?P<pre>.*tag: )(?P<date>\d{4}-\d{2}-\d{2})\.?(?P<ver>\d{2})?(?P<post>[.\s]*)$')]
 
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+MANIFEST_FILE = 'image_manifest.json'
+'''
+Records the content hash of each image and the tag it was last built under
+'''
+
 
 def bump_file(fname, pattern):
 
@@ -30,12 +40,13 @@ def bump_file(fname, pattern):
             current_version = (matcher.group('date'), matcher.group('ver'))
 
             timestamp = datetime.datetime(
-                *map(int, matcher.group('date').split('-')), tzinfo=pytz.utc)
+                *map(int, matcher.group('date').split('-')),
+                tzinfo=datetime.timezone.utc)
 
             date = datetime.date(
                 timestamp.year, timestamp.month, timestamp.day)
 
-            now = datetime.datetime.utcnow()
+            now = datetime.datetime.now(datetime.timezone.utc)
             today = datetime.date(now.year, now.month, now.day)
 
             if (date == today):
@@ -62,6 +73,200 @@ def bump_file(fname, pattern):
     return (current_version, new_version, ''.join(newlines))
 
 
+IMAGES = {
+    'notebook': ['notebook/Dockerfile'],
+    'worker': ['worker/Dockerfile'],
+    'octave-worker': ['worker/Dockerfile', 'octave-worker/Dockerfile'],
+    }
+'''
+Dockerfiles used to build each image, as in ``conda_tools.DOCKER_IMAGES``.
+Listed here so that bumping doesn't require the conda python API.
+'''
+
+IMAGE_DEPENDENCIES = {
+    'notebook': ['worker'],
+    'octave-worker': ['worker'],
+    }
+'''
+Images which are built from, or launch, another image by its tag. The
+notebook launches workers by the tag in worker-template.yml, and octave-worker
+is built on the worker image, so these must be rebuilt with the worker.
+'''
+
+
+def _normalized_contents(path):
+    '''
+    Read a file, masking any image tags that bump.py rewrites
+
+    Tags are rewritten on every bump, so they are excluded from content
+    hashes to keep unchanged images' hashes stable. Changes to the images
+    behind the tags are tracked with :py:data:`IMAGE_DEPENDENCIES`.
+    '''
+    with open(path, 'rb') as f:
+        contents = f.read()
+
+    relpath = os.path.relpath(path, REPO_ROOT)
+    for fname, pattern in SEARCH_PATTERNS:
+        if os.path.normpath(fname) != relpath:
+            continue
+
+        lines = []
+        for l in contents.decode().splitlines(True):
+            matcher = re.match(pattern, l, re.I)
+            if matcher:
+                l = matcher.group('pre') + '<tag>' + matcher.group('post')
+            lines.append(l)
+
+        contents = ''.join(lines).encode()
+
+    return contents
+
+
+def _list_files(path):
+    if os.path.isdir(path):
+        return sorted(
+            os.path.join(d, f)
+            for d, _, files in os.walk(path) for f in files)
+
+    if os.path.isfile(path):
+        return [path]
+
+    return []
+
+
+def get_copy_sources(dockerfile):
+    '''
+    Find the local files copied into an image by a Dockerfile
+
+    Sources of ``COPY``/``ADD`` instructions are looked up in the Dockerfile's
+    directory, falling back to the repository root for the shared files CI
+    copies into each build context. Instructions copying from another stage
+    or image (``--from``) are skipped.
+    '''
+    docker_wd = os.path.dirname(dockerfile)
+
+    with open(dockerfile, 'r') as f:
+        text = re.sub(r'\\[ \t]*\n', ' ', f.read())
+
+    sources = []
+
+    for line in text.splitlines():
+        tokens = line.strip().split()
+        if len(tokens) < 3 or tokens[0].upper() not in ('COPY', 'ADD'):
+            continue
+
+        args = line.strip()[len(tokens[0]):].strip()
+        if args.startswith('['):
+            args = json.loads(args)
+        else:
+            args = args.split()
+
+        if any(a.startswith('--from') for a in args):
+            continue
+
+        for src in [a for a in args if not a.startswith('--')][:-1]:
+            matches = sorted(glob.glob(os.path.join(docker_wd, src)))
+            if not matches:
+                matches = sorted(glob.glob(os.path.join(REPO_ROOT, src)))
+
+            for match in matches:
+                sources.extend(_list_files(match))
+
+    return sources
+
+
+def hash_image_inputs(image, hashes=None):
+    '''
+    Compute a content hash of everything that goes into an image
+
+    Covers each Dockerfile used to build the image, every file copied into
+    the image, the image's conda lock files, and the hashes of the images it
+    depends on (see :py:data:`IMAGE_DEPENDENCIES`).
+
+    Parameters
+    ----------
+    image : str
+        Image name from :py:data:`IMAGES`
+    hashes : dict, optional
+        Cache of ``{image: digest}``, updated in place
+
+    Returns
+    -------
+    digest : str
+        sha256 hex digest
+    '''
+    if hashes is None:
+        hashes = {}
+
+    if image in hashes:
+        return hashes[image]
+
+    inputs = set()
+
+    for dockerfile in IMAGES[image]:
+        dockerfile = os.path.join(REPO_ROOT, dockerfile)
+        inputs.add(dockerfile)
+        inputs.update(get_copy_sources(dockerfile))
+
+    image_dir = os.path.dirname(IMAGES[image][-1])
+    inputs.update(glob.glob(os.path.join(REPO_ROOT, image_dir, '*.lock')))
+
+    h = hashlib.sha256()
+    for path in sorted(inputs, key=lambda p: os.path.relpath(p, REPO_ROOT)):
+        h.update(os.path.relpath(path, REPO_ROOT).encode() + b'\0')
+        h.update(hashlib.sha256(_normalized_contents(path)).digest())
+
+    for dependency in IMAGE_DEPENDENCIES.get(image, []):
+        h.update(dependency.encode() + b'\0')
+        h.update(hash_image_inputs(dependency, hashes).encode())
+
+    hashes[image] = h.hexdigest()
+
+    return hashes[image]
+
+
+def update_image_manifest(new_tag, manifest_file=MANIFEST_FILE):
+    '''
+    Compare image content hashes with the manifest from the last bump
+
+    Parameters
+    ----------
+    new_tag : str
+        Tag being stamped by this bump
+
+    Returns
+    -------
+    manifest : dict
+        Updated manifest: ``{'tag': new_tag, 'images': {image: {'hash':
+        content hash, 'built_tag': tag the image was last built under}}}``
+    changed : dict
+        ``{image: bool}``, True where the image's inputs changed since the
+        last bump (or it has no recorded build) and it must be rebuilt
+    '''
+    try:
+        with open(manifest_file, 'r') as f:
+            previous = json.load(f)
+    except (OSError, IOError, ValueError):
+        previous = {'images': {}}
+
+    manifest = {'tag': new_tag, 'images': {}}
+    changed = {}
+    hashes = {}
+
+    for image in sorted(IMAGES):
+        digest = hash_image_inputs(image, hashes)
+        last = previous.get('images', {}).get(image, {})
+
+        changed[image] = (
+            last.get('hash') != digest or last.get('built_tag') is None)
+
+        manifest['images'][image] = {
+            'hash': digest,
+            'built_tag': new_tag if changed[image] else last['built_tag']}
+
+    return manifest, changed
+
+
 def main():
     cv = None
     nv = None
@@ -88,10 +293,25 @@ def main():
 
         contents.append((fname, this_contents))
 
+    new_tag = '{}.{}'.format(*nv)
+    manifest, changed = update_image_manifest(new_tag)
+
     for fname, c in contents:
         with open(fname, 'w+') as f:
             f.write(c)
 
+    with open(MANIFEST_FILE, 'w+') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+    for image, image_changed in sorted(changed.items()):
+        built_tag = manifest['images'][image]['built_tag']
+        if image_changed:
+            print('{}: changed, rebuild as {}'.format(image, new_tag))
+        else:
+            print('{}: unchanged, retag rhodium/{}:{} as {}'.format(
+                image, image, built_tag, new_tag))
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,347 @@
+'''
+Container entrypoint for the notebook and worker images
+
+Prepares the container, then runs the container command. Preparation is
+split into phases, each applied only when the environment variables it
+depends on are set, as in the original ``prepare.sh`` scripts:
+
+worker
+
+- ``EXTRA_CONDA_PACKAGES``/``EXTRA_PIP_PACKAGES``: install extra packages
+- ``GCSFUSE_TOKENS``: write bucket credentials, then mount the buckets
+- ``EXTRA_PACKAGES_DIR``: install extras from the shared package cache
+- ``SQL_TOKEN`` and ``SQL_INSTANCE``: start the cloud SQL proxy
+- ``GOOGLE_APPLICATION_CREDENTIALS``: activate the gcloud service account
+- BLAS/OpenMP thread counts are sized to the CPU quota (see
+  ``thread_tuning.py``)
+
+notebook
+
+- copy the dask config, worker template and other files from /pre-home
+- mount a bucket for each credential in ~/service-account-credentials
+- add the credentials to ~/worker-template.yml
+
+Phases which don't depend on each other run concurrently, and phases which
+depend on a failed phase are skipped. Each phase is timed, and a JSON timing
+record is printed to stdout as a single line and written to
+``STARTUP_TIMING_FILE`` (default /tmp/startup_timing.json):
+
+.. code-block:: bash
+
+    $ python /usr/bin/entrypoint.py worker dask-worker ...
+
+'''
+
+import os
+import sys
+import glob
+import json
+import time
+import socket
+import datetime
+import subprocess
+import collections
+import concurrent.futures
+
+import mount_buckets
+
+
+HOME = '/home/jovyan'
+PRE_HOME = '/pre-home'
+TOKEN_DIR = '/opt/gcsfuse_tokens'
+TOKEN_STRINGS = '/opt/gcsfuse_token_strings.json'
+SQL_TOKEN_FILE = '/opt/sql_token_string.json'
+CONDA_BIN = '/opt/conda/bin'
+
+TIMING_FILE = '/tmp/startup_timing.json'
+
+Phase = collections.namedtuple('Phase', ['name', 'func', 'requires'])
+'''
+A unit of container preparation. ``requires`` names the phases which must
+finish before this one starts.
+'''
+
+
+def log(message):
+    sys.stderr.write(message + '\n')
+    sys.stderr.flush()
+
+
+def run(*args, **kwargs):
+    log('+ ' + ' '.join(args))
+    subprocess.run(list(args), check=True, **kwargs)
+
+
+def _mount(token_dir):
+    results = mount_buckets.mount_all(token_dir=token_dir)
+
+    if results:
+        log(mount_buckets.format_results(results))
+
+    failed = [r.bucket for r in results if r.status == 'failed']
+    if failed:
+        raise RuntimeError('failed to mount {}'.format(', '.join(failed)))
+
+
+def get_worker_phases(env):
+    '''
+    Get the preparation phases for a worker container
+    '''
+    phases = []
+
+    if env.get('EXTRA_CONDA_PACKAGES'):
+        phases.append(Phase('extra_conda_packages', lambda: run(
+            os.path.join(CONDA_BIN, 'conda'), 'install', '--yes',
+            *env['EXTRA_CONDA_PACKAGES'].split()), ()))
+
+    if env.get('EXTRA_PIP_PACKAGES'):
+        phases.append(Phase('extra_pip_packages', lambda: run(
+            os.path.join(CONDA_BIN, 'pip'), 'install',
+            *env['EXTRA_PIP_PACKAGES'].split()), ('extra_conda_packages',)))
+
+    if env.get('GCSFUSE_TOKENS'):
+        def write_credentials():
+            with open(TOKEN_STRINGS, 'w') as f:
+                f.write(env['GCSFUSE_TOKENS'] + '\n')
+
+            if not os.path.isdir(TOKEN_DIR):
+                os.makedirs(TOKEN_DIR)
+
+            run(sys.executable, '/usr/bin/add_service_creds.py')
+
+        phases.append(Phase('gcsfuse_credentials', write_credentials, ()))
+        phases.append(Phase(
+            'gcsfuse_mounts',
+            lambda: _mount(TOKEN_DIR),
+            ('gcsfuse_credentials',)))
+
+    # extras resolved on the notebook may be cached in a mounted bucket, and
+    # conda can't install into the environment concurrently with itself
+    if env.get('EXTRA_PACKAGES_DIR'):
+        phases.append(Phase('extra_packages_cache', lambda: run(
+            sys.executable, '/usr/bin/extra_packages.py', 'install',
+            env['EXTRA_PACKAGES_DIR']), (
+                'gcsfuse_mounts',
+                'extra_conda_packages',
+                'extra_pip_packages')))
+
+    if env.get('SQL_TOKEN') and env.get('SQL_INSTANCE'):
+        def start_sql_proxy():
+            with open(SQL_TOKEN_FILE, 'w') as f:
+                f.write(env['SQL_TOKEN'] + '\n')
+
+            log('Starting SQL proxy connection to {}'.format(
+                env['SQL_INSTANCE']))
+
+            subprocess.Popen([
+                '/usr/bin/cloud_sql_proxy',
+                '-instances={}'.format(env['SQL_INSTANCE']),
+                '-credential_file={}'.format(SQL_TOKEN_FILE)])
+
+        phases.append(Phase('sql_proxy', start_sql_proxy, ()))
+
+    if env.get('SQL_GATEWAY'):
+        log('SQL connections are pooled through the gateway at {}'.format(
+            env['SQL_GATEWAY']))
+
+    if env.get('GOOGLE_APPLICATION_CREDENTIALS'):
+        phases.append(Phase('gcloud_auth', lambda: run(
+            'gcloud', 'auth', 'activate-service-account', '--key-file',
+            env['GOOGLE_APPLICATION_CREDENTIALS']), ()))
+
+    return phases
+
+
+def get_notebook_phases(env):
+    '''
+    Get the preparation phases for a notebook container
+    '''
+    dask_config_dir = os.path.join(HOME, '.config', 'dask')
+    creds_dir = os.path.join(HOME, 'service-account-credentials')
+
+    def copy_dask_config():
+        if not os.path.isdir(dask_config_dir):
+            os.makedirs(dask_config_dir)
+
+        # /pre-home/config.yaml is removed on the first start, so it is
+        # missing when a container restarts
+        config = os.path.join(PRE_HOME, 'config.yaml')
+        if os.path.isfile(config):
+            run('cp', '--update', '-r', '-v', config, dask_config_dir)
+
+        # only the copy in ~ is read by rhg_compute_tools. It is rendered
+        # from /pre-home by add_service_creds.py, which leaves it untouched
+        # if the rendered template is unchanged
+        worker_template = os.path.join(PRE_HOME, 'worker-template.yml')
+        if os.path.isfile(worker_template):
+            run('cp', '-r', '-v', worker_template, dask_config_dir)
+
+        if os.path.isfile(config):
+            run('sudo', 'rm', config)
+
+    def copy_pre_home():
+        run('cp', '--update', '-r', '-v', PRE_HOME + '/.', HOME)
+
+    def copy_credentials():
+        run('sudo', 'mkdir', '-p', TOKEN_DIR)
+
+        if not os.path.isdir(creds_dir):
+            os.makedirs(creds_dir)
+
+        creds = sorted(glob.glob(os.path.join(creds_dir, '*.json')))
+        if creds:
+            run('sudo', 'cp', *(creds + [TOKEN_DIR + '/']))
+
+    def add_worker_credentials():
+        if os.path.isfile(os.path.join(PRE_HOME, 'worker-template.yml')):
+            run(sys.executable, os.path.join(HOME, 'add_service_creds.py'))
+
+    return [
+        Phase('dask_config', copy_dask_config, ()),
+        Phase('pre_home', copy_pre_home, ('dask_config',)),
+        Phase('gcsfuse_credentials', copy_credentials, ()),
+        Phase(
+            'gcsfuse_mounts',
+            lambda: _mount(creds_dir),
+            ('gcsfuse_credentials',)),
+        Phase('worker_template_credentials', add_worker_credentials, (
+            'pre_home',))]
+
+
+def _run_phase(phase, dependencies, origin):
+    failed = [
+        name for name, f in dependencies.items()
+        if f.result()['status'] != 'ok']
+
+    start = time.time()
+    record = {'start': start - origin}
+
+    # a failed phase only stops the phases which depend on it
+    if failed:
+        record['status'] = 'skipped'
+        record['error'] = 'requires failed phases: {}'.format(
+            ', '.join(failed))
+        record['seconds'] = 0.0
+        log('skipping {}: {}'.format(phase.name, record['error']))
+
+        return record
+
+    log('starting {}'.format(phase.name))
+
+    try:
+        phase.func()
+        record['status'] = 'ok'
+
+    except Exception as e:
+        record['status'] = 'error'
+        record['error'] = str(e)
+        log('{} failed: {}'.format(phase.name, e))
+
+    record['seconds'] = time.time() - start
+    log('finished {} in {:.2f}s'.format(phase.name, record['seconds']))
+
+    return record
+
+
+def run_phases(phases):
+    '''
+    Run phases concurrently, each once the phases it requires have finished
+
+    Phases must be listed after the phases they require. Requirements which
+    are not in ``phases`` are ignored. A phase is skipped if a phase it
+    requires failed or was skipped.
+
+    Returns
+    -------
+    timings : dict
+        ``{phase: {'start': seconds after the first phase started,
+        'seconds': duration, 'status': 'ok', 'error' or 'skipped'}}``
+    '''
+    origin = time.time()
+    futures = collections.OrderedDict()
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(len(phases), 1)) as executor:
+
+        for phase in phases:
+            dependencies = collections.OrderedDict(
+                (name, futures[name])
+                for name in phase.requires if name in futures)
+
+            futures[phase.name] = executor.submit(
+                _run_phase, phase, dependencies, origin)
+
+        return collections.OrderedDict(
+            (name, f.result()) for name, f in futures.items())
+
+
+def prepare(image, env=None, timing_file=None):
+    '''
+    Prepare a container, returning its JSON timing record
+    '''
+    if env is None:
+        env = os.environ
+
+    if timing_file is None:
+        timing_file = env.get('STARTUP_TIMING_FILE', TIMING_FILE)
+
+    get_phases = {
+        'worker': get_worker_phases,
+        'notebook': get_notebook_phases}[image]
+
+    started = datetime.datetime.now(datetime.timezone.utc)
+    start = time.time()
+
+    timings = run_phases(get_phases(env))
+
+    record = {
+        'image': image,
+        'hostname': socket.gethostname(),
+        'started': started.isoformat().replace('+00:00', 'Z'),
+        'total_seconds': time.time() - start,
+        'phases': timings}
+
+    line = json.dumps({'startup_timing': record}, sort_keys=True)
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+
+    try:
+        with open(timing_file, 'w') as f:
+            f.write(line + '\n')
+    except (OSError, IOError) as e:
+        log('could not write {}: {}'.format(timing_file, e))
+
+    return record
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    if not args or args[0] not in ('worker', 'notebook'):
+        sys.exit('usage: entrypoint.py {worker,notebook} [command ...]')
+
+    prepare(args[0])
+
+    # prepare.sh ran its command unquoted, so "start.sh jupyter lab" as a
+    # single argument is split into words
+    command = ' '.join(args[1:]).split()
+
+    if args[0] == 'worker':
+        # only copied into the worker image
+        import thread_tuning
+
+        layout, blas_env = thread_tuning.get_blas_env(command, os.environ)
+        os.environ.update(blas_env)
+
+        log('thread layout: {:.2f} CPUs, {} worker threads, {} BLAS/OpenMP '
+            'threads each{}'.format(
+                layout.cpus, layout.nthreads, layout.blas_threads,
+                '' if blas_env else ' (set in the environment)'))
+
+    if command:
+        os.execvp(command[0], command)
+
+
+if __name__ == '__main__':
+    main()
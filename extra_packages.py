@@ -0,0 +1,363 @@
+'''
+Resolve extra conda and pip packages once and install them on workers
+
+Installing ``EXTRA_CONDA_PACKAGES`` with ``conda install`` on every worker
+means every pod runs a full solve and downloads its packages from the
+channel. Instead, resolve the extras once from the notebook:
+
+.. code-block:: bash
+
+    $ python /usr/bin/extra_packages.py resolve \
+        --conda "xarray=0.15 zarr" --pip "rhg_compute_tools==0.2.1" \
+        --cache-dir /gcs/my-bucket/extra-packages
+
+This solves the requested conda packages against the notebook's base
+environment and writes an explicit package list, together with the package
+tarballs and a wheelhouse for the pip packages, to a directory of the cache
+keyed by the hash of the list. The directory is added to
+``~/worker-template.yml`` as ``EXTRA_PACKAGES_DIR``, and workers started from
+the template install from it with no solve and no channel access:
+
+.. code-block:: bash
+
+    $ python /usr/bin/extra_packages.py install "$EXTRA_PACKAGES_DIR"
+
+The cache directory must be visible to the workers, e.g. in a gcsfuse-mounted
+bucket. Resolving the same packages again reuses the existing cache entry.
+Entries are written in place, as gcsfuse can't rename directories, and a
+``.complete`` marker is written last; an entry without the marker is
+rewritten by the next resolve.
+
+This script is copied into the images on its own, so it can't import
+``maintenance_utilities/conda_tools.py``. :py:func:`format_explicit` must list
+packages the same way as ``conda_tools.format_explicit_lock``.
+
+'''
+
+import os
+import sys
+import json
+import hashlib
+import tempfile
+import argparse
+import subprocess
+
+
+EXPLICIT_FILE = 'explicit.txt'
+REQUIREMENTS_FILE = 'requirements.txt'
+PKGS_DIR = 'pkgs'
+COMPLETE_FILE = '.complete'
+WHEELHOUSE_DIR = 'wheelhouse'
+
+WORKER_TEMPLATE = '/home/jovyan/worker-template.yml'
+
+CONDA_PREFIX = '/opt/conda'
+
+
+def get_cache_key(explicit, requirements):
+    '''
+    Hash an explicit package list and pip requirements into a cache key
+    '''
+    h = hashlib.sha256()
+    h.update(explicit.encode())
+    h.update(b'\0')
+    h.update('\n'.join(requirements).encode())
+
+    return h.hexdigest()[:16]
+
+
+def format_explicit(records):
+    '''
+    Format conda package records as an ``@EXPLICIT`` package list
+
+    The package lines match ``conda_tools.format_explicit_lock``, without its
+    header comments.
+    '''
+    lines = ['@EXPLICIT']
+
+    # packages are installed in list order, so keep the solver's order
+    for r in records:
+        if getattr(r, 'md5', None):
+            lines.append('{}#{}'.format(r.url, r.md5))
+        else:
+            lines.append(r.url)
+
+    return '\n'.join(lines) + '\n'
+
+
+def parse_explicit(explicit):
+    '''
+    Parse an ``@EXPLICIT`` package list into ``(url, md5)`` tuples
+    '''
+    packages = []
+
+    for line in explicit.splitlines():
+        line = line.strip()
+        if (not line) or line.startswith('#') or line.startswith('@'):
+            continue
+
+        url, _, md5 = line.partition('#')
+        packages.append((url, md5 or None))
+
+    return packages
+
+
+def get_installed_filenames(prefix=CONDA_PREFIX):
+    '''
+    Get the package filenames installed in a conda prefix from conda-meta
+    '''
+    installed = set()
+    meta_dir = os.path.join(prefix, 'conda-meta')
+
+    if not os.path.isdir(meta_dir):
+        return installed
+
+    for fname in os.listdir(meta_dir):
+        if not fname.endswith('.json'):
+            continue
+
+        try:
+            with open(os.path.join(meta_dir, fname), 'r') as f:
+                meta = json.load(f)
+        except (OSError, IOError, ValueError):
+            continue
+
+        if meta.get('fn'):
+            installed.add(meta['fn'])
+        elif meta.get('url'):
+            installed.add(meta['url'].rsplit('/', 1)[-1])
+
+    return installed
+
+
+def get_missing_packages(explicit, cache_dir, installed):
+    '''
+    Map an explicit list onto the tarball cache, skipping installed packages
+
+    Parameters
+    ----------
+    explicit : str
+        ``@EXPLICIT`` package list
+    cache_dir : str
+        Cache entry containing the package tarballs in ``pkgs/``
+    installed : set
+        Package filenames already installed in the target prefix
+
+    Returns
+    -------
+    explicit : str or None
+        ``@EXPLICIT`` list of ``file://`` URLs into the cache for each package
+        which is not installed, or None if all packages are installed
+    '''
+    lines = []
+
+    for url, md5 in parse_explicit(explicit):
+        fn = url.rsplit('/', 1)[-1]
+        if fn in installed:
+            continue
+
+        local = 'file://' + os.path.abspath(
+            os.path.join(cache_dir, PKGS_DIR, fn))
+        lines.append('{}#{}'.format(local, md5) if md5 else local)
+
+    if not lines:
+        return
+
+    return '\n'.join(['@EXPLICIT'] + lines) + '\n'
+
+
+def _get_closure(records, specs):
+    from conda.models.match_spec import MatchSpec
+
+    by_name = {r.name: r for r in records}
+    closure = {}
+    queue = [MatchSpec(s).name for s in specs]
+
+    while queue:
+        name = queue.pop()
+        if name in closure or name not in by_name:
+            continue
+
+        closure[name] = by_name[name]
+        queue.extend(MatchSpec(d).name for d in by_name[name].depends)
+
+    return [r for r in records if r.name in closure]
+
+
+def resolve_conda_packages(specs, prefix=CONDA_PREFIX):
+    '''
+    Solve conda specs against a prefix and list the records they require
+
+    Returns the full dependency closure of the specs in the solved
+    environment, so that the list can be installed into any environment
+    aligned with ``prefix``; packages already installed are skipped at
+    install time.
+    '''
+    from conda.api import Solver
+    from conda.base.context import context
+
+    solver = Solver(prefix, context.channels, specs_to_add=specs)
+    final_state = solver.solve_final_state()
+
+    return _get_closure(final_state, specs)
+
+
+def _populate_cache(target, records, requirements):
+    from conda.gateways.connection.download import download
+
+    os.makedirs(os.path.join(target, PKGS_DIR), exist_ok=True)
+
+    for r in records:
+        print('downloading {}'.format(r.fn))
+        download(r.url, os.path.join(target, PKGS_DIR, r.fn), r.md5)
+
+    if requirements:
+        subprocess.check_call(
+            [sys.executable, '-m', 'pip', 'download',
+             '--dest', os.path.join(target, WHEELHOUSE_DIR)] + requirements)
+
+
+def resolve(conda_specs, requirements, cache_dir, prefix=CONDA_PREFIX):
+    '''
+    Resolve extra packages into a cache entry, reusing an existing entry
+
+    Returns
+    -------
+    entry : str
+        Path to the cache entry for the resolved packages
+    '''
+    records = resolve_conda_packages(conda_specs, prefix) if conda_specs else []
+    explicit = format_explicit(records)
+    key = get_cache_key(explicit, requirements)
+
+    entry = os.path.join(cache_dir, key)
+    if os.path.isfile(os.path.join(entry, COMPLETE_FILE)):
+        print('using cached extra packages in {}'.format(entry))
+        return entry
+
+    # the entry's contents are determined by its key, so an incomplete entry
+    # left by a failed or concurrent resolve is safe to write over
+    _populate_cache(entry, records, requirements)
+
+    with open(os.path.join(entry, EXPLICIT_FILE), 'w+') as f:
+        f.write(explicit)
+
+    with open(os.path.join(entry, REQUIREMENTS_FILE), 'w+') as f:
+        f.write(''.join(r + '\n' for r in requirements))
+
+    with open(os.path.join(entry, COMPLETE_FILE), 'w+') as f:
+        f.write(key + '\n')
+
+    print('extra packages cached in {}'.format(entry))
+
+    return entry
+
+
+def add_to_worker_template(
+        entry, worker_template=WORKER_TEMPLATE, conda=True, pip=True):
+    '''
+    Point workers at a cache entry in place of installing packages themselves
+
+    ``EXTRA_CONDA_PACKAGES`` and ``EXTRA_PIP_PACKAGES`` are removed from the
+    template only if the entry resolved conda or pip packages respectively,
+    so that extras which were not resolved are still installed by the worker.
+    '''
+    import yaml
+
+    with open(worker_template, 'r') as f:
+        template = yaml.safe_load(f)
+
+    resolved = ['EXTRA_PACKAGES_DIR']
+    if conda:
+        resolved.append('EXTRA_CONDA_PACKAGES')
+    if pip:
+        resolved.append('EXTRA_PIP_PACKAGES')
+
+    env_vars = [
+        env for env in template['spec']['containers'][0]['env']
+        if env['name'] not in resolved]
+
+    env_vars.append({'name': 'EXTRA_PACKAGES_DIR', 'value': entry})
+
+    template['spec']['containers'][0]['env'] = env_vars
+
+    with open(worker_template, 'w') as f:
+        f.write(yaml.dump(template))
+
+    print('worker-template.yml updated')
+
+
+def install(entry, prefix=CONDA_PREFIX):
+    '''
+    Install a resolved cache entry without solving or contacting a channel
+    '''
+    with open(os.path.join(entry, EXPLICIT_FILE), 'r') as f:
+        explicit = f.read()
+
+    missing = get_missing_packages(
+        explicit, entry, get_installed_filenames(prefix))
+
+    if missing is not None:
+        fd, local_list = tempfile.mkstemp(suffix='.txt')
+
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(missing)
+
+            subprocess.check_call([
+                os.path.join(prefix, 'bin', 'conda'), 'install',
+                '--offline', '--yes', '--prefix', prefix, '--file', local_list])
+
+        finally:
+            os.remove(local_list)
+
+    requirements = os.path.join(entry, REQUIREMENTS_FILE)
+    if os.path.isfile(requirements) and os.path.getsize(requirements) > 0:
+        subprocess.check_call([
+            os.path.join(prefix, 'bin', 'pip'), 'install', '--no-index',
+            '--find-links', os.path.join(entry, WHEELHOUSE_DIR),
+            '--requirement', requirements])
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command')
+
+    resolve_parser = subparsers.add_parser(
+        'resolve', help='resolve extra packages into the shared cache')
+    resolve_parser.add_argument(
+        '--conda', default='', help='space-separated conda specs')
+    resolve_parser.add_argument(
+        '--pip', default='', help='space-separated pip requirements')
+    resolve_parser.add_argument(
+        '--cache-dir', required=True,
+        help='shared directory visible to the workers')
+    resolve_parser.add_argument(
+        '--worker-template', default=WORKER_TEMPLATE,
+        help='worker template to update ("" to skip)')
+
+    install_parser = subparsers.add_parser(
+        'install', help='install a resolved cache entry')
+    install_parser.add_argument('entry', help='cache entry to install')
+
+    args = parser.parse_args(args)
+
+    if args.command == 'resolve':
+        conda_specs, requirements = args.conda.split(), args.pip.split()
+        entry = resolve(conda_specs, requirements, args.cache_dir)
+        if args.worker_template:
+            add_to_worker_template(
+                entry,
+                args.worker_template,
+                conda=bool(conda_specs),
+                pip=bool(requirements))
+
+    elif args.command == 'install':
+        install(args.entry)
+
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
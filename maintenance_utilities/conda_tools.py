@@ -15,8 +15,30 @@ TODO:
 
 import os
 import re
+import copy
+import json
+import shlex
+import posixpath
+import time
 import yaml
+import hashlib
+import zipfile
+import email.parser
+import multiprocessing
+import collections
+import concurrent.futures
+
+import conda
+from conda.base.context import context
 from conda.core.solve import Solver
+from conda.core.subdir_data import SubdirData
+from conda.models.channel import Channel
+from conda.models.match_spec import MatchSpec
+from conda.models.records import PackageRecord
+from conda.models.version import VersionOrder
+from packaging.requirements import Requirement, InvalidRequirement
+from packaging.specifiers import SpecifierSet
+from packaging.version import Version, InvalidVersion
 
 CONDA_ARGS = {
     '-n': '--name',
@@ -32,6 +54,89 @@ CONDA_ARGS = {
     '-v': '--verbose',
     '-y': '--yes'}
 
+CACHE_DIR = os.environ.get(
+    'CONDA_TOOLS_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'rhg-docker-images'))
+'''
+Root directory for on-disk caches written by this module
+
+Override with the ``CONDA_TOOLS_CACHE_DIR`` environment variable.
+'''
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DOCKER_IMAGES = {
+    'notebook': ['notebook/Dockerfile'],
+    'worker': ['worker/Dockerfile'],
+    'octave-worker': ['worker/Dockerfile', 'octave-worker/Dockerfile'],
+    }
+'''
+Dockerfiles used to build each image, relative to :py:data:`REPO_ROOT`
+'''
+
+ENV_PAIRINGS = [
+    ('notebook', 'base', 'worker', 'base'),
+    ('notebook', 'base', 'octave-worker', 'base'),
+]
+'''
+(notebook image, notebook env, worker image, worker env) pairings whose
+shared packages must be identical
+'''
+
+LAYER_INSTRUCTIONS = ('RUN', 'COPY', 'ADD')
+'''
+Dockerfile instructions which add a filesystem layer to the image
+'''
+
+SOLVE_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+SOLVE_CACHE_MAX_SIZE = 256 * 1024 * 1024
+SOLVE_CACHE_TMP_MAX_AGE = 24 * 60 * 60
+
+WHEEL_DIRS = os.environ.get(
+    'CONDA_TOOLS_WHEEL_DIRS',
+    os.path.join(CACHE_DIR, 'wheels')).split(os.pathsep)
+'''
+Directories of wheels indexed by :py:class:`WheelIndex` for offline pip
+resolution
+
+Override with the ``CONDA_TOOLS_WHEEL_DIRS`` environment variable (a
+``os.pathsep``-separated list). Populate a directory once, with network
+access, using e.g.:
+
+.. code-block:: bash
+
+    $ pip wheel --wheel-dir ~/.cache/rhg-docker-images/wheels \\
+        mapbox==0.18.0 rhg_compute_tools==0.2.2 ...
+
+'''
+
+REPODATA_SNAPSHOT_DIR = os.environ.get('CONDA_TOOLS_REPODATA_SNAPSHOT')
+'''
+Directory of a pruned repodata snapshot (see :py:class:`RepodataSnapshot`)
+to solve against instead of the upstream channels, or ``None``
+
+Set with the ``CONDA_TOOLS_REPODATA_SNAPSHOT`` environment variable.
+'''
+
+IMPLICIT_DEPENDENCIES = {'python': ['pip']}
+'''
+Dependencies conda adds when loading repodata, which aren't listed in the
+records' ``depends``
+'''
+
+CONDA_PIP_NAMES = {
+    'matplotlib-base': 'matplotlib',
+    'msgpack-python': 'msgpack',
+    'pytables': 'tables',
+    'python-blosc': 'blosc',
+    'python-graphviz': 'graphviz',
+    'pytorch': 'torch',
+}
+'''
+pip distribution names of conda packages whose names differ, used to treat
+pip requirements on these packages as satisfied by conda
+'''
+
 
 def get_conda_solver(
         filepath=None,
@@ -113,17 +218,16 @@ def get_conda_solver(
 
           - python[version='<3.0']
 
-    TODO
-    ----
+    Notes
+    -----
 
-    * figure out how to solve for/align pip dependencies. currently these are
-      ignored
+    ``pip:`` sections of environment files are not passed to the solver. See
+    :py:func:`solve_pip` for resolving and aligning pip dependencies.
 
     '''
 
     if filepath is not None:
-        with open(filepath, 'r') as f:
-            spec = yaml.safe_load(f)
+        spec = load_env_file(filepath)
     else:
         spec = {
             'prefix': prefix,
@@ -131,7 +235,8 @@ def get_conda_solver(
             'subdirs': subdirs if subdirs is not None else [],
             'dependencies': specs_to_add if specs_to_add is not None else []}
 
-    # exclude pip dependencies - these trip up the Solver
+    # exclude pip dependencies - these trip up the Solver, and are resolved
+    # separately by solve_pip
     conda_packages = [
         d for d in spec.get('dependencies', []) if not isinstance(d, dict)]
 
@@ -195,7 +300,471 @@ def parse_conda_create_command(env, args):
     return spec
 
 
-def get_conda_specs(dockerfile, conda_specs=None):
+def _file_sha256(filepath):
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def _add_to_manifest(manifest, env, filepath):
+    if manifest is None:
+        return
+
+    manifest.setdefault(env, {})[filepath] = _file_sha256(filepath)
+
+
+_ENV_FILE_CACHE = {}
+_DOCKERFILE_CACHE = {}
+
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def load_env_file(filepath):
+    '''
+    Load a conda environment yml file, cached by file content hash
+
+    Uses libyaml's ``CSafeLoader`` when available.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the environment file
+
+    Returns
+    -------
+    spec : dict
+        Parsed environment spec. A copy of the cached spec is returned, so it
+        is safe to modify.
+    '''
+    with open(filepath, 'rb') as f:
+        contents = f.read()
+
+    key = hashlib.sha256(contents).hexdigest()
+
+    if key not in _ENV_FILE_CACHE:
+        _ENV_FILE_CACHE[key] = yaml.load(contents, Loader=_YAML_LOADER)
+
+    return copy.deepcopy(_ENV_FILE_CACHE[key])
+
+
+DockerInstruction = collections.namedtuple(
+    'DockerInstruction',
+    ['lineno', 'instruction', 'value', 'flags', 'args', 'commands'])
+DockerInstruction.__doc__ = '''
+A single Dockerfile instruction
+
+``lineno`` is the first line of the instruction in the Dockerfile,
+``instruction`` the upper-cased keyword, and ``value`` the raw text after the
+keyword with line continuations joined. ``flags`` holds ``--flag=value``
+options (e.g. ``--from`` or ``--chown``), and ``args`` the remaining
+arguments after ``ARG``/``ENV`` substitution. For ``RUN`` instructions,
+``commands`` is a list of the tokenized shell commands chained with ``&&``,
+``||``, ``;`` or ``|``.
+'''
+
+DockerStage = collections.namedtuple(
+    'DockerStage', ['index', 'base', 'name', 'env', 'instructions'])
+DockerStage.__doc__ = '''
+A build stage: the ``FROM`` image, optional ``AS`` name, the ``ARG``/``ENV``
+variables defined at the end of the stage, and its instructions.
+'''
+
+Dockerfile = collections.namedtuple(
+    'Dockerfile', ['path', 'sha256', 'global_args', 'stages'])
+Dockerfile.__doc__ = '''
+Parsed Dockerfile returned by :py:func:`parse_dockerfile`
+'''
+
+
+def get_logical_lines(text):
+    '''
+    Yield ``(start, end, line)`` for each Dockerfile instruction
+
+    ``start`` and ``end`` are the first and last (1-indexed) lines of the
+    instruction, and ``line`` the instruction with continuations joined.
+    Comment lines are dropped, including those inside continued instructions.
+    '''
+    current = []
+    start = None
+    end = None
+
+    for lineno, line in enumerate(text.splitlines(), 1):
+        stripped = line.strip()
+
+        if stripped.startswith('#') or (not stripped and not current):
+            continue
+
+        if start is None:
+            start = lineno
+        end = lineno
+
+        if stripped.endswith('\\'):
+            current.append(stripped[:-1].strip())
+            continue
+
+        current.append(stripped)
+        yield start, end, ' '.join(c for c in current if c)
+
+        current = []
+        start = None
+
+    if current:
+        yield start, end, ' '.join(c for c in current if c)
+
+
+_VAR_PATTERN = re.compile(
+    r'\$(?:\{(?P<braced>\w+)(?:(?P<op>:[-+])(?P<word>[^}]*))?\}|(?P<bare>\w+))')
+
+
+def _expand_vars(value, variables):
+    '''
+    Substitute ``$VAR``, ``${VAR}``, ``${VAR:-default}`` and ``${VAR:+alt}``
+
+    Variables which are not defined are left untouched, as they may be
+    defined in the base image or at container runtime.
+    '''
+    def substitute(match):
+        name = match.group('braced') or match.group('bare')
+        op = match.group('op')
+        defined = variables.get(name) is not None
+
+        if op == ':-':
+            return variables[name] if defined else match.group('word')
+        if op == ':+':
+            return match.group('word') if defined else ''
+
+        return variables[name] if defined else match.group(0)
+
+    return _VAR_PATTERN.sub(substitute, value)
+
+
+def _split_shell_commands(value):
+    '''
+    Split a shell command line on unquoted ``&&``, ``||``, ``;`` and ``|``
+    '''
+    commands = []
+    current = []
+    quote = None
+    i = 0
+
+    while i < len(value):
+        char = value[i]
+
+        if quote is not None:
+            current.append(char)
+            if char == quote:
+                quote = None
+            elif char == '\\' and quote == '"' and i + 1 < len(value):
+                current.append(value[i + 1])
+                i += 1
+
+        elif char in '\'"':
+            quote = char
+            current.append(char)
+
+        elif char == '\\' and i + 1 < len(value):
+            current.append(value[i:i + 2])
+            i += 1
+
+        elif char in '&|;':
+            if value[i:i + 2] in ('&&', '||'):
+                i += 1
+            commands.append(''.join(current))
+            current = []
+
+        else:
+            current.append(char)
+
+        i += 1
+
+    commands.append(''.join(current))
+
+    parsed = []
+    for command in commands:
+        try:
+            tokens = shlex.split(command)
+        except ValueError:
+            tokens = command.split()
+
+        if tokens:
+            parsed.append(tokens)
+
+    return parsed
+
+
+def _parse_flags(tokens):
+    flags = {}
+    args = []
+
+    for token in tokens:
+        if token.startswith('--') and not args:
+            key, _, value = token[2:].partition('=')
+            flags[key] = value
+        else:
+            args.append(token)
+
+    return flags, args
+
+
+def _parse_assignments(value):
+    '''
+    Parse the ``key=value`` pairs of an ``ENV``, ``ARG`` or ``LABEL`` line
+    '''
+    try:
+        tokens = shlex.split(value)
+    except ValueError:
+        tokens = value.split()
+
+    if not tokens:
+        return []
+
+    if '=' not in tokens[0]:
+        # legacy ``ENV key value with spaces`` form
+        return [(tokens[0], value.split(None, 1)[1].strip()
+                 if len(tokens) > 1 else None)]
+
+    pairs = []
+    for token in tokens:
+        key, sep, val = token.partition('=')
+        pairs.append((key, val if sep else None))
+
+    return pairs
+
+
+def _parse_instruction(lineno, line, variables):
+    keyword, _, value = line.partition(' ')
+    keyword = keyword.upper()
+    value = value.strip()
+
+    commands = []
+
+    if keyword == 'RUN':
+        expanded = _expand_vars(value, variables)
+
+        if expanded.startswith('['):
+            try:
+                commands = [json.loads(expanded)]
+            except ValueError:
+                commands = _split_shell_commands(expanded)
+        else:
+            commands = _split_shell_commands(expanded)
+
+        return DockerInstruction(lineno, keyword, value, {}, [], commands)
+
+    if keyword in ('ENV', 'ARG', 'LABEL'):
+        args = [
+            '{}={}'.format(k, _expand_vars(v, variables))
+            if v is not None else k
+            for k, v in _parse_assignments(value)]
+
+        return DockerInstruction(lineno, keyword, value, {}, args, [])
+
+    expanded = _expand_vars(value, variables)
+
+    if expanded.startswith('['):
+        try:
+            tokens = [str(t) for t in json.loads(expanded)]
+        except ValueError:
+            tokens = expanded.split()
+    else:
+        tokens = expanded.split()
+
+    flags, args = _parse_flags(tokens)
+
+    return DockerInstruction(lineno, keyword, value, flags, args, commands)
+
+
+def parse_dockerfile(dockerfile, build_args=None):
+    '''
+    Parse a Dockerfile into build stages and instructions
+
+    Handles line continuations, comments, ``ARG`` (including global args
+    declared before the first ``FROM``) and ``ENV`` substitution, exec-form
+    (JSON array) arguments, ``--flag`` options, multi-stage builds and
+    chained shell commands in ``RUN`` instructions. Results are cached by the
+    content hash of the Dockerfile.
+
+    Parameters
+    ----------
+    dockerfile : str
+        Path to a Dockerfile
+    build_args : dict, optional
+        Values for ``ARG`` variables, as would be passed to ``docker build
+        --build-arg``
+
+    Returns
+    -------
+    parsed : Dockerfile
+        Parsed Dockerfile. A copy of the cached result is returned, so it
+        may be modified by the caller.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> parsed = parse_dockerfile('octave-worker/Dockerfile')
+        >>> parsed.stages[0].base
+        'rhodium/worker:${TRAVIS_COMMIT}'
+        >>> [i.instruction for i in parsed.stages[0].instructions]
+        ['ARG', 'COPY', 'RUN', 'RUN']
+
+    '''
+    build_args = dict(build_args or {})
+
+    with open(dockerfile, 'rb') as f:
+        contents = f.read()
+
+    sha256 = hashlib.sha256(contents).hexdigest()
+    key = (os.path.abspath(dockerfile), sha256, tuple(sorted(build_args.items())))
+
+    if key in _DOCKERFILE_CACHE:
+        return copy.deepcopy(_DOCKERFILE_CACHE[key])
+
+    global_args = {}
+    stages = []
+    variables = global_args
+    instructions = None
+
+    for lineno, _, line in get_logical_lines(contents.decode('utf-8')):
+        instruction = _parse_instruction(lineno, line, variables)
+
+        if instruction.instruction == 'FROM':
+            base = instruction.args[0] if instruction.args else None
+            name = None
+            if len(instruction.args) >= 3 and instruction.args[1].upper() == 'AS':
+                name = instruction.args[2]
+
+            # stages built on an earlier stage inherit its ENV
+            variables = {}
+            for stage in stages:
+                if stage.name is not None and stage.name == base:
+                    variables = dict(stage.env)
+
+            instructions = []
+            stages.append(DockerStage(
+                len(stages), base, name, variables, instructions))
+
+            continue
+
+        if instruction.instruction in ('ARG', 'ENV'):
+            for k, v in _parse_assignments(instruction.value):
+                if instruction.instruction == 'ARG':
+                    if k in build_args:
+                        v = build_args[k]
+                    elif v is None:
+                        v = global_args.get(k)
+                if v is not None:
+                    v = _expand_vars(v, variables)
+                variables[k] = v
+
+        if instructions is None:
+            # only ARG and comments/directives may precede the first FROM
+            continue
+
+        instructions.append(instruction)
+
+    parsed = Dockerfile(dockerfile, sha256, global_args, stages)
+    _DOCKERFILE_CACHE[key] = parsed
+
+    return copy.deepcopy(parsed)
+
+
+def _resolve_build_context_path(docker_wd, src):
+    '''
+    Locate a COPY source on the local machine
+
+    Files shared across images (e.g. ``base_environment.yml`` and
+    ``common.sh``) live in the repository root and are copied into the build
+    context by CI, so fall back to the repository root if the file is not in
+    the Dockerfile's directory.
+    '''
+    path = os.path.join(docker_wd, src)
+
+    if not os.path.exists(path):
+        shared = os.path.join(REPO_ROOT, src)
+        if os.path.exists(shared):
+            return shared
+
+    return path
+
+
+def get_copy_targets(instruction, docker_wd, workdir='/'):
+    '''
+    Map the container paths created by a COPY/ADD instruction to local files
+
+    Parameters
+    ----------
+    instruction : DockerInstruction
+        ``COPY`` or ``ADD`` instruction
+    docker_wd : str
+        Docker build context directory
+    workdir : str
+        Container working directory in effect for the instruction
+
+    Returns
+    -------
+    targets : dict
+        ``{container path: local path}``. Where the destination may be a
+        directory (no trailing slash and a single source), both the
+        destination and ``destination/basename(source)`` are included.
+    '''
+    if len(instruction.args) < 2 or 'from' in instruction.flags:
+        return {}
+
+    sources = instruction.args[:-1]
+    dest = posixpath.join(workdir, instruction.args[-1])
+
+    targets = {}
+
+    for src in sources:
+        local = _resolve_build_context_path(docker_wd, src)
+        in_dir = posixpath.join(dest, posixpath.basename(src.rstrip('/')))
+
+        if dest.endswith('/') or len(sources) > 1:
+            targets[posixpath.normpath(in_dir)] = local
+        else:
+            targets[posixpath.normpath(dest)] = local
+            targets[posixpath.normpath(in_dir)] = local
+
+    return targets
+
+
+def _get_stage_lineage(stages):
+    '''
+    Returns the stages which make up the final image, in build order
+    '''
+    if not stages:
+        return []
+
+    by_name = {s.name: s for s in stages if s.name is not None}
+    lineage = [stages[-1]]
+
+    while lineage[0].base in by_name and by_name[lineage[0].base] not in lineage:
+        lineage.insert(0, by_name[lineage[0].base])
+
+    return lineage
+
+
+def _add_conda_install_spec(conda_specs, env, command):
+    spec = parse_conda_create_command(env, command)
+    solver = get_conda_solver(
+        prefix=spec['name'],
+        channels=spec.get('channels'),
+        subdirs=spec.get('subdirs'),
+        specs_to_add=spec.get('dependencies'),
+        existing_solver=conda_specs.get(spec['name'], None))
+
+    conda_specs[spec['name']] = solver
+
+    return spec['name']
+
+
+def get_conda_specs(dockerfile, conda_specs=None, manifest=None,
+                    build_args=None):
     '''
     Scours a docker file for conda commands, and returns a spec for each env
 
@@ -205,6 +774,12 @@ def get_conda_specs(dockerfile, conda_specs=None):
         Path to a Dockerfile
     conda_specs: dict, None
         Existing conda specs from the Dockerfile build dependencies
+    manifest: dict, None
+        If provided, updated in place with a dependency manifest of
+        ``{env: {filepath: sha256}}`` listing the Dockerfile and environment
+        files which feed each conda environment.
+    build_args: dict, None
+        Values for ``ARG`` variables (see :py:func:`parse_dockerfile`)
 
     Returns
     -------
@@ -218,69 +793,63 @@ def get_conda_specs(dockerfile, conda_specs=None):
     if conda_specs is None:
         conda_specs = {}
 
-    files_in_docker_scope = {}
+    parsed = parse_dockerfile(dockerfile, build_args=build_args)
+    docker_wd = os.path.dirname(dockerfile)
 
-    with open(dockerfile, 'r') as f:
-        docker_wd = os.path.dirname(dockerfile)
+    files_in_docker_scope = {}
+    env = 'base'
 
-        line_getter = f
+    for stage in _get_stage_lineage(parsed.stages):
+        workdir = '/'
 
-        in_conda = False
-        env = 'base'
+        for instruction in stage.instructions:
+            if instruction.instruction in ('COPY', 'ADD'):
+                files_in_docker_scope.update(
+                    get_copy_targets(instruction, docker_wd, workdir))
 
-        while True:
-            try:
-                line = next(f).split('#')[0].strip()
-            except StopIteration:
-                break
+            elif instruction.instruction == 'WORKDIR' and instruction.args:
+                workdir = posixpath.join(workdir, instruction.args[0])
 
-            args = re.split(r'\s+', line.rstrip('\\').strip())
+            elif instruction.instruction != 'RUN':
+                continue
 
-            # expand arg abbrevs
-            args = [CONDA_ARGS.get(a, a) for a in args]
+            for command in instruction.commands:
+                if command[0] == 'sudo':
+                    command = command[1:]
 
-            if args[0].upper() == 'COPY':
-                files_in_docker_scope[args[2]] = (
-                    os.path.join(docker_wd, args[1]))
-            elif (
-                    (args[0].upper() == 'RUN')
-                    and (args[1].lower() in ['conda', 'source'])
-                    and (args[2].lower() == 'activate')):
+                if len(command) < 3:
+                    continue
 
-                env = args[3]
+                program = posixpath.basename(command[0])
+                args = [CONDA_ARGS.get(a, a) for a in command[1:]]
 
-            elif (
-                    (args[0].upper() == 'RUN')
-                    and (args[1].lower() == 'conda')
-                    and (args[2].lower() in ['install', 'create'])):
+                if program in ('conda', 'source') and args[0] == 'activate':
+                    env = args[1]
 
-                conda_spec = args[1:]
+                elif program != 'conda':
+                    continue
 
-                if line.endswith('\\'):
-                    in_conda = True
-                else:
-                    spec = parse_conda_create_command(env, conda_spec)
-                    solver = get_conda_solver(
-                        prefix=spec['name'],
-                        channels=spec.get('channels'),
-                        subdirs=spec.get('subdirs'),
-                        specs_to_add=spec.get('dependencies'),
-                        existing_solver=conda_specs.get(spec['name'], None))
+                elif args[0] in ('install', 'create'):
+                    name = _add_conda_install_spec(
+                        conda_specs, env, ['conda'] + args)
+                    _add_to_manifest(manifest, name, dockerfile)
 
-                    conda_specs[spec['name']] = solver
+                elif args[0] == 'env' and args[1] in ('create', 'update'):
+                    if '--file' not in args[:-1]:
+                        raise ValueError(
+                            "I can't parse this line: {}".format(
+                                instruction.value))
 
-            elif (
-                    (args[0].upper() == 'RUN')
-                    and (args[1].lower() == 'conda')
-                    and (args[2].lower() == 'env')
-                    and (args[3].lower() in ['create', 'update'])):
+                    env_path = posixpath.normpath(posixpath.join(
+                        workdir, args[args.index('--file') + 1]))
 
-                if '--file' in args:
-                    env_file = files_in_docker_scope[
-                        args[args.index('--file') + 1]]
+                    if env_path not in files_in_docker_scope:
+                        raise ValueError(
+                            'environment file {} is not copied into the '
+                            'image in {}'.format(env_path, dockerfile))
 
-                    with open(env_file, 'r') as y:
-                        env_spec = yaml.safe_load(y)
+                    env_file = files_in_docker_scope[env_path]
+                    env_spec = load_env_file(env_file)
 
                     solver = get_conda_solver(
                         env_file,
@@ -288,31 +857,2110 @@ def get_conda_specs(dockerfile, conda_specs=None):
                             env_spec['name'], None))
 
                     conda_specs[solver.prefix] = solver
-
-                else:
-                    raise ValueError(
-                        "I can't parse this line: {}".format(line))
-
-            elif in_conda:
-                conda_spec += args
-
-                if not line.endswith('\\'):
-                    spec = parse_conda_create_command(env, conda_spec)
-                    solver = get_conda_solver(
-                        prefix=spec['name'],
-                        channels=spec.get('channels'),
-                        subdirs=spec.get('subdirs'),
-                        specs_to_add=spec.get('dependencies'),
-                        existing_solver=conda_specs.get(spec['name'], None))
-
-                    conda_specs[spec['name']] = solver
-                    in_conda = False
+                    _add_to_manifest(manifest, solver.prefix, dockerfile)
+                    _add_to_manifest(manifest, solver.prefix, env_file)
 
     return conda_specs
 
-def build_final_envs_for_multiple_docker_files(dockerfiles):
+
+def build_final_envs_for_multiple_docker_files(
+        dockerfiles, manifest=None, build_args=None):
     envs = {}
     for dockerfile in dockerfiles:
-        envs.update(get_conda_specs(dockerfile, envs))
+        envs.update(get_conda_specs(
+            dockerfile, envs, manifest=manifest, build_args=build_args))
 
     return envs
+
+
+def _repodata_snapshot(channels, subdirs):
+    '''
+    Identify the state of the locally cached repodata for a set of channels
+
+    Reads the ``_etag`` and ``_mod`` headers conda writes at the top of each
+    cached repodata json file. Only the head of each file is read, so this
+    does not pay the cost of parsing the full repodata. Falls back to file
+    size and mtime if the headers are missing, and to ``None`` for channels
+    which have not been fetched yet.
+    '''
+    snapshot = []
+
+    for channel in channels:
+        for url in Channel(channel).urls(
+                with_credentials=False, subdirs=subdirs or None):
+
+            cache_path = SubdirData(Channel(url)).cache_path_json
+
+            try:
+                with open(cache_path, 'r') as f:
+                    head = f.read(4096)
+                stat = os.stat(cache_path)
+            except (OSError, IOError):
+                snapshot.append((url, None))
+                continue
+
+            headers = dict(re.findall(
+                r'"(_etag|_mod)":\s*"([^"]*)"', head))
+
+            if headers:
+                snapshot.append((url, sorted(headers.items())))
+            else:
+                snapshot.append((url, (stat.st_size, stat.st_mtime)))
+
+    return snapshot
+
+
+def get_solver_cache_key(solver, repodata_snapshot=None):
+    '''
+    Compute a content hash identifying the solution to a solver
+
+    The key covers the normalized specs to add and remove, the channels (in
+    priority order), the subdirs, the target prefix, the conda version, and a
+    snapshot of the cached repodata for the solver's channels.
+
+    Parameters
+    ----------
+    solver : conda.core.solve.Solver
+    repodata_snapshot : object, optional
+        JSON-serializable token identifying the repodata the solve will run
+        against. Default is to read the state of conda's repodata cache.
+
+    Returns
+    -------
+    key : str
+        sha256 hex digest
+    '''
+
+    channels = [Channel(c).canonical_name for c in solver.channels]
+    subdirs = list(solver.subdirs)
+
+    if repodata_snapshot is None:
+        repodata_snapshot = _repodata_snapshot(channels, subdirs)
+
+    key_spec = {
+        'prefix': solver.prefix,
+        'specs_to_add': sorted(str(s) for s in solver.specs_to_add),
+        'specs_to_remove': sorted(str(s) for s in solver.specs_to_remove),
+        'channels': channels,
+        'subdirs': subdirs,
+        'conda': conda.__version__,
+        'repodata': repodata_snapshot}
+
+    return hashlib.sha256(
+        json.dumps(key_spec, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class SolveCache(object):
+    '''
+    Persistent, content-addressed cache of solved environments
+
+    Each entry is a json file named by :py:func:`get_solver_cache_key`
+    containing the dumped :py:class:`~conda.models.records.PackageRecord`
+    list from :py:meth:`~conda.core.solve.Solver.solve_final_state`. Entries
+    are touched on read, so eviction by size drops the least recently used
+    solutions first.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        Directory in which to store solutions. Default is ``solves`` in
+        :py:data:`CACHE_DIR`.
+    max_age : int, optional
+        Age in seconds after which an unused entry is evicted (default 30
+        days)
+    max_size : int, optional
+        Total size in bytes above which the least recently used entries are
+        evicted (default 256 MB)
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> cache = SolveCache()
+        >>> solver = get_conda_solver('base_environment.yml')
+        >>> records = cache.solve(solver)  # slow the first time
+        >>> records = cache.solve(solver)  # read from disk
+    '''
+
+    def __init__(self, cache_dir=None, max_age=None, max_size=None):
+        if cache_dir is None:
+            cache_dir = os.path.join(CACHE_DIR, 'solves')
+
+        self.cache_dir = cache_dir
+        self.max_age = (
+            max_age if max_age is not None else SOLVE_CACHE_MAX_AGE)
+        self.max_size = (
+            max_size if max_size is not None else SOLVE_CACHE_MAX_SIZE)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, '{}.json'.format(key))
+
+    def get(self, key):
+        '''
+        Return the cached PackageRecord list for ``key``, or ``None``
+        '''
+        path = self._path(key)
+
+        try:
+            with open(path, 'r') as f:
+                dumped = json.load(f)
+        except (OSError, IOError, ValueError):
+            return None
+
+        os.utime(path, None)
+
+        return tuple(PackageRecord(**r) for r in dumped['records'])
+
+    def put(self, key, records):
+        '''
+        Store a solution and evict stale entries
+        '''
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        path = self._path(key)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+
+        with open(tmp, 'w') as f:
+            json.dump(
+                {'key': key, 'records': [dict(r.dump()) for r in records]}, f)
+
+        os.replace(tmp, path)
+
+        self.evict()
+
+    def evict(self):
+        '''
+        Remove entries older than ``max_age``, then LRU entries over ``max_size``
+
+        Temporary files being written by :py:meth:`put` in other processes
+        are left alone, unless they are older than a day and so were left
+        behind by a process which died.
+        '''
+        if not os.path.isdir(self.cache_dir):
+            return
+
+        now = time.time()
+        entries = []
+
+        def _remove(path):
+            # another process may have evicted it already
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        for fname in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, fname)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            if fname.endswith('.tmp'):
+                if now - stat.st_mtime > SOLVE_CACHE_TMP_MAX_AGE:
+                    _remove(path)
+            elif now - stat.st_mtime > self.max_age:
+                _remove(path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            _remove(path)
+            total -= size
+
+    def solve(self, solver, repodata_snapshot=None):
+        '''
+        Return the solved state of ``solver``, solving only on a cache miss
+
+        The key is computed from the repodata cache before solving, and the
+        solve may fetch or refresh repodata. Solutions are stored under the
+        key computed after the solve as well, so that the next run, which
+        sees the refreshed repodata, finds them.
+        '''
+        key = get_solver_cache_key(solver, repodata_snapshot)
+
+        records = self.get(key)
+        if records is None:
+            records = tuple(solver.solve_final_state())
+            self.put(key, records)
+
+            if repodata_snapshot is None:
+                refreshed = get_solver_cache_key(solver)
+                if refreshed != key:
+                    self.put(refreshed, records)
+
+        return records
+
+
+def _get_solver_args(solver):
+    '''
+    Reduce a solver to picklable keyword arguments for :py:class:`Solver`
+    '''
+    return {
+        'prefix': solver.prefix,
+        'channels': [Channel(c).canonical_name for c in solver.channels],
+        'subdirs': list(solver.subdirs),
+        'specs_to_add': [str(s) for s in solver.specs_to_add],
+        'specs_to_remove': [str(s) for s in solver.specs_to_remove]}
+
+
+def _solve_from_args(solver_args):
+    solver = Solver(**solver_args)
+    return [dict(r.dump()) for r in solver.solve_final_state()]
+
+
+def _preload_repodata(solver_args):
+    '''
+    Load repodata for every channel/subdir used by a set of solvers
+
+    :py:class:`~conda.core.subdir_data.SubdirData` keeps loaded repodata in a
+    class-level cache, so loading it once in the parent process lets forked
+    solver processes share it rather than each parsing it again.
+    '''
+    urls = set()
+    for args in solver_args:
+        for channel in args['channels']:
+            urls.update(Channel(channel).urls(
+                with_credentials=False, subdirs=args['subdirs'] or None))
+
+    for url in sorted(urls):
+        SubdirData(Channel(url)).load()
+
+
+def solve_all(solvers, max_workers=None, cache=None):
+    '''
+    Solve a nested dictionary of solvers concurrently in a process pool
+
+    Parameters
+    ----------
+    solvers : dict
+        Nested dictionary of ``{image: {env: solver}}``, e.g. as produced by
+        calling :py:func:`build_final_envs_for_multiple_docker_files` for each
+        image.
+    max_workers : int, optional
+        Maximum number of solver processes. Default is the number of CPUs.
+    cache : SolveCache, optional
+        Cache to read solutions from and write new solutions to. Only cache
+        misses are solved.
+
+    Returns
+    -------
+    solutions : dict
+        Nested dictionary of ``{image: {env: records}}``, where ``records`` is
+        the tuple of :py:class:`~conda.models.records.PackageRecord` objects
+        returned by :py:meth:`~conda.core.solve.Solver.solve_final_state`.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> solvers = {
+        ...     'notebook': build_final_envs_for_multiple_docker_files(
+        ...         ['notebook/Dockerfile']),
+        ...     'worker': build_final_envs_for_multiple_docker_files(
+        ...         ['worker/Dockerfile'])}
+        ...
+        >>> solutions = solve_all(solvers, cache=SolveCache())
+        >>> sorted(solutions['worker'].keys())
+        ['base']
+
+    '''
+
+    solutions = {img: {} for img in solvers}
+
+    # identical solves (by cache key) are only run once
+    jobs = {}
+
+    for img, envs in solvers.items():
+        for env, solver in envs.items():
+            key = get_solver_cache_key(solver)
+
+            records = cache.get(key) if cache is not None else None
+            if records is not None:
+                solutions[img][env] = records
+                continue
+
+            if key not in jobs:
+                jobs[key] = (solver, _get_solver_args(solver), [])
+            jobs[key][2].append((img, env))
+
+    if not jobs:
+        return solutions
+
+    _preload_repodata([args for _, args, _ in jobs.values()])
+
+    # loading may have fetched or refreshed repodata, so also store
+    # solutions under the keys the next run will compute
+    refreshed = {}
+    if cache is not None:
+        for key, (solver, _, _) in jobs.items():
+            refreshed[key] = get_solver_cache_key(solver)
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context('fork')
+    else:
+        mp_context = None
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=mp_context) as pool:
+
+        futures = {
+            pool.submit(_solve_from_args, args): key
+            for key, (_, args, _) in jobs.items()}
+
+        for future in concurrent.futures.as_completed(futures):
+            key = futures[future]
+            records = tuple(PackageRecord(**r) for r in future.result())
+
+            if cache is not None:
+                cache.put(key, records)
+                if refreshed[key] != key:
+                    cache.put(refreshed[key], records)
+
+            for img, env in jobs[key][2]:
+                solutions[img][env] = records
+
+    return solutions
+
+
+def get_manifest_hash(manifest):
+    '''
+    Hash a dependency manifest from :py:func:`get_conda_specs`
+    '''
+    return hashlib.sha256(
+        json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+
+
+class ManifestStore(object):
+    '''
+    Solutions from the last successful solve of each image, by manifest
+
+    Used to skip solving images whose Dockerfiles and environment files are
+    unchanged since the last run. Unlike :py:class:`SolveCache`, entries are
+    not invalidated by repodata updates, so a change to one image's inputs
+    only re-solves that image.
+
+    Parameters
+    ----------
+    store_dir : str, optional
+        Directory in which to store solutions. Default is ``manifests`` in
+        :py:data:`CACHE_DIR`.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> store = ManifestStore()
+        >>> manifest = {}
+        >>> solvers = build_final_envs_for_multiple_docker_files(
+        ...     ['worker/Dockerfile'], manifest=manifest)
+        ...
+        >>> solutions = store.get('worker', manifest)
+        >>> if solutions is None:
+        ...     solutions = solve_all({'worker': solvers})['worker']
+        ...     store.put('worker', manifest, solutions)
+    '''
+
+    def __init__(self, store_dir=None):
+        if store_dir is None:
+            store_dir = os.path.join(CACHE_DIR, 'manifests')
+
+        self.store_dir = store_dir
+
+    def _path(self, image):
+        return os.path.join(self.store_dir, '{}.json'.format(image))
+
+    def get(self, image, manifest):
+        '''
+        Return ``{env: records}`` if ``manifest`` matches the last solve
+        '''
+        try:
+            with open(self._path(image), 'r') as f:
+                stored = json.load(f)
+        except (OSError, IOError, ValueError):
+            return None
+
+        if stored['manifest_hash'] != get_manifest_hash(manifest):
+            return None
+
+        return {
+            env: tuple(PackageRecord(**r) for r in records)
+            for env, records in stored['records'].items()}
+
+    def put(self, image, manifest, solutions):
+        '''
+        Record the manifest and ``{env: records}`` solutions for an image
+        '''
+        if not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+
+        path = self._path(image)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+
+        with open(tmp, 'w') as f:
+            json.dump({
+                'manifest_hash': get_manifest_hash(manifest),
+                'manifest': manifest,
+                'records': {
+                    env: [dict(r.dump()) for r in records]
+                    for env, records in solutions.items()}},
+                f)
+
+        os.replace(tmp, path)
+
+
+Mismatch = collections.namedtuple(
+    'Mismatch',
+    ['package', 'base', 'base_version', 'base_build',
+     'paired', 'paired_version', 'paired_build', 'kind'])
+Mismatch.__doc__ = '''
+Row of the mismatch table returned by :py:func:`align_environments`
+
+``base`` and ``paired`` are ``image:env`` labels. ``kind`` is ``'version'``
+if the package versions differ under :py:class:`VersionOrder` comparison, or
+``'build'`` if the versions match but the build strings or numbers differ.
+'''
+
+
+def index_solutions(solutions):
+    '''
+    Index solved environments by package name
+
+    Parameters
+    ----------
+    solutions : dict
+        Nested dictionary of ``{image: {env: records}}``, as returned by
+        :py:func:`solve_all`
+
+    Returns
+    -------
+    index : dict
+        Dictionary of ``{package name: {(image, env): record}}``
+    '''
+    index = collections.defaultdict(dict)
+
+    for img, envs in solutions.items():
+        for env, records in envs.items():
+            for record in records:
+                index[record.name][(img, env)] = record
+
+    return dict(index)
+
+
+def _compare_records(base, paired):
+    if VersionOrder(base.version) != VersionOrder(paired.version):
+        return 'version'
+
+    if (base.build, base.build_number) != (paired.build, paired.build_number):
+        return 'build'
+
+    return None
+
+
+def align_environments(solutions, pairings):
+    '''
+    Compare packages across any number of image/env pairings in one pass
+
+    Every solved environment is indexed by package name once, so the cost of
+    the check grows linearly with the number of packages and pairings.
+
+    Parameters
+    ----------
+    solutions : dict
+        Nested dictionary of ``{image: {env: records}}``, as returned by
+        :py:func:`solve_all`
+    pairings : list
+        List of ``(base image, base env, paired image, paired env)`` tuples.
+        Packages present in both environments of a pairing are compared.
+
+    Returns
+    -------
+    mismatches : list
+        List of :py:class:`Mismatch` rows, sorted by package name and pairing
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> mismatches = align_environments(
+        ...     solutions,
+        ...     [('notebook', 'base', 'worker', 'base'),
+        ...      ('notebook', 'base', 'octave-worker', 'base')])
+        ...
+        >>> print(format_mismatch_table(mismatches))  # doctest: +SKIP
+        package  base           base_version  paired       paired_version ...
+        dask     notebook:base  2.8.1         worker:base  2.9.0          ...
+
+    '''
+
+    for img, env, paired_img, paired_env in pairings:
+        for i, e in [(img, env), (paired_img, paired_env)]:
+            if e not in solutions.get(i, {}):
+                raise KeyError('no solution for {}:{}'.format(i, e))
+
+    mismatches = []
+
+    for name, records in sorted(index_solutions(solutions).items()):
+        for img, env, paired_img, paired_env in pairings:
+            base = records.get((img, env))
+            paired = records.get((paired_img, paired_env))
+
+            if base is None or paired is None:
+                continue
+
+            kind = _compare_records(base, paired)
+            if kind is None:
+                continue
+
+            mismatches.append(Mismatch(
+                name,
+                '{}:{}'.format(img, env), base.version, base.build,
+                '{}:{}'.format(paired_img, paired_env),
+                paired.version, paired.build,
+                kind))
+
+    return mismatches
+
+
+def format_mismatch_table(mismatches):
+    '''
+    Render :py:class:`Mismatch` rows as a fixed-width text table
+    '''
+    rows = [Mismatch._fields] + [tuple(m) for m in mismatches]
+    widths = [max(len(str(r[i])) for r in rows) for i in range(len(rows[0]))]
+
+    return '\n'.join(
+        '  '.join(str(v).ljust(w) for v, w in zip(r, widths)).rstrip()
+        for r in rows)
+
+
+def get_image_solvers(images=None, manifests=None):
+    '''
+    Build solvers for the final conda environments of each docker image
+
+    Parameters
+    ----------
+    images : list, optional
+        Image names from :py:data:`DOCKER_IMAGES`. Default is all images.
+    manifests : dict, optional
+        If provided, updated in place with ``{image: manifest}`` dependency
+        manifests (see :py:func:`get_conda_specs`)
+
+    Returns
+    -------
+    solvers : dict
+        Nested dictionary of ``{image: {env: solver}}``, suitable for
+        :py:func:`solve_all`
+    '''
+    if images is None:
+        images = sorted(DOCKER_IMAGES)
+
+    solvers = {}
+
+    for img in images:
+        manifest = None
+        if manifests is not None:
+            manifest = manifests.setdefault(img, {})
+
+        solvers[img] = build_final_envs_for_multiple_docker_files(
+            [os.path.join(REPO_ROOT, fp) for fp in DOCKER_IMAGES[img]],
+            manifest=manifest)
+
+    return solvers
+
+
+def get_lock_platform(records):
+    '''
+    Returns the (non-noarch) platform subdir of a solved environment
+    '''
+    subdirs = set(r.subdir for r in records) - {'noarch'}
+
+    if len(subdirs) > 1:
+        raise ValueError(
+            'environment spans multiple platforms: {}'
+            .format(', '.join(sorted(subdirs))))
+
+    return subdirs.pop() if subdirs else context.subdir
+
+
+def format_explicit_lock(records, platform=None):
+    '''
+    Render a solved environment as an ``@EXPLICIT`` conda spec file
+
+    The file lists the url and md5 of each package, and can be installed
+    with ``conda create --file`` or ``conda install --file`` without running
+    the solver. Pip dependencies are not included.
+
+    Packages are listed in the order given. ``@EXPLICIT`` files are installed
+    in file order, so keep the dependency order of
+    :py:meth:`~conda.core.solve.Solver.solve_final_state`.
+
+    Parameters
+    ----------
+    records : list
+        :py:class:`~conda.models.records.PackageRecord` objects, as returned
+        by :py:meth:`~conda.core.solve.Solver.solve_final_state`
+    platform : str, optional
+        Platform subdir to record in the header. Default is inferred from the
+        records.
+
+    Returns
+    -------
+    lock : str
+    '''
+    if platform is None:
+        platform = get_lock_platform(records)
+
+    lines = [
+        '# This file may be used to create an environment using:',
+        '# $ conda create --name <env> --file <this file>',
+        '# platform: {}'.format(platform),
+        '@EXPLICIT']
+
+    for record in records:
+        if getattr(record, 'md5', None):
+            lines.append('{}#{}'.format(record.url, record.md5))
+        else:
+            lines.append(record.url)
+
+    return '\n'.join(lines) + '\n'
+
+
+def get_lock_path(image, env, platform, root=REPO_ROOT):
+    '''
+    Returns the path of the lock file for an image/env, next to its Dockerfile
+    '''
+    image_dir = os.path.dirname(DOCKER_IMAGES[image][-1])
+
+    return os.path.join(
+        root, image_dir, '{}-{}.lock'.format(env, platform))
+
+
+def write_lock_files(solutions, root=REPO_ROOT):
+    '''
+    Write an explicit lock file for each solved image/env
+
+    Lock files are only rewritten if their contents change.
+
+    Parameters
+    ----------
+    solutions : dict
+        Nested dictionary of ``{image: {env: records}}``, as returned by
+        :py:func:`solve_all`
+    root : str, optional
+        Repository root (default :py:data:`REPO_ROOT`)
+
+    Returns
+    -------
+    paths : dict
+        Nested dictionary of ``{image: {env: lock file path}}``
+    '''
+    paths = {}
+
+    for img, envs in sorted(solutions.items()):
+        paths[img] = {}
+
+        for env, records in sorted(envs.items()):
+            platform = get_lock_platform(records)
+            lock = format_explicit_lock(records, platform)
+            path = get_lock_path(img, env, platform, root=root)
+
+            try:
+                with open(path, 'r') as f:
+                    unchanged = (f.read() == lock)
+            except (OSError, IOError):
+                unchanged = False
+
+            if not unchanged:
+                with open(path, 'w') as f:
+                    f.write(lock)
+
+            paths[img][env] = path
+
+    return paths
+
+
+def get_dependency_closure(records, names):
+    '''
+    Find the names of all packages in a solution required by ``names``
+
+    Parameters
+    ----------
+    records : list
+        Solved :py:class:`~conda.models.records.PackageRecord` objects
+    names : iterable
+        Package names to start from
+
+    Returns
+    -------
+    closure : set
+        Names of ``names`` and their transitive dependencies within
+        ``records``
+    '''
+    by_name = {r.name: r for r in records}
+
+    closure = set()
+    stack = [n for n in names if n in by_name]
+
+    while stack:
+        name = stack.pop()
+        if name in closure:
+            continue
+
+        closure.add(name)
+
+        for dep in by_name[name].depends:
+            dep_name = MatchSpec(dep).name
+            if dep_name in by_name and dep_name not in closure:
+                stack.append(dep_name)
+
+    return closure
+
+
+def get_installed_size(record, pkgs_dirs=None):
+    '''
+    Installed size of a package from its extracted copy in the package cache
+
+    Returns ``None`` if the package has not been downloaded and extracted.
+    '''
+    if pkgs_dirs is None:
+        pkgs_dirs = context.pkgs_dirs
+
+    dist = re.sub(r'(\.tar\.bz2|\.conda)$', '', record.fn)
+
+    for pkgs_dir in pkgs_dirs:
+        paths_json = os.path.join(pkgs_dir, dist, 'info', 'paths.json')
+
+        try:
+            with open(paths_json, 'r') as f:
+                paths = json.load(f).get('paths', [])
+        except (OSError, IOError, ValueError):
+            continue
+
+        return sum(p.get('size_in_bytes', 0) for p in paths)
+
+    return None
+
+
+def _sum_sizes(sizes):
+    if any(s is None for s in sizes):
+        return None
+
+    return sum(sizes)
+
+
+def get_spec_weights(records, specs, pkgs_dirs=None):
+    '''
+    Download and installed size attributable to each requested spec
+
+    Parameters
+    ----------
+    records : list
+        Solved :py:class:`~conda.models.records.PackageRecord` objects
+    specs : iterable
+        Requested top-level specs (strings or MatchSpecs), e.g. the
+        ``specs_to_add`` of the solver which produced ``records``
+    pkgs_dirs : list, optional
+        Package cache directories searched for installed sizes. Default is
+        conda's configured ``pkgs_dirs``.
+
+    Returns
+    -------
+    weights : list
+        One dict per spec, sorted by the size that removing the spec would
+        save. Each dict has the spec ``name``, the ``packages`` in its
+        transitive closure with their total ``download_size`` and
+        ``installed_size``, the ``exclusive`` packages required by no other
+        spec with their sizes (the marginal cost of removing the spec), and
+        the ``shared`` packages. Installed sizes are ``None`` where a package
+        is not in the package cache.
+    '''
+    by_name = {r.name: r for r in records}
+    names = sorted(set(MatchSpec(s).name for s in specs) & set(by_name))
+
+    download = {n: getattr(by_name[n], 'size', None) for n in by_name}
+    installed = {
+        n: get_installed_size(by_name[n], pkgs_dirs=pkgs_dirs)
+        for n in by_name}
+
+    closures = {n: get_dependency_closure(records, [n]) for n in names}
+
+    users = collections.Counter()
+    for closure in closures.values():
+        users.update(closure)
+
+    weights = []
+
+    for name in names:
+        closure = closures[name]
+        exclusive = set(p for p in closure if users[p] == 1)
+
+        weights.append({
+            'name': name,
+            'packages': sorted(closure),
+            'download_size': _sum_sizes([download[p] for p in closure]),
+            'installed_size': _sum_sizes([installed[p] for p in closure]),
+            'exclusive': sorted(exclusive),
+            'exclusive_download_size': _sum_sizes(
+                [download[p] for p in exclusive]),
+            'exclusive_installed_size': _sum_sizes(
+                [installed[p] for p in exclusive]),
+            'shared': sorted(closure - exclusive)})
+
+    return sorted(
+        weights,
+        key=lambda w: (
+            -(w['exclusive_download_size'] or 0),
+            -(w['download_size'] or 0),
+            w['name']))
+
+
+LockedPackage = collections.namedtuple(
+    'LockedPackage', ['name', 'version', 'build', 'url', 'md5'])
+LockedPackage.__doc__ = '''
+Package entry read from an ``@EXPLICIT`` lock file by :py:func:`read_lock_file`
+'''
+
+
+def read_lock_file(path):
+    '''
+    Read the packages listed in an ``@EXPLICIT`` lock file
+
+    Returns
+    -------
+    packages : list
+        :py:class:`LockedPackage` for each url in the file
+    '''
+    packages = []
+
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#') or line.startswith('@'):
+                continue
+
+            url, _, md5 = line.partition('#')
+            dist = re.sub(r'(\.tar\.bz2|\.conda)$', '', url.rsplit('/', 1)[-1])
+            name, version, build = dist.rsplit('-', 2)
+
+            packages.append(LockedPackage(name, version, build, url, md5 or None))
+
+    return packages
+
+
+def get_pinkeep_specs(env_files):
+    '''
+    Read ``# pinkeep: spec`` directives from environment files
+
+    Returns
+    -------
+    specs : dict
+        ``{package name: spec to keep when unpinning}``
+    '''
+    specs = {}
+
+    for env_file in env_files:
+        with open(env_file, 'r') as f:
+            for match in re.finditer(r'#\s*pinkeep:\s*(\S+)', f.read()):
+                spec = match.group(1)
+                specs[MatchSpec(spec).name] = spec
+
+    return specs
+
+
+def unpin_solver(solver, pinkeep=None):
+    '''
+    Copy a solver with each spec reduced to its package name
+
+    Mirrors ``python pin.py unpin``: specs listed in ``pinkeep`` (see
+    :py:func:`get_pinkeep_specs`) are kept as given.
+    '''
+    pinkeep = pinkeep or {}
+
+    specs_to_add = [
+        pinkeep.get(s.name, s.name) for s in solver.specs_to_add]
+
+    return Solver(
+        solver.prefix,
+        channels=solver.channels,
+        subdirs=solver.subdirs,
+        specs_to_add=specs_to_add,
+        specs_to_remove=solver.specs_to_remove)
+
+
+PackageChange = collections.namedtuple(
+    'PackageChange', ['name', 'old', 'new', 'change', 'major'])
+PackageChange.__doc__ = '''
+Row of the changelog returned by :py:func:`diff_solutions`
+
+``old`` and ``new`` are ``version=build`` strings (``None`` for added or
+removed packages). ``change`` is one of ``'upgrade'``, ``'downgrade'``,
+``'build'``, ``'add'`` or ``'remove'``, and ``major`` is True if the first
+component of the version changed.
+'''
+
+CHANGE_TYPES = ['upgrade', 'downgrade', 'build', 'add', 'remove']
+
+
+def _major_version(version):
+    return re.split(r'[.\-_+]', version)[0]
+
+
+def diff_solutions(old, new):
+    '''
+    Compare two solved environments
+
+    Parameters
+    ----------
+    old, new : list
+        Package records (anything with ``name``, ``version`` and ``build``
+        attributes, e.g. :py:class:`~conda.models.records.PackageRecord` or
+        :py:class:`LockedPackage`)
+
+    Returns
+    -------
+    changes : list
+        :py:class:`PackageChange` rows sorted by change type and name
+    '''
+    old = {p.name: p for p in old}
+    new = {p.name: p for p in new}
+
+    changes = []
+
+    for name in sorted(set(old) | set(new)):
+        before = old.get(name)
+        after = new.get(name)
+
+        label_before = (
+            '{}={}'.format(before.version, before.build) if before else None)
+        label_after = (
+            '{}={}'.format(after.version, after.build) if after else None)
+
+        if before is None:
+            changes.append(PackageChange(
+                name, None, label_after, 'add', False))
+            continue
+
+        if after is None:
+            changes.append(PackageChange(
+                name, label_before, None, 'remove', False))
+            continue
+
+        old_version = VersionOrder(before.version)
+        new_version = VersionOrder(after.version)
+
+        if old_version == new_version:
+            if before.build != after.build:
+                changes.append(PackageChange(
+                    name, label_before, label_after, 'build', False))
+            continue
+
+        changes.append(PackageChange(
+            name,
+            label_before,
+            label_after,
+            'upgrade' if new_version > old_version else 'downgrade',
+            _major_version(before.version) != _major_version(after.version)))
+
+    return sorted(changes, key=lambda c: (CHANGE_TYPES.index(c.change), c.name))
+
+
+def diff_unpinned_solutions(images=None, cache=None, max_workers=None):
+    '''
+    Compare the pinned environments of each image with a fresh unpinned solve
+
+    The pinned state of each image/env is read from its lock file (see
+    :py:func:`write_lock_files`) if one exists, or else solved from the
+    pinned environment files. The fresh state is solved from the same specs
+    with all pins removed except ``# pinkeep:`` directives.
+
+    Parameters
+    ----------
+    images : list, optional
+        Image names from :py:data:`DOCKER_IMAGES`. Default is all images.
+    cache : SolveCache, optional
+        Cache for both the pinned and unpinned solves
+    max_workers : int, optional
+        Maximum number of solver processes (see :py:func:`solve_all`)
+
+    Returns
+    -------
+    changes : dict
+        Nested dictionary of ``{image: {env: [PackageChange, ...]}}``
+    '''
+    manifests = {}
+    pinned_solvers = get_image_solvers(images, manifests=manifests)
+
+    baseline = {}
+    to_solve = {}
+
+    for img, envs in pinned_solvers.items():
+        baseline[img] = {}
+
+        for env, solver in envs.items():
+            env_files = [
+                f for f in manifests[img].get(env, {})
+                if not os.path.basename(f).startswith('Dockerfile')]
+
+            to_solve.setdefault('unpinned:' + img, {})[env] = unpin_solver(
+                solver, get_pinkeep_specs(env_files))
+
+            lock_paths = [
+                get_lock_path(img, env, subdir)
+                for subdir in solver.subdirs if subdir != 'noarch']
+            lock_paths = [p for p in lock_paths if os.path.isfile(p)]
+
+            if lock_paths:
+                baseline[img][env] = read_lock_file(lock_paths[0])
+            else:
+                to_solve.setdefault('pinned:' + img, {})[env] = solver
+
+    solutions = solve_all(to_solve, max_workers=max_workers, cache=cache)
+
+    changes = {}
+
+    for img, envs in pinned_solvers.items():
+        changes[img] = {}
+
+        for env in envs:
+            old = baseline[img].get(env)
+            if old is None:
+                old = solutions['pinned:' + img][env]
+
+            changes[img][env] = diff_solutions(
+                old, solutions['unpinned:' + img][env])
+
+    return changes
+
+
+def format_changelog(changes):
+    '''
+    Render :py:func:`diff_solutions` output as a categorized changelog
+    '''
+    headings = [
+        ('Major version upgrades', lambda c: c.change == 'upgrade' and c.major),
+        ('Upgrades', lambda c: c.change == 'upgrade' and not c.major),
+        ('Major version downgrades',
+            lambda c: c.change == 'downgrade' and c.major),
+        ('Downgrades', lambda c: c.change == 'downgrade' and not c.major),
+        ('Build changes', lambda c: c.change == 'build'),
+        ('Added', lambda c: c.change == 'add'),
+        ('Removed', lambda c: c.change == 'remove')]
+
+    sections = []
+
+    for heading, selector in headings:
+        rows = [c for c in changes if selector(c)]
+        if not rows:
+            continue
+
+        lines = ['{} ({})'.format(heading, len(rows))]
+        for c in rows:
+            lines.append('  {}: {} -> {}'.format(
+                c.name, c.old or '(none)', c.new or '(none)'))
+
+        sections.append('\n'.join(lines))
+
+    if not sections:
+        return 'no changes'
+
+    return '\n\n'.join(sections)
+
+
+def get_pairing_groups(pairings):
+    '''
+    Group image/env pairs which are directly or transitively paired
+
+    Parameters
+    ----------
+    pairings : list
+        List of ``(image, env, paired image, paired env)`` tuples
+
+    Returns
+    -------
+    groups : list
+        List of sorted lists of ``(image, env)`` tuples
+    '''
+    groups = []
+
+    for img, env, paired_img, paired_env in pairings:
+        pair = {(img, env), (paired_img, paired_env)}
+        connected = [g for g in groups if g & pair]
+
+        for g in connected:
+            groups.remove(g)
+            pair |= g
+
+        groups.append(pair)
+
+    return sorted(sorted(g) for g in groups)
+
+
+def co_solve(solvers, pairings, max_workers=None, cache=None):
+    '''
+    Solve paired environments jointly so their shared packages are identical
+
+    For each group of paired environments (see :py:func:`get_pairing_groups`),
+    the union of their specs is solved once. Each environment is then solved
+    from its own specs with every package it shares with another environment
+    in the group locked to the exact version and build from the union
+    solution. Environments which aren't paired are solved as usual.
+
+    Parameters
+    ----------
+    solvers : dict
+        Nested dictionary of ``{image: {env: solver}}``
+    pairings : list
+        List of ``(image, env, paired image, paired env)`` tuples, e.g.
+        :py:data:`ENV_PAIRINGS`
+    max_workers : int, optional
+        Maximum number of solver processes (see :py:func:`solve_all`)
+    cache : SolveCache, optional
+        Cache for all solves
+
+    Returns
+    -------
+    solutions : dict
+        Nested dictionary of ``{image: {env: records}}``, as returned by
+        :py:func:`solve_all`
+
+    Raises
+    ------
+    conda.exceptions.UnsatisfiableError
+        If the paired environments cannot be aligned
+    '''
+    groups = [
+        [(img, env) for img, env in group if env in solvers.get(img, {})]
+        for group in get_pairing_groups(pairings)]
+    groups = [g for g in groups if len(g) > 1]
+
+    union_solvers = {}
+
+    for i, group in enumerate(groups):
+        members = [solvers[img][env] for img, env in group]
+
+        channels = []
+        for solver in members:
+            for channel in solver.channels:
+                if channel not in channels:
+                    channels.append(channel)
+
+        union_solvers['group{}'.format(i)] = {'union': Solver(
+            members[0].prefix,
+            channels=channels,
+            subdirs=members[0].subdirs,
+            specs_to_add=set().union(*[s.specs_to_add for s in members]))}
+
+    union_solutions = solve_all(
+        union_solvers, max_workers=max_workers, cache=cache)
+
+    locked = {img: dict(envs) for img, envs in solvers.items()}
+
+    for i, group in enumerate(groups):
+        records = union_solutions['group{}'.format(i)]['union']
+        by_name = {r.name: r for r in records}
+
+        closures = {
+            (img, env): get_dependency_closure(
+                records, [s.name for s in solvers[img][env].specs_to_add])
+            for img, env in group}
+
+        for member in group:
+            others = set().union(
+                *[closures[m] for m in group if m != member])
+            shared = closures[member] & others
+
+            solver = solvers[member[0]][member[1]]
+            locked[member[0]][member[1]] = Solver(
+                solver.prefix,
+                channels=solver.channels,
+                subdirs=solver.subdirs,
+                specs_to_add=(
+                    [s for s in solver.specs_to_add if s.name not in shared]
+                    + ['{}=={}={}'.format(
+                        n, by_name[n].version, by_name[n].build)
+                       for n in sorted(shared)]),
+                specs_to_remove=solver.specs_to_remove)
+
+    return solve_all(locked, max_workers=max_workers, cache=cache)
+
+
+def get_env_file_solutions(manifests, solutions):
+    '''
+    Map each environment file to the solution of an environment it feeds
+
+    Where a file (e.g. ``base_environment.yml``) feeds several environments,
+    the first image/env in sorted order is used. Use with
+    :py:func:`co_solve` solutions so the choice doesn't matter for packages
+    shared between paired environments.
+
+    Parameters
+    ----------
+    manifests : dict
+        ``{image: manifest}`` dependency manifests, as filled in by
+        :py:func:`get_image_solvers`
+    solutions : dict
+        Nested dictionary of ``{image: {env: records}}``
+
+    Returns
+    -------
+    env_file_solutions : dict
+        ``{absolute env file path: records}``
+    '''
+    env_file_solutions = {}
+
+    for img in sorted(manifests):
+        for env in sorted(manifests[img]):
+            if env not in solutions.get(img, {}):
+                continue
+
+            for filepath in sorted(manifests[img][env]):
+                if os.path.basename(filepath).startswith('Dockerfile'):
+                    continue
+
+                env_file_solutions.setdefault(
+                    os.path.abspath(filepath), solutions[img][env])
+
+    return env_file_solutions
+
+
+PipRecord = collections.namedtuple(
+    'PipRecord',
+    ['name', 'version', 'build', 'build_number', 'requires_dist', 'filename'])
+PipRecord.__doc__ = '''
+A pip package resolved by :py:func:`resolve_pip`
+
+``name`` is the normalized distribution name (see :py:func:`normalize_pip_name`)
+and ``requires_dist`` the ``Requires-Dist`` entries of the wheel's metadata.
+``build`` is always ``'pip'`` and ``build_number`` 0, so pip records can be
+compared with conda records by :py:func:`align_environments`: a package
+installed with pip in one environment and conda in another is reported as a
+``'build'`` mismatch.
+'''
+
+
+def normalize_pip_name(name):
+    '''
+    Normalize a distribution name as in PEP 503, e.g. ``rhg_compute_tools``
+    to ``rhg-compute-tools``
+    '''
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def _read_wheel_metadata(path):
+    '''
+    Read the name, version and requirements from a wheel or metadata file
+
+    ``.metadata`` files hold the contents of a wheel's ``METADATA`` file, as
+    served alongside wheels by PEP 658 indexes.
+    '''
+    if path.endswith('.whl'):
+        with zipfile.ZipFile(path) as whl:
+            members = [
+                m for m in whl.namelist()
+                if re.match(r'^[^/]+\.dist-info/METADATA$', m)]
+
+            if len(members) != 1:
+                raise ValueError('no METADATA file in {}'.format(path))
+
+            text = whl.read(members[0]).decode('utf-8')
+    else:
+        with open(path, 'r') as f:
+            text = f.read()
+
+    metadata = email.parser.Parser().parsestr(text, headersonly=True)
+
+    if metadata['Name'] is None or metadata['Version'] is None:
+        raise ValueError('no name or version in {}'.format(path))
+
+    return {
+        'name': metadata['Name'],
+        'version': metadata['Version'],
+        'requires_dist': metadata.get_all('Requires-Dist') or [],
+        'requires_python': metadata['Requires-Python']}
+
+
+class WheelIndex(object):
+    '''
+    Persistent index of wheel metadata, for resolving pip packages offline
+
+    Maps each wheel (or ``.metadata`` file) in a set of local directories to
+    its distribution name, version and ``Requires-Dist`` requirements. The
+    index is stored as a single json file, and :py:meth:`update` only reads
+    wheels which are new or changed (by size and mtime) since the last update.
+
+    Parameters
+    ----------
+    path : str, optional
+        Index file. Default is ``wheel_index.json`` in :py:data:`CACHE_DIR`.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> index = WheelIndex()
+        >>> index.update(WHEEL_DIRS)  # only reads new wheels
+        3
+        >>> [r.version for r in index.candidates('rhg_compute_tools')]
+        ['0.2.2', '0.2.1']
+    '''
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(CACHE_DIR, 'wheel_index.json')
+
+        self.path = path
+        self.wheels = self._load()
+        self._by_name = None
+
+    def __len__(self):
+        return len(self.wheels)
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)['wheels']
+        except (OSError, IOError, ValueError, KeyError):
+            return {}
+
+    def save(self):
+        '''
+        Write the index to :py:attr:`path`
+        '''
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+
+        with open(tmp, 'w') as f:
+            json.dump({'wheels': self.wheels}, f, sort_keys=True)
+
+        os.replace(tmp, self.path)
+
+    def update(self, wheel_dirs=None):
+        '''
+        Index new and changed wheels in ``wheel_dirs``, and drop removed ones
+
+        Parameters
+        ----------
+        wheel_dirs : list, optional
+            Directories of ``.whl`` and ``.metadata`` files. Default is
+            :py:data:`WHEEL_DIRS`. Directories which don't exist are skipped.
+
+        Returns
+        -------
+        changed : int
+            Number of wheels read
+        '''
+        if wheel_dirs is None:
+            wheel_dirs = WHEEL_DIRS
+
+        changed = 0
+        wheels = dict(self.wheels)
+
+        for wheel_dir in wheel_dirs:
+            wheel_dir = os.path.abspath(wheel_dir)
+            if not os.path.isdir(wheel_dir):
+                continue
+
+            found = set()
+
+            for fname in sorted(os.listdir(wheel_dir)):
+                if not fname.endswith(('.whl', '.metadata')):
+                    continue
+
+                path = os.path.join(wheel_dir, fname)
+                stat = os.stat(path)
+                stamp = [stat.st_size, stat.st_mtime]
+                found.add(path)
+
+                if path in wheels and wheels[path]['stamp'] == stamp:
+                    continue
+
+                try:
+                    entry = _read_wheel_metadata(path)
+                except (zipfile.BadZipFile, UnicodeDecodeError, ValueError):
+                    wheels.pop(path, None)
+                    continue
+
+                entry['stamp'] = stamp
+                wheels[path] = entry
+                changed += 1
+
+            for path in list(wheels):
+                if os.path.dirname(path) == wheel_dir and path not in found:
+                    del wheels[path]
+
+        if wheels != self.wheels:
+            self.wheels = wheels
+            self._by_name = None
+            self.save()
+
+        return changed
+
+    def candidates(self, name):
+        '''
+        Return the indexed versions of a package as PipRecords, newest first
+        '''
+        if self._by_name is None:
+            by_name = collections.defaultdict(dict)
+
+            for path, entry in sorted(self.wheels.items()):
+                try:
+                    version = Version(entry['version'])
+                except InvalidVersion:
+                    continue
+
+                by_name[normalize_pip_name(entry['name'])].setdefault(
+                    version, PipRecord(
+                        normalize_pip_name(entry['name']),
+                        entry['version'],
+                        'pip',
+                        0,
+                        tuple(entry['requires_dist']),
+                        os.path.basename(path)))
+
+            self._by_name = {
+                n: [versions[v] for v in sorted(versions, reverse=True)]
+                for n, versions in by_name.items()}
+
+        return list(self._by_name.get(normalize_pip_name(name), []))
+
+
+def get_marker_environment(python_version):
+    '''
+    Environment marker values for a linux/x86_64 CPython image
+    '''
+    return {
+        'implementation_name': 'cpython',
+        'os_name': 'posix',
+        'platform_machine': 'x86_64',
+        'platform_python_implementation': 'CPython',
+        'platform_system': 'Linux',
+        'python_full_version': python_version,
+        'python_version': '.'.join(python_version.split('.')[:2]),
+        'sys_platform': 'linux'}
+
+
+def _is_satisfied(specifier, version):
+    try:
+        return specifier.contains(version, prereleases=True)
+    except InvalidVersion:
+        # conda versions which aren't PEP 440 can't be checked
+        return True
+
+
+def resolve_pip(specs, index, installed=None, python_version='3.7'):
+    '''
+    Resolve pip requirements against a :py:class:`WheelIndex`, offline
+
+    Each package gets the newest indexed version allowed by every requirement
+    on it found so far, and is re-resolved if a requirement found later
+    excludes that version. The requirements of a replaced version are
+    dropped, along with packages required only through them. Requirements
+    whose environment markers don't apply to the image's python, and
+    malformed ``Requires-Dist`` entries, are skipped. Requirements on packages
+    installed by conda are left to conda if the installed version satisfies
+    them, as pip does. This is not a backtracking resolver: a conflict is
+    reported rather than worked around by trying older versions of the
+    packages involved.
+
+    Parameters
+    ----------
+    specs : list
+        pip requirement strings, e.g. the ``pip:`` section of an environment
+        file. Direct URL and VCS requirements can't be resolved from the
+        index and are skipped.
+    index : WheelIndex
+    installed : dict, optional
+        ``{name: version}`` of the conda packages in the environment
+    python_version : str, optional
+        Python version used to evaluate environment markers
+
+    Returns
+    -------
+    records : tuple
+        :py:class:`PipRecord` for each package pip would install, sorted by
+        name
+
+    Raises
+    ------
+    ValueError
+        If no indexed version of a package satisfies all requirements on it,
+        or a requirement excludes the version of a package installed by conda
+    '''
+    installed = {
+        normalize_pip_name(CONDA_PIP_NAMES.get(n, n)): v
+        for n, v in (installed or {}).items()}
+
+    marker_env = get_marker_environment(python_version)
+
+    # requirements on each package, with the record (or None, for the
+    # environment) which requires it
+    requirements = collections.defaultdict(list)
+    chosen = {}
+    chosen_extras = {}
+
+    def _drop(record):
+        # forget the requirements of a replaced record, and any packages
+        # which were only required through it
+        orphaned = []
+
+        for name in list(requirements):
+            requirements[name] = [
+                (r, p) for r, p in requirements[name] if p != record]
+
+            if not requirements[name] and name in chosen:
+                orphaned.append(chosen.pop(name))
+
+        for orphan in orphaned:
+            _drop(orphan)
+
+    def _label(parent):
+        if parent is None:
+            return 'environment'
+        return '{} {}'.format(parent.name, parent.version)
+
+    queue = collections.deque()
+    for spec in specs:
+        try:
+            req = Requirement(spec)
+        except InvalidRequirement:
+            continue
+
+        if req.marker is None or req.marker.evaluate(marker_env):
+            queue.append((req, None))
+
+    while queue:
+        req, parent = queue.popleft()
+
+        # queued by a record which has since been replaced
+        if parent is not None and chosen.get(parent.name) != parent:
+            continue
+
+        if req.url is not None:
+            continue
+
+        name = normalize_pip_name(req.name)
+        requirements[name].append((req, parent))
+
+        specifier = SpecifierSet()
+        extras = set()
+        for r, _ in requirements[name]:
+            specifier &= r.specifier
+            extras |= set(r.extras)
+
+        if name in installed:
+            if not _is_satisfied(specifier, installed[name]):
+                raise ValueError(
+                    '{} requires {}{}, but conda installs {} {}'.format(
+                        _label(parent), name, req.specifier,
+                        name, installed[name]))
+            continue
+
+        current = chosen.get(name)
+        if (current is not None
+                and _is_satisfied(specifier, current.version)
+                and extras <= chosen_extras[name]):
+            continue
+
+        candidates = index.candidates(name)
+        allowed = set(specifier.filter([c.version for c in candidates]))
+        candidate = next(
+            (c for c in candidates if c.version in allowed), None)
+
+        if candidate is None:
+            raise ValueError(
+                'no indexed wheel of {} satisfies {} (required by {})'.format(
+                    name,
+                    ', '.join(
+                        str(r.specifier) or 'any version'
+                        for r, _ in requirements[name]),
+                    ', '.join(sorted(set(
+                        _label(p) for _, p in requirements[name])))))
+
+        if current is not None and current != candidate:
+            del chosen[name]
+            _drop(current)
+
+        chosen[name] = candidate
+        chosen_extras[name] = extras
+
+        for dep in candidate.requires_dist:
+            try:
+                dep_req = Requirement(dep)
+            except InvalidRequirement:
+                continue
+
+            if dep_req.marker is not None and not any(
+                    dep_req.marker.evaluate(dict(marker_env, extra=extra))
+                    for extra in [''] + sorted(extras)):
+                continue
+
+            queue.append((dep_req, candidate))
+
+    return tuple(chosen[name] for name in sorted(chosen))
+
+
+def get_pip_specs(manifest):
+    '''
+    Get the pip requirements of each environment in a dependency manifest
+
+    Parameters
+    ----------
+    manifest : dict
+        ``{env: {filepath: sha256}}`` dependency manifest, as filled in by
+        :py:func:`get_conda_specs`
+
+    Returns
+    -------
+    pip_specs : dict
+        ``{env: [requirement]}`` for environments with pip requirements
+    '''
+    pip_specs = {}
+
+    for env, files in manifest.items():
+        for filepath in sorted(files):
+            if os.path.basename(filepath).startswith('Dockerfile'):
+                continue
+
+            for dep in load_env_file(filepath).get('dependencies', []):
+                if isinstance(dep, dict):
+                    pip_specs.setdefault(env, []).extend(dep.get('pip', []))
+
+    return pip_specs
+
+
+def solve_pip(manifests, solutions, index=None):
+    '''
+    Resolve the pip requirements of every image environment, offline
+
+    Parameters
+    ----------
+    manifests : dict
+        ``{image: manifest}`` dependency manifests, as filled in by
+        :py:func:`get_image_solvers`
+    solutions : dict
+        Nested dictionary of ``{image: {env: records}}`` conda solutions
+    index : WheelIndex, optional
+        Wheel metadata to resolve against. Default is a :py:class:`WheelIndex`
+        updated from :py:data:`WHEEL_DIRS`.
+
+    Returns
+    -------
+    pip_solutions : dict
+        Nested dictionary of ``{image: {env: pip records}}`` (see
+        :py:func:`resolve_pip`)
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> manifests = {}
+        >>> solutions = co_solve(
+        ...     get_image_solvers(manifests=manifests), ENV_PAIRINGS)
+        ...
+        >>> pip_solutions = solve_pip(manifests, solutions)
+        >>> mismatches = align_environments(
+        ...     merge_pip_solutions(solutions, pip_solutions), ENV_PAIRINGS)
+    '''
+    if index is None:
+        index = WheelIndex()
+        index.update()
+
+    pip_solutions = {}
+
+    for img in sorted(manifests):
+        for env, specs in sorted(get_pip_specs(manifests[img]).items()):
+            records = solutions.get(img, {}).get(env)
+            if records is None:
+                continue
+
+            python = [r.version for r in records if r.name == 'python']
+
+            pip_solutions.setdefault(img, {})[env] = resolve_pip(
+                specs,
+                index,
+                installed={r.name: r.version for r in records},
+                python_version=python[0] if python else '3.7')
+
+    return pip_solutions
+
+
+def merge_pip_solutions(solutions, pip_solutions):
+    '''
+    Add pip records to conda solutions, for :py:func:`align_environments`
+
+    Returns a new nested dictionary of ``{image: {env: records}}``;
+    ``solutions`` is not modified.
+    '''
+    merged = {img: dict(envs) for img, envs in solutions.items()}
+
+    for img, envs in pip_solutions.items():
+        for env, records in envs.items():
+            merged.setdefault(img, {})[env] = (
+                tuple(merged[img].get(env, ())) + tuple(records))
+
+    return merged
+
+
+def _get_dependency_name(dep):
+    return re.split(r'[\s\[=<>!]', dep.split('::')[-1], maxsplit=1)[0]
+
+
+def get_repodata_closure(repodata, names):
+    '''
+    Find the package names reachable from a set of names through ``depends``
+
+    Parameters
+    ----------
+    repodata : list
+        Parsed ``repodata.json`` contents of every channel and subdir the
+        packages may come from. A dependency may be satisfied by a record in
+        a different channel or subdir.
+    names : iterable
+        Package names to start from
+
+    Returns
+    -------
+    closure : set
+        The requested names and the names of every package any version of
+        them could depend on. Names no record provides (e.g. virtual packages
+        such as ``__glibc``) are included.
+    '''
+    depends = collections.defaultdict(set)
+
+    for data in repodata:
+        for key in ('packages', 'packages.conda'):
+            for record in data.get(key, {}).values():
+                depends[record['name']].update(
+                    _get_dependency_name(d) for d in record.get('depends', []))
+
+    for name, implicit in IMPLICIT_DEPENDENCIES.items():
+        depends[name].update(implicit)
+
+    closure = set()
+    queue = collections.deque(names)
+
+    while queue:
+        name = queue.popleft()
+        if name in closure:
+            continue
+
+        closure.add(name)
+        queue.extend(depends.get(name, set()) - closure)
+
+    return closure
+
+
+def get_solver_names(solvers):
+    '''
+    Get the channels, subdirs and requested package names of nested solvers
+
+    Returns
+    -------
+    channels : list
+        Canonical channel names, in order of first appearance
+    subdirs : list
+    names : set
+    '''
+    channels, subdirs, names = [], [], set()
+
+    for envs in solvers.values():
+        for solver in envs.values():
+            for channel in solver.channels:
+                channel = Channel(channel).canonical_name
+                if channel not in channels:
+                    channels.append(channel)
+
+            for subdir in solver.subdirs:
+                if subdir not in subdirs:
+                    subdirs.append(subdir)
+
+            names.update(MatchSpec(s).name for s in solver.specs_to_add)
+
+    return channels, subdirs, names
+
+
+def _load_upstream_repodata(channel, subdir):
+    '''
+    Fetch (if stale) and parse conda's cached repodata for a channel subdir
+    '''
+    url = Channel(channel).urls(with_credentials=False, subdirs=[subdir])[0]
+    subdir_data = SubdirData(Channel(url))
+    subdir_data.load()
+
+    with open(subdir_data.cache_path_json, 'r') as f:
+        data = json.load(f)
+
+    data.setdefault('_url', url)
+
+    return data
+
+
+def _get_repodata_source(data):
+    return {k: data[k] for k in ('_url', '_etag', '_mod') if k in data}
+
+
+class RepodataSnapshot(object):
+    '''
+    Local conda channel holding only the repodata needed to solve our images
+
+    :py:meth:`build` prunes the upstream repodata of each channel and subdir
+    to the records of packages reachable from the requested package names
+    (see :py:func:`get_repodata_closure`), and writes it as a local channel
+    in ``snapshot_dir/<channel>/<subdir>/repodata.json``. Solvers rebuilt
+    against the snapshot by :py:meth:`use` load a small fraction of the
+    upstream repodata and need no network access.
+
+    The snapshot is updated with deltas. A rebuild is skipped unless the
+    upstream repodata (by ``_etag``/``_mod`` header) or the requested names
+    changed, and only subdirs whose pruned records changed are rewritten,
+    including records edited in place by upstream repodata patches. The
+    records added, removed and patched by each update are appended to
+    ``deltas.jsonl`` in the subdir.
+
+    Parameters
+    ----------
+    snapshot_dir : str, optional
+        Default is :py:data:`REPODATA_SNAPSHOT_DIR`, or ``repodata`` in
+        :py:data:`CACHE_DIR`.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> snapshot = RepodataSnapshot()
+        >>> solvers = get_image_solvers()
+        >>> snapshot.build(*get_solver_names(solvers))  # needs network
+        ...
+        >>> solutions = solve_all(snapshot.use(solvers))  # offline
+        >>> records = snapshot.restore(solutions['worker']['base'])
+    '''
+
+    def __init__(self, snapshot_dir=None):
+        if snapshot_dir is None:
+            snapshot_dir = REPODATA_SNAPSHOT_DIR or os.path.join(
+                CACHE_DIR, 'repodata')
+
+        self.snapshot_dir = os.path.abspath(snapshot_dir)
+        self.state = self._load_state()
+
+    @property
+    def _state_path(self):
+        return os.path.join(self.snapshot_dir, 'snapshot.json')
+
+    def _load_state(self):
+        try:
+            with open(self._state_path, 'r') as f:
+                return json.load(f)
+        except (OSError, IOError, ValueError):
+            return {'names': [], 'sources': {}, 'closure_size': 0}
+
+    def _write_json(self, path, data):
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+
+        with open(tmp, 'w') as f:
+            json.dump(data, f, sort_keys=True)
+
+        os.replace(tmp, path)
+
+    def _repodata_path(self, channel, subdir):
+        return os.path.join(
+            self.snapshot_dir, *(channel.split('/') + [subdir, 'repodata.json']))
+
+    def channel_url(self, channel):
+        '''
+        Return the ``file://`` url of a channel in the snapshot
+        '''
+        return 'file://' + '/'.join(
+            [self.snapshot_dir.replace(os.sep, '/')] + channel.split('/'))
+
+    def build(self, channels, subdirs, names, load_repodata=None):
+        '''
+        Create or update the snapshot
+
+        Parameters
+        ----------
+        channels : list
+            Canonical channel names, e.g. ``conda-forge``
+        subdirs : list
+            e.g. ``['linux-64', 'noarch']``
+        names : iterable
+            Requested package names, e.g. from :py:func:`get_solver_names`
+        load_repodata : callable, optional
+            ``load_repodata(channel, subdir)`` returning parsed upstream
+            repodata. Default reads conda's repodata cache, fetching the
+            repodata if it is stale.
+
+        Returns
+        -------
+        deltas : dict
+            ``{channel/subdir: {'added': n, 'removed': n, 'patched': n}}``
+            for each subdir rewritten, where ``patched`` counts records whose
+            metadata (e.g. ``depends``) changed. Empty if the snapshot is up
+            to date.
+        '''
+        if load_repodata is None:
+            load_repodata = _load_upstream_repodata
+
+        names = sorted(set(names))
+
+        sources = collections.OrderedDict()
+        for channel in channels:
+            for subdir in subdirs:
+                sources['{}/{}'.format(channel, subdir)] = load_repodata(
+                    channel, subdir)
+
+        source_state = {
+            key: _get_repodata_source(data) for key, data in sources.items()}
+
+        if (names == self.state['names']
+                and source_state == self.state['sources']
+                and all(os.path.isfile(self._repodata_path(*k.rsplit('/', 1)))
+                        for k in sources)):
+            return {}
+
+        closure = get_repodata_closure(sources.values(), names)
+        deltas = {}
+
+        for key, data in sources.items():
+            channel, subdir = key.rsplit('/', 1)
+            path = self._repodata_path(channel, subdir)
+
+            pruned = {
+                'info': dict(data.get('info', {}), subdir=subdir),
+                'repodata_version': data.get('repodata_version', 1)}
+
+            for k in ('packages', 'packages.conda'):
+                pruned[k] = {
+                    fn: record for fn, record in data.get(k, {}).items()
+                    if record['name'] in closure}
+
+            try:
+                with open(path, 'r') as f:
+                    old = json.load(f)
+            except (OSError, IOError, ValueError):
+                old = {}
+
+            old_records = dict(old.get('packages', {}))
+            old_records.update(old.get('packages.conda', {}))
+            new_records = dict(pruned['packages'])
+            new_records.update(pruned['packages.conda'])
+
+            # repodata patches edit the records of existing files, so
+            # compare contents, not just filenames
+            if old and old_records == new_records:
+                continue
+
+            added = sorted(set(new_records) - set(old_records))
+            removed = sorted(set(old_records) - set(new_records))
+            patched = sorted(
+                fn for fn in set(new_records) & set(old_records)
+                if new_records[fn] != old_records[fn])
+
+            self._write_json(path, pruned)
+
+            with open(os.path.join(os.path.dirname(path), 'deltas.jsonl'),
+                      'a') as f:
+                f.write(json.dumps({
+                    'time': time.time(),
+                    'source': source_state[key],
+                    'added': added,
+                    'removed': removed,
+                    'patched': patched}, sort_keys=True) + '\n')
+
+            deltas[key] = {
+                'added': len(added),
+                'removed': len(removed),
+                'patched': len(patched)}
+
+        self.state = {
+            'names': names,
+            'sources': source_state,
+            'closure_size': len(closure)}
+        self._write_json(self._state_path, self.state)
+
+        return deltas
+
+    def use(self, solvers):
+        '''
+        Rebuild nested ``{image: {env: solver}}`` solvers against the snapshot
+
+        Raises
+        ------
+        ValueError
+            If a solver uses a channel or subdir missing from the snapshot
+        '''
+        snapshot_solvers = {}
+
+        for img, envs in solvers.items():
+            snapshot_solvers[img] = {}
+
+            for env, solver in envs.items():
+                channels = [Channel(c).canonical_name for c in solver.channels]
+
+                for channel in channels:
+                    for subdir in solver.subdirs:
+                        if not os.path.isfile(
+                                self._repodata_path(channel, subdir)):
+                            raise ValueError(
+                                '{}/{} is not in the repodata snapshot at {}; '
+                                'rebuild it with repodata_snapshot.py'.format(
+                                    channel, subdir, self.snapshot_dir))
+
+                snapshot_solvers[img][env] = Solver(
+                    solver.prefix,
+                    channels=[self.channel_url(c) for c in channels],
+                    subdirs=solver.subdirs,
+                    specs_to_add=solver.specs_to_add,
+                    specs_to_remove=solver.specs_to_remove)
+
+        return snapshot_solvers
+
+    def restore(self, records):
+        '''
+        Point records solved against the snapshot back at upstream channels
+
+        Use this before writing lock files from snapshot solutions.
+        '''
+        upstream = {}
+        for key, source in self.state['sources'].items():
+            channel, subdir = key.rsplit('/', 1)
+            upstream['{}/{}'.format(self.channel_url(channel), subdir)] = (
+                channel, source.get('_url'))
+
+        restored = []
+
+        for record in records:
+            prefix = record.url.rsplit('/', 1)[0]
+
+            if prefix not in upstream or upstream[prefix][1] is None:
+                restored.append(record)
+                continue
+
+            channel, url = upstream[prefix]
+            restored.append(PackageRecord(**dict(
+                record.dump(),
+                channel=channel,
+                url='{}/{}'.format(url.rstrip('/'), record.fn))))
+
+        return tuple(restored)
@@ -0,0 +1,115 @@
+'''
+Report which requested packages make the docker images heavy
+
+For each top-level spec requested in an image's environment files, reports
+the download and installed size of its transitive dependency closure, the
+packages it shares with other specs, and the size of the packages required
+only by it, i.e. what removing the spec would save.
+
+Usage
+-----
+
+.. code-block:: bash
+
+    $ python maintenance_utilities/image_weight.py worker
+
+    $ python maintenance_utilities/image_weight.py notebook --env r --json weights.json
+
+By default solves run offline against conda's cached repodata, and solutions
+are read from :py:class:`conda_tools.SolveCache` when available. Installed
+sizes are read from the package cache, and are only reported for packages
+which have been downloaded.
+
+'''
+
+import os
+import sys
+import json
+
+import click
+
+import conda_tools
+
+
+def _format_size(size):
+    if size is None:
+        return '-'
+
+    for unit in ['B', 'KB', 'MB']:
+        if size < 1024:
+            return '{:.0f} {}'.format(size, unit)
+        size /= 1024.0
+
+    return '{:.1f} GB'.format(size)
+
+
+def format_weight_table(weights):
+    '''
+    Render :py:func:`conda_tools.get_spec_weights` output as a ranked table
+    '''
+    rows = [(
+        'rank', 'spec', 'packages', 'download', 'installed', 'exclusive',
+        'exclusive download', 'exclusive installed')]
+
+    for rank, w in enumerate(weights, 1):
+        rows.append((
+            str(rank),
+            w['name'],
+            str(len(w['packages'])),
+            _format_size(w['download_size']),
+            _format_size(w['installed_size']),
+            str(len(w['exclusive'])),
+            _format_size(w['exclusive_download_size']),
+            _format_size(w['exclusive_installed_size'])))
+
+    widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+
+    return '\n'.join(
+        '  '.join(v.ljust(w) for v, w in zip(r, widths)).rstrip()
+        for r in rows)
+
+
+@click.command()
+@click.argument('image', default='worker')
+@click.option('--env', default='base', help='conda environment in the image')
+@click.option(
+    '--json', 'json_path',
+    default=None,
+    help='write the full report as JSON to this path ("-" for stdout)',
+)
+@click.option(
+    '--online',
+    is_flag=True,
+    default=False,
+    help='allow fetching repodata rather than using the local cache',
+)
+def main(image, env, json_path, online):
+    '''Rank the requested packages in an image by size'''
+
+    if not online:
+        os.environ['CONDA_OFFLINE'] = 'true'
+        from conda.base.context import reset_context
+        reset_context()
+
+    solvers = conda_tools.get_image_solvers([image])
+    solver = solvers[image][env]
+
+    records = conda_tools.solve_all(
+        {image: {env: solver}}, cache=conda_tools.SolveCache())[image][env]
+
+    weights = conda_tools.get_spec_weights(records, solver.specs_to_add)
+
+    if json_path == '-':
+        json.dump(weights, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return
+
+    click.echo(format_weight_table(weights))
+
+    if json_path is not None:
+        with open(json_path, 'w') as f:
+            json.dump(weights, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,335 @@
+'''
+Track the import time of each package in the image environments
+
+Reads the packages requested in the environment files, maps each package to
+the top-level modules it installs, and imports each package's modules in a
+fresh ``python -X importtime`` subprocess. The cumulative import time of each
+package (the median over several runs) is recorded under an image tag, and
+compared against a baseline tag.
+
+Usage
+-----
+
+Run this with the python of the image being measured, e.g.
+
+.. code-block:: bash
+
+    $ docker run -v $PWD:/repo rhodium/worker:2020-06-12.01 \
+        python /repo/maintenance_utilities/import_times.py \
+        --tag 2020-06-12.01 --output /repo/import_times.json \
+        /repo/base_environment.yml
+
+The check fails if any package fails to import where it imported in the
+baseline tag, or if any package, or the environment as a whole, imports more
+than 20% slower than in the baseline tag, which defaults to the most recently
+recorded other tag. Packages whose import time changes by less than
+``--min-ms`` are not flagged, to keep small packages' noise out of the check.
+
+'''
+
+import os
+import re
+import sys
+import glob
+import json
+import datetime
+import statistics
+import subprocess
+import concurrent.futures
+
+import click
+
+import conda_tools
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENV_FILES = [
+    os.path.join(REPO_ROOT, 'base_environment.yml'),
+    os.path.join(REPO_ROOT, 'notebook', 'notebook_environment.yml')]
+
+RESULTS_FILE = os.path.join(REPO_ROOT, 'import_times.json')
+
+MODULE_NAMES = {
+    'beautifulsoup4': ['bs4'],
+    'pyyaml': ['yaml'],
+    'scikit-learn': ['sklearn'],
+    'scikit-image': ['skimage'],
+}
+'''
+Modules to import for pip packages whose name differs from their module.
+Modules of conda packages are read from conda-meta.
+'''
+
+_SITE_PACKAGES = re.compile(
+    r'^(?:lib/python[0-9.]+|Lib)/site-packages/([A-Za-z_][A-Za-z0-9_]*)'
+    r'(/__init__\.py|\.py|\.cpython[^/]*\.so|\.so|\.pyd)$')
+
+
+def get_requested_packages(env_files):
+    '''
+    Get the names of the conda and pip packages requested in env files
+    '''
+    names = []
+
+    for env_file in env_files:
+        spec = conda_tools.load_env_file(env_file)
+
+        for dep in spec.get('dependencies', []):
+            if isinstance(dep, dict):
+                names.extend(
+                    re.split(r'[<>=!~\[ ;]', p, maxsplit=1)[0].lower()
+                    for p in dep.get('pip', []))
+            else:
+                names.append(conda_tools.MatchSpec(dep).name)
+
+    return sorted(set(names))
+
+
+def get_package_modules(prefix=sys.prefix):
+    '''
+    Map installed conda packages to their top-level importable modules
+
+    Packages which don't install python modules map to an empty list.
+    '''
+    modules = {}
+
+    for path in glob.glob(os.path.join(prefix, 'conda-meta', '*.json')):
+        try:
+            with open(path, 'r') as f:
+                meta = json.load(f)
+        except (OSError, IOError, ValueError):
+            continue
+
+        found = set()
+        for fname in meta.get('files', []):
+            match = _SITE_PACKAGES.match(fname)
+            if match:
+                found.add(match.group(1))
+
+        modules[meta['name']] = sorted(
+            m for m in found if not m.startswith('_') or len(found) == 1)
+
+    return modules
+
+
+def parse_importtime(stderr):
+    '''
+    Parse ``-X importtime`` output to ``{module: cumulative_us}`` for the
+    modules imported directly, rather than by another module
+    '''
+    times = {}
+
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+
+        _, cumulative, name = line[len('import time:'):].split('|')
+
+        # nested imports are indented under the module which imported them
+        if len(name) - len(name.lstrip(' ')) > 1:
+            continue
+
+        try:
+            times[name.strip()] = int(cumulative)
+        except ValueError:
+            continue
+
+    return times
+
+
+def _get_startup_modules(python):
+    proc = subprocess.run(
+        [python, '-X', 'importtime', '-c', 'pass'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True)
+
+    return set(parse_importtime(proc.stderr))
+
+
+def time_import(modules, python=sys.executable, repeat=3, startup=()):
+    '''
+    Time importing modules in fresh interpreters
+
+    Returns
+    -------
+    result : dict
+        ``cumulative_ms``, the median over ``repeat`` runs of the total
+        cumulative import time of ``modules`` (excluding modules imported at
+        interpreter startup), or ``error`` if the import failed
+    '''
+    totals = []
+
+    for i in range(repeat):
+        proc = subprocess.run(
+            [python, '-X', 'importtime', '-c', 'import ' + ', '.join(modules)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True)
+
+        if proc.returncode != 0:
+            lines = proc.stderr.strip().splitlines()
+
+            return {
+                'modules': modules,
+                'error': lines[-1] if lines else 'exited with {}'.format(
+                    proc.returncode)}
+
+        times = parse_importtime(proc.stderr)
+        totals.append(sum(
+            t for name, t in times.items() if name not in startup))
+
+    return {
+        'modules': modules,
+        'cumulative_ms': statistics.median(totals) / 1000.0}
+
+
+def time_packages(packages, python=sys.executable, repeat=3, jobs=1):
+    '''
+    Time the imports of each package which installs python modules
+    '''
+    package_modules = get_package_modules()
+    startup = _get_startup_modules(python)
+
+    targets = {}
+    for name in packages:
+        if name in package_modules:
+            modules = package_modules[name]
+        else:
+            # pip packages aren't listed in conda-meta
+            modules = MODULE_NAMES.get(name, [name.replace('-', '_')])
+
+        if modules:
+            targets[name] = modules
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            name: executor.submit(
+                time_import, modules, python, repeat, startup)
+            for name, modules in targets.items()}
+
+        return {name: f.result() for name, f in sorted(futures.items())}
+
+
+def check_regressions(results, baseline, threshold=0.2, min_ms=5):
+    '''
+    Find packages which import more than ``threshold`` slower than baseline
+
+    Returns
+    -------
+    regressions : list of tuple
+        ``(package, baseline_ms, ms, change)`` for each regression, including
+        the environment ``'(total)'``
+    '''
+    regressions = []
+    old_total = new_total = 0
+
+    for name, new in sorted(results.items()):
+        old = baseline.get(name, {})
+
+        if 'cumulative_ms' not in new or 'cumulative_ms' not in old:
+            continue
+
+        old_ms, new_ms = old['cumulative_ms'], new['cumulative_ms']
+        old_total += old_ms
+        new_total += new_ms
+
+        if new_ms - old_ms < min_ms or old_ms == 0:
+            continue
+
+        if (new_ms - old_ms) / old_ms > threshold:
+            regressions.append(
+                (name, old_ms, new_ms, (new_ms - old_ms) / old_ms))
+
+    if old_total and (new_total - old_total) / old_total > threshold:
+        regressions.append((
+            '(total)', old_total, new_total,
+            (new_total - old_total) / old_total))
+
+    return regressions
+
+
+def check_errors(results, baseline):
+    '''
+    Find packages which fail to import, unless they also failed in baseline
+
+    Returns
+    -------
+    errors : list of tuple
+        ``(package, error)`` for each new import error
+    '''
+    return [
+        (name, new['error'])
+        for name, new in sorted(results.items())
+        if 'error' in new and 'error' not in baseline.get(name, {})]
+
+
+def _load_results(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, IOError, ValueError):
+        return {}
+
+
+@click.command()
+@click.argument('env_files', nargs=-1)
+@click.option('--tag', required=True, help='image tag to record results under')
+@click.option('--output', default=RESULTS_FILE, help='results JSON file')
+@click.option('--baseline', default=None, help='tag to compare against')
+@click.option('--repeat', default=3, help='imports per package')
+@click.option('--jobs', default=1, help='packages timed concurrently')
+@click.option(
+    '--threshold', default=0.2, help='fractional slowdown which fails')
+@click.option(
+    '--min-ms', default=5.0, help='ignore changes smaller than this')
+def main(env_files, tag, output, baseline, repeat, jobs, threshold, min_ms):
+    '''Record import times under a tag and check them against a baseline'''
+
+    packages = get_requested_packages(env_files or ENV_FILES)
+    results = time_packages(packages, repeat=repeat, jobs=jobs)
+
+    for name, r in results.items():
+        if 'error' in r:
+            click.echo('{:<30} error: {}'.format(name, r['error']))
+        else:
+            click.echo('{:<30} {:>10.1f} ms'.format(name, r['cumulative_ms']))
+
+    all_results = _load_results(output)
+
+    if baseline is None:
+        others = sorted(
+            (r['timestamp'], t) for t, r in all_results.items() if t != tag)
+        baseline = others[-1][1] if others else None
+
+    all_results[tag] = {
+        'timestamp': datetime.datetime.now(
+            datetime.timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'packages': results}
+
+    with open(output, 'w+') as f:
+        json.dump(all_results, f, indent=2, sort_keys=True)
+
+    if baseline is None:
+        return
+
+    regressions = check_regressions(
+        results, all_results[baseline]['packages'], threshold, min_ms)
+
+    errors = check_errors(results, all_results[baseline]['packages'])
+
+    for name, old_ms, new_ms, change in regressions:
+        click.echo('{} imports {:.0%} slower than {}: {:.1f} ms -> {:.1f} ms'.format(
+            name, change, baseline, old_ms, new_ms))
+
+    for name, error in errors:
+        click.echo('{} fails to import, but imported in {}: {}'.format(
+            name, baseline, error))
+
+    if regressions or errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
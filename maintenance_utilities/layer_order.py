@@ -0,0 +1,481 @@
+'''
+Reorder Dockerfile instructions to maximize docker build cache hits
+
+Docker invalidates every layer after the first one whose inputs changed, so
+a frequently-edited file copied in early in a Dockerfile forces the heavy
+conda and apt layers after it to be rebuilt. This tool scores each
+instruction by how often its inputs change (from git history) and by its
+build cost, and moves volatile ``COPY`` instructions as late as they can go
+without changing the result of the build.
+
+Usage
+-----
+
+.. code-block:: bash
+
+    $ python maintenance_utilities/layer_order.py notebook/Dockerfile
+
+    $ python maintenance_utilities/layer_order.py notebook/Dockerfile --write
+
+A ``COPY`` is only moved past instructions which cannot observe the copied
+file: ``RUN`` instructions (and any scripts they execute from the image)
+which don't mention the destination path or a parent directory of it,
+``ENV``/``ARG`` instructions which don't define variables used by the
+``COPY``, and ``COPY`` instructions with non-overlapping destinations. It is
+never moved past ``WORKDIR``, ``FROM``, or trailing metadata such as
+``ENTRYPOINT`` and ``CMD``. Paths used in ``RUN`` commands are detected
+heuristically, so review the proposed diff before committing it.
+
+'''
+
+import os
+import re
+import sys
+import difflib
+import posixpath
+import subprocess
+import collections
+
+import click
+
+import conda_tools
+
+COMMAND_COSTS = {
+    'conda': 10.0,
+    'pip': 5.0,
+    'apt-get': 5.0,
+    'jupyter': 5.0,
+    'bash': 5.0,
+    'sh': 5.0,
+    'wget': 2.0,
+    'curl': 2.0,
+}
+'''
+Relative build cost of RUN commands, by program. Other commands cost 1.
+'''
+
+COPY_COST = 1.0
+
+BARRIER_INSTRUCTIONS = (
+    'FROM', 'WORKDIR', 'ENTRYPOINT', 'CMD', 'ONBUILD', 'SHELL', 'HEALTHCHECK',
+    'STOPSIGNAL', 'EXPOSE', 'VOLUME', 'LABEL')
+'''
+Instructions a COPY is never moved past
+'''
+
+_PATH_PATTERN = re.compile(r'/[\w.\-/*$]+')
+
+LayerScore = collections.namedtuple(
+    'LayerScore', ['lineno', 'instruction', 'volatility', 'cost', 'value'])
+
+
+def get_change_counts(root=conda_tools.REPO_ROOT, max_commits=500):
+    '''
+    Count the commits touching each file in the last ``max_commits`` commits
+
+    Returns
+    -------
+    counts : dict
+        ``{path relative to root: number of commits}``
+    '''
+    try:
+        out = subprocess.check_output(
+            ['git', 'log', '--format=', '--name-only',
+             '-n', str(max_commits)],
+            cwd=root,
+            stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+
+    return collections.Counter(
+        line.strip() for line in out.decode().splitlines() if line.strip())
+
+
+def _command_cost(command):
+    if command[0] == 'sudo':
+        command = command[1:]
+
+    if not command:
+        return 0.0
+
+    return COMMAND_COSTS.get(posixpath.basename(command[0]), 1.0)
+
+
+def get_instruction_cost(instruction):
+    '''
+    Heuristic build cost of a Dockerfile instruction
+    '''
+    if instruction.instruction == 'RUN':
+        return sum(_command_cost(c) for c in instruction.commands)
+
+    if instruction.instruction in conda_tools.LAYER_INSTRUCTIONS:
+        return COPY_COST
+
+    return 0.0
+
+
+def _copy_target(instruction, docker_wd, workdir):
+    '''
+    Best guess at the container path written by a single-source COPY
+
+    A destination without a trailing slash is ambiguous: it is a directory if
+    it already exists in the image. Treat it as a directory if its basename
+    has no extension and differs from the source's.
+    '''
+    targets = conda_tools.get_copy_targets(instruction, docker_wd, workdir)
+    sources = instruction.args[:-1]
+    dest = posixpath.normpath(posixpath.join(workdir, instruction.args[-1]))
+
+    if len(sources) > 1 or instruction.args[-1].endswith('/'):
+        return sorted(targets)
+
+    dest_name = posixpath.basename(dest)
+    src_name = posixpath.basename(sources[0].rstrip('/'))
+
+    if '.' not in dest_name and dest_name != src_name:
+        return [posixpath.join(dest, src_name)]
+
+    return [dest]
+
+
+def _overlaps(path, other):
+    path = path.rstrip('*').rstrip('/') or '/'
+    other = other.rstrip('*').rstrip('/') or '/'
+
+    if path == '/' or other == '/':
+        return False
+
+    return (
+        path == other
+        or path.startswith(other + '/')
+        or other.startswith(path + '/'))
+
+
+def _get_run_paths(instruction, files_in_scope):
+    '''
+    Container paths mentioned by a RUN instruction or the scripts it runs
+    '''
+    paths = set()
+
+    for command in instruction.commands:
+        for token in command:
+            paths.update(_PATH_PATTERN.findall(token))
+
+    for path in list(paths):
+        local = files_in_scope.get(posixpath.normpath(path))
+        if local is None or not os.path.isfile(local):
+            continue
+
+        with open(local, 'r', errors='replace') as f:
+            paths.update(_PATH_PATTERN.findall(f.read()))
+
+    return paths
+
+
+def _uses_variables(instruction, names):
+    return any(
+        re.search(r'\$\{?' + re.escape(name) + r'\b', instruction.value)
+        for name in names)
+
+
+class _Layer(object):
+    def __init__(self, index, instruction, volatility, cost, targets,
+                 run_paths):
+        self.index = index
+        self.instruction = instruction
+        self.volatility = volatility
+        self.cost = cost
+        self.targets = targets
+        self.run_paths = run_paths
+        self.moved = False
+
+    @property
+    def movable(self):
+        return (
+            self.instruction.instruction in ('COPY', 'ADD')
+            and 'from' not in self.instruction.flags
+            and self.volatility > 0)
+
+    def blocks(self, copy):
+        '''
+        Whether ``copy`` cannot be moved past this instruction
+        '''
+        kind = self.instruction.instruction
+
+        if kind in BARRIER_INSTRUCTIONS:
+            return True
+
+        if kind in ('ENV', 'ARG'):
+            names = [a.split('=')[0] for a in self.instruction.args]
+            return _uses_variables(copy.instruction, names)
+
+        if kind in ('COPY', 'ADD'):
+            if self.volatility > copy.volatility:
+                return True
+            return any(
+                _overlaps(t, o) for t in copy.targets for o in self.targets)
+
+        if kind == 'RUN':
+            names = set(posixpath.basename(t) for t in copy.targets)
+            return any(
+                _overlaps(t, p) or posixpath.basename(p) in names
+                for t in copy.targets for p in self.run_paths)
+
+        return False
+
+
+def _get_stage_layers(stage, docker_wd, change_counts, root):
+    layers = []
+    files_in_scope = {}
+    workdir = '/'
+
+    for index, instruction in enumerate(stage.instructions):
+        targets = []
+        run_paths = set()
+        volatility = 0
+
+        if instruction.instruction in ('COPY', 'ADD'):
+            copied = conda_tools.get_copy_targets(
+                instruction, docker_wd, workdir)
+            files_in_scope.update(copied)
+
+            if copied:
+                targets = _copy_target(instruction, docker_wd, workdir)
+                volatility = sum(
+                    change_counts.get(os.path.relpath(local, root), 0)
+                    for local in set(copied.values()))
+
+        elif instruction.instruction == 'WORKDIR' and instruction.args:
+            workdir = posixpath.join(workdir, instruction.args[0])
+
+        elif instruction.instruction == 'RUN':
+            run_paths = _get_run_paths(instruction, files_in_scope)
+
+        layers.append(_Layer(
+            index, instruction, volatility,
+            get_instruction_cost(instruction), targets, run_paths))
+
+    return layers
+
+
+def _expected_rebuild_cost(order):
+    '''
+    Sum over instructions of volatility times the cost of the layers after it
+    '''
+    total = 0.0
+    cost_after = 0.0
+
+    for layer in reversed(order):
+        total += layer.volatility * cost_after
+        cost_after += layer.cost
+
+    return total
+
+
+def reorder_layers(layers):
+    '''
+    Move volatile COPY layers as late as they can legally go
+
+    COPY layers are placed from the bottom of the stage up. Each slides down
+    past every instruction which doesn't block it, then settles at the
+    earliest position with the lowest expected rebuild cost, so moves which
+    don't skip any build work are not made. Moved layers are flagged with
+    ``moved = True``.
+    '''
+    order = list(layers)
+
+    for layer in sorted(layers, key=lambda l: -l.index):
+        if not layer.movable:
+            continue
+
+        position = order.index(layer)
+        limit = position
+
+        while (
+                limit + 1 < len(order)
+                and not order[limit + 1].blocks(layer)):
+            limit += 1
+
+        best = position
+        best_cost = _expected_rebuild_cost(order)
+        candidate = list(order)
+
+        for target in range(position + 1, limit + 1):
+            candidate[target - 1], candidate[target] = (
+                candidate[target], candidate[target - 1])
+
+            cost = _expected_rebuild_cost(candidate)
+            if cost < best_cost:
+                best, best_cost = target, cost
+
+        if best != position:
+            order.remove(layer)
+            order.insert(best, layer)
+            layer.moved = True
+
+    return order
+
+
+def _render(text, orders):
+    '''
+    Render a Dockerfile with its instructions in a new order
+
+    Comments and blank lines stay where they were; only the lines of moved
+    instructions are relocated, directly after the instruction they now
+    follow.
+    '''
+    lines = text.splitlines(True)
+
+    following = {}
+    for order in orders:
+        previous = None
+        for layer in order:
+            if layer.moved:
+                following[previous].append(layer.instruction.lineno)
+            else:
+                previous = layer.instruction.lineno
+                following[previous] = []
+
+    moved = set(
+        lineno for linenos in following.values() for lineno in linenos)
+    spans = dict(
+        (start, (start, end))
+        for start, end, _ in conda_tools.get_logical_lines(text))
+
+    out = []
+    cursor = 1
+
+    for start, end in sorted(spans.values()):
+        # comments and blank lines preceding each instruction stay in place
+        out.extend(lines[cursor - 1:start - 1])
+        cursor = end + 1
+
+        if start in moved:
+            continue
+
+        out.extend(lines[start - 1:end])
+
+        for lineno in following.get(start, []):
+            s, e = spans[lineno]
+            out.extend(lines[s - 1:e])
+
+    out.extend(lines[cursor - 1:])
+
+    return ''.join(out)
+
+
+def optimize_dockerfile(dockerfile, max_commits=500, root=None):
+    '''
+    Propose a cache-friendlier instruction order for a Dockerfile
+
+    Parameters
+    ----------
+    dockerfile : str
+        Path to a Dockerfile
+    max_commits : int
+        Number of commits of git history used to score how often each
+        copied file changes (default 500)
+    root : str, optional
+        Repository root (default :py:data:`conda_tools.REPO_ROOT`)
+
+    Returns
+    -------
+    proposed : str
+        Reordered Dockerfile contents
+    before : list
+        :py:class:`LayerScore` for each instruction in the original order
+    after : list
+        :py:class:`LayerScore` for each instruction in the proposed order
+    '''
+    if root is None:
+        root = conda_tools.REPO_ROOT
+
+    with open(dockerfile, 'r') as f:
+        text = f.read()
+
+    change_counts = get_change_counts(root, max_commits=max_commits)
+    parsed = conda_tools.parse_dockerfile(dockerfile)
+    docker_wd = os.path.dirname(dockerfile)
+
+    stage_orders = []
+    for stage in parsed.stages:
+        layers = _get_stage_layers(stage, docker_wd, change_counts, root)
+        stage_orders.append((layers, reorder_layers(layers)))
+
+    def scores(index):
+        return [
+            LayerScore(
+                l.instruction.lineno, l.instruction.instruction,
+                l.volatility, l.cost, l.instruction.value)
+            for orders in stage_orders for l in orders[index]]
+
+    return (
+        _render(text, [after for _, after in stage_orders]),
+        scores(0),
+        scores(1))
+
+
+def get_rebuild_cost(scores):
+    '''
+    Expected rebuild cost of a list of :py:class:`LayerScore` rows
+    '''
+    return _expected_rebuild_cost(scores)
+
+
+def format_scores(scores):
+    rows = [('line', 'instruction', 'changes', 'cost', 'value')]
+    rows += [
+        (str(s.lineno), s.instruction, str(s.volatility),
+         '{:.0f}'.format(s.cost), s.value[:60])
+        for s in scores]
+
+    widths = [max(len(r[i]) for r in rows) for i in range(4)]
+
+    return '\n'.join(
+        '  '.join(v.ljust(w) for v, w in zip(r[:4], widths)) + '  ' + r[4]
+        for r in rows)
+
+
+@click.command()
+@click.argument('dockerfile', type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    '--write',
+    is_flag=True,
+    default=False,
+    help='overwrite the Dockerfile with the proposed order',
+)
+@click.option(
+    '--max-commits',
+    default=500,
+    help='number of commits of history used to score file volatility',
+)
+def main(dockerfile, write, max_commits):
+    '''Propose (or write) a cache-friendlier Dockerfile instruction order'''
+
+    proposed, before, after = optimize_dockerfile(
+        dockerfile, max_commits=max_commits)
+
+    click.echo(format_scores(before))
+    click.echo('')
+    click.echo('expected rebuild cost: {:.0f} -> {:.0f}'.format(
+        get_rebuild_cost(before), get_rebuild_cost(after)))
+
+    with open(dockerfile, 'r') as f:
+        original = f.read()
+
+    if proposed == original:
+        click.echo('no reordering proposed')
+        return
+
+    if write:
+        with open(dockerfile, 'w') as f:
+            f.write(proposed)
+        click.echo('{} updated'.format(dockerfile))
+    else:
+        sys.stdout.writelines(difflib.unified_diff(
+            original.splitlines(True), proposed.splitlines(True),
+            dockerfile, dockerfile + ' (proposed)'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+'''
+Build a pruned, offline snapshot of the repodata our images are solved with
+
+Every solve otherwise loads the full repodata of conda-forge and its dev
+label. This tool keeps only the records of packages reachable from the
+packages requested in the image environment files and Dockerfile ``conda
+install`` lines, and writes them as local channels (see
+:py:class:`conda_tools.RepodataSnapshot`).
+
+Usage
+-----
+
+.. code-block:: bash
+
+    $ python maintenance_utilities/repodata_snapshot.py
+
+    $ export CONDA_TOOLS_REPODATA_SNAPSHOT=~/.cache/rhg-docker-images/repodata
+    $ pytest tests/test_package_alignment.py
+
+Building the snapshot fetches the upstream repodata if conda's cached copy
+is stale. It is only pruned again if the upstream repodata or the requested
+packages changed, and subdirs whose pruned records are unchanged are not
+rewritten.
+
+'''
+
+import os
+
+import click
+
+import conda_tools
+
+
+@click.command()
+@click.argument('images', nargs=-1)
+@click.option(
+    '--snapshot-dir',
+    default=None,
+    help='snapshot directory (default $CONDA_TOOLS_REPODATA_SNAPSHOT or the '
+    'conda_tools cache)')
+def main(images, snapshot_dir):
+    '''Build or update the pruned repodata snapshot for IMAGES (default all)'''
+
+    solvers = conda_tools.get_image_solvers(images=list(images) or None)
+    channels, subdirs, names = conda_tools.get_solver_names(solvers)
+
+    snapshot = conda_tools.RepodataSnapshot(snapshot_dir)
+    deltas = snapshot.build(channels, subdirs, names)
+
+    if not deltas:
+        click.echo('snapshot in {} is up to date'.format(snapshot.snapshot_dir))
+
+    for key, delta in sorted(deltas.items()):
+        path = os.path.join(
+            snapshot.snapshot_dir, *(key.split('/') + ['repodata.json']))
+
+        click.echo('{:<40} +{:<6} -{:<6} ~{:<6} {:>8.1f} MB'.format(
+            key, delta['added'], delta['removed'], delta['patched'],
+            os.path.getsize(path) / 2.0**20))
+
+    click.echo('{} packages requested, {} in the snapshot'.format(
+        len(names), snapshot.state.get('closure_size')))
+
+
+if __name__ == '__main__':
+    main()
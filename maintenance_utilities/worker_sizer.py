@@ -0,0 +1,309 @@
+'''
+Size dask workers in the worker template to pack cleanly onto a node
+
+Given a node's allocatable resources and a workload profile, this tool
+computes how many workers fit on each node and splits the node evenly between
+them, so that no CPU or memory is left stranded. The worker template's CPU and
+memory requests and limits, ``--nthreads``, ``--memory-limit`` and the BLAS
+thread count environment variables are rewritten together so they stay
+consistent.
+
+Usage
+-----
+
+.. code-block:: bash
+
+    $ python maintenance_utilities/worker_sizer.py --cpu 3920m --memory 26Gi \
+        --threads-per-worker 1 --memory-per-thread 6GiB
+
+    $ python maintenance_utilities/worker_sizer.py --cpu 3920m --memory 26Gi \
+        --threads-per-worker 2 --memory-per-thread 4GiB --write
+
+Allocatable resources are reported by ``kubectl describe node`` and are lower
+than the machine type's capacity. Use ``--reserve-cpu`` and
+``--reserve-memory`` to set aside room for daemonsets running on each node.
+
+'''
+
+import io
+import os
+import re
+import collections
+
+import click
+from ruamel.yaml import YAML
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORKER_TEMPLATE = os.path.join(REPO_ROOT, 'notebook', 'worker-template.yml')
+
+BLAS_THREAD_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+
+MEMORY_UNITS = {
+    '': 1,
+    'b': 1,
+    'k': 10**3, 'kb': 10**3, 'ki': 2**10, 'kib': 2**10,
+    'm': 10**6, 'mb': 10**6, 'mi': 2**20, 'mib': 2**20,
+    'g': 10**9, 'gb': 10**9, 'gi': 2**30, 'gib': 2**30,
+    't': 10**12, 'tb': 10**12, 'ti': 2**40, 'tib': 2**40,
+}
+'''
+Multipliers for kubernetes quantity and dask byte string suffixes
+'''
+
+WorkerSize = collections.namedtuple(
+    'WorkerSize',
+    ['workers', 'nthreads', 'cpu', 'memory', 'blas_threads',
+     'cpu_efficiency', 'memory_efficiency'])
+'''
+Worker shape and its packing onto a node. ``cpu`` is in millicores and
+``memory`` in bytes, per worker. Efficiencies are the fraction of the node's
+allocatable resources requested by the workers.
+'''
+
+
+def parse_cpu(value):
+    '''
+    Parse a kubernetes CPU quantity (e.g. ``1.75`` or ``3920m``) to millicores
+    '''
+    value = str(value).strip()
+
+    if value.endswith('m'):
+        return int(float(value[:-1]))
+
+    return int(round(float(value) * 1000))
+
+
+def parse_memory(value):
+    '''
+    Parse a kubernetes quantity or dask byte string (``13Gi``, ``11.5GB``)
+    '''
+    match = re.match(r'^\s*([0-9.]+)\s*([a-zA-Z]*)\s*$', str(value))
+
+    if match is None or match.group(2).lower() not in MEMORY_UNITS:
+        raise ValueError('cannot parse memory quantity {!r}'.format(value))
+
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2).lower()])
+
+
+def _pack(node_cpu, node_memory, nthreads, cpu, memory):
+    workers = min(node_cpu // cpu, node_memory // memory)
+
+    return WorkerSize(
+        workers=workers,
+        nthreads=nthreads,
+        cpu=cpu,
+        memory=memory,
+        blas_threads=max(1, cpu // 1000 // nthreads),
+        cpu_efficiency=float(workers * cpu) / node_cpu,
+        memory_efficiency=float(workers * memory) / node_memory)
+
+
+def size_workers(
+        node_cpu,
+        node_memory,
+        threads_per_worker,
+        memory_per_thread,
+        cpu_per_thread=1000,
+        reserve_cpu=0,
+        reserve_memory=0):
+    '''
+    Compute a worker shape which packs onto a node with nothing stranded
+
+    Parameters
+    ----------
+    node_cpu : int
+        Node allocatable CPU, in millicores
+    node_memory : int
+        Node allocatable memory, in bytes
+    threads_per_worker : int
+    memory_per_thread : int
+        Minimum memory for each worker thread, in bytes
+    cpu_per_thread : int, optional
+        Minimum CPU for each worker thread, in millicores
+    reserve_cpu, reserve_memory : int, optional
+        Resources to leave free on each node for other pods
+
+    Returns
+    -------
+    size : WorkerSize
+        The node's remaining resources divided evenly between as many workers
+        as fit the profile. CPU is rounded down to whole millicores and
+        memory to whole MiB.
+    '''
+    cpu = node_cpu - reserve_cpu
+    memory = node_memory - reserve_memory
+
+    workers = min(
+        cpu // (threads_per_worker * cpu_per_thread),
+        memory // (threads_per_worker * memory_per_thread))
+
+    if workers < 1:
+        raise ValueError(
+            'a worker with {} threads does not fit on the node'.format(
+                threads_per_worker))
+
+    size = _pack(
+        cpu,
+        memory,
+        threads_per_worker,
+        cpu // workers,
+        memory // workers // 2**20 * 2**20)
+
+    # efficiency is reported against the whole node, including reservations
+    return size._replace(
+        cpu_efficiency=float(size.workers * size.cpu) / node_cpu,
+        memory_efficiency=float(size.workers * size.memory) / node_memory)
+
+
+def _get_container(template):
+    return template['spec']['containers'][0]
+
+
+def _get_arg(args, flag):
+    if flag in args:
+        return args[args.index(flag) + 1]
+
+
+def _set_arg(args, flag, value):
+    if flag in args:
+        args[args.index(flag) + 1] = value
+    else:
+        args.extend([flag, value])
+
+
+def get_template_size(template, node_cpu, node_memory):
+    '''
+    Get the worker shape currently in a worker template and how it packs
+    '''
+    container = _get_container(template)
+    requests = container['resources']['requests']
+
+    return _pack(
+        node_cpu,
+        node_memory,
+        int(_get_arg(container['args'], '--nthreads') or 1),
+        parse_cpu(requests['cpu']),
+        parse_memory(requests['memory']))
+
+
+def apply_worker_size(template, size):
+    '''
+    Write a worker shape into a worker template, in place
+    '''
+    container = _get_container(template)
+    mib = size.memory // 2**20
+
+    _set_arg(container['args'], '--nthreads', str(size.nthreads))
+    _set_arg(container['args'], '--memory-limit', '{}MiB'.format(mib))
+
+    for key in ('requests', 'limits'):
+        container['resources'][key]['cpu'] = '{}m'.format(size.cpu)
+        container['resources'][key]['memory'] = '{}Mi'.format(mib)
+
+    env = container.setdefault('env', [])
+    blas = str(size.blas_threads)
+
+    for var in BLAS_THREAD_VARS:
+        for entry in env:
+            if entry['name'] == var:
+                entry['value'] = blas
+                break
+        else:
+            env.append({'name': var, 'value': blas})
+
+
+def format_packing_report(current, proposed):
+    rows = [('', 'current', 'proposed')]
+
+    for label, fmt in [
+            ('workers per node', lambda s: str(s.workers)),
+            ('threads per worker', lambda s: str(s.nthreads)),
+            ('cpu per worker', lambda s: '{}m'.format(s.cpu)),
+            ('memory per worker', lambda s: '{:.2f} GiB'.format(
+                s.memory / float(2**30))),
+            ('threads per node', lambda s: str(s.workers * s.nthreads)),
+            ('cpu packed', lambda s: '{:.1%}'.format(s.cpu_efficiency)),
+            ('memory packed', lambda s: '{:.1%}'.format(s.memory_efficiency))]:
+
+        rows.append((label, fmt(current), fmt(proposed)))
+
+    widths = [max(len(r[i]) for r in rows) for i in range(3)]
+
+    return '\n'.join(
+        '  '.join(v.ljust(w) for v, w in zip(r, widths)).rstrip()
+        for r in rows)
+
+
+@click.command()
+@click.option('--cpu', required=True, help='node allocatable CPU, e.g. 3920m')
+@click.option(
+    '--memory', required=True, help='node allocatable memory, e.g. 26Gi')
+@click.option('--threads-per-worker', type=int, default=1)
+@click.option(
+    '--memory-per-thread', required=True,
+    help='minimum memory per worker thread, e.g. 6GiB')
+@click.option(
+    '--cpu-per-thread', default='1', help='minimum CPU per worker thread')
+@click.option('--reserve-cpu', default='0', help='CPU to leave free per node')
+@click.option(
+    '--reserve-memory', default='0', help='memory to leave free per node')
+@click.option(
+    '--template', 'template_path',
+    default=WORKER_TEMPLATE,
+    help='worker template to resize')
+@click.option(
+    '--write',
+    is_flag=True,
+    default=False,
+    help='rewrite the template rather than printing it')
+def main(
+        cpu,
+        memory,
+        threads_per_worker,
+        memory_per_thread,
+        cpu_per_thread,
+        reserve_cpu,
+        reserve_memory,
+        template_path,
+        write):
+    '''Resize the dask worker template to pack onto a node'''
+
+    node_cpu = parse_cpu(cpu)
+    node_memory = parse_memory(memory)
+
+    try:
+        proposed = size_workers(
+            node_cpu,
+            node_memory,
+            threads_per_worker,
+            parse_memory(memory_per_thread),
+            cpu_per_thread=parse_cpu(cpu_per_thread),
+            reserve_cpu=parse_cpu(reserve_cpu),
+            reserve_memory=parse_memory(reserve_memory))
+
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+    yaml = YAML(typ='rt')
+
+    with open(template_path, 'r') as f:
+        template = yaml.load(f)
+
+    current = get_template_size(template, node_cpu, node_memory)
+    apply_worker_size(template, proposed)
+
+    click.echo(format_packing_report(current, proposed))
+
+    if write:
+        with open(template_path, 'w') as f:
+            yaml.dump(template, f)
+    else:
+        buf = io.StringIO()
+        yaml.dump(template, buf)
+        click.echo()
+        click.echo(buf.getvalue())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+'''
+Mount a gcsfuse bucket for each service account credential file, in parallel
+
+Each ``{bucket}.json`` key file in the token directory is mounted at
+``/gcs/{bucket}``. Buckets which are already mounted are skipped, and the
+remaining mounts run concurrently, each with a timeout and retries. A mount is
+only reported as ready once its mount point is a mounted, readable directory.
+
+.. code-block:: bash
+
+    $ python /usr/bin/mount_buckets.py --token-dir /opt/gcsfuse_tokens
+
+A line is printed for each bucket with the outcome, the number of attempts
+and the time taken to mount it.
+
+'''
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import subprocess
+import collections
+import concurrent.futures
+
+
+TOKEN_DIR = '/opt/gcsfuse_tokens'
+MOUNT_ROOT = '/gcs'
+GCSFUSE = '/usr/bin/gcsfuse'
+
+MountResult = collections.namedtuple(
+    'MountResult',
+    ['bucket', 'mountpoint', 'status', 'attempts', 'seconds', 'error'])
+
+
+def _unescape_mount_path(path):
+    # /proc/mounts escapes whitespace and backslashes as octal, e.g. '\040'
+    return (
+        path.replace('\\040', ' ')
+            .replace('\\011', '\t')
+            .replace('\\012', '\n')
+            .replace('\\134', '\\'))
+
+
+def get_mountpoints(mounts_file='/proc/mounts'):
+    '''
+    Get the set of mount points listed in ``/proc/mounts``
+    '''
+    mountpoints = set()
+
+    try:
+        with open(mounts_file, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 1:
+                    mountpoints.add(_unescape_mount_path(fields[1]))
+
+    except (OSError, IOError):
+        pass
+
+    return mountpoints
+
+
+def get_key_files(token_dir=TOKEN_DIR):
+    '''
+    Map bucket names to the key files in ``token_dir``
+    '''
+    return {
+        os.path.splitext(os.path.basename(f))[0]: f
+        for f in sorted(glob.glob(os.path.join(token_dir, '*.json')))
+        if os.path.isfile(f)}
+
+
+def wait_until_ready(mountpoint, timeout, is_mounted=os.path.ismount):
+    '''
+    Wait for a mount point to be mounted and readable
+
+    Returns
+    -------
+    error : str or None
+        None if the mount became ready within ``timeout`` seconds, otherwise a
+        description of the last failure
+    '''
+    deadline = time.time() + timeout
+    delay = 0.05
+
+    while True:
+        try:
+            if is_mounted(mountpoint):
+                os.listdir(mountpoint)
+                return
+            error = '{} is not mounted'.format(mountpoint)
+
+        except (OSError, IOError) as e:
+            error = str(e)
+
+        if time.time() >= deadline:
+            return error
+
+        time.sleep(delay)
+        delay = min(delay * 2, 1)
+
+
+def mount_bucket(
+        bucket,
+        key_file,
+        mountpoint,
+        gcsfuse=GCSFUSE,
+        timeout=60,
+        retries=2,
+        is_mounted=os.path.ismount):
+    '''
+    Mount a bucket with gcsfuse, retrying failed or hung mounts
+
+    Returns
+    -------
+    result : MountResult
+    '''
+    start = time.time()
+    error = None
+
+    if not os.path.isdir(mountpoint):
+        os.makedirs(mountpoint)
+
+    for attempt in range(1, retries + 2):
+        attempt_start = time.time()
+
+        try:
+            proc = subprocess.run(
+                [gcsfuse, '--key-file={}'.format(key_file), bucket, mountpoint],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                timeout=timeout)
+
+        except subprocess.TimeoutExpired:
+            error = 'gcsfuse timed out after {}s'.format(timeout)
+            continue
+
+        except (OSError, IOError) as e:
+            error = str(e)
+            continue
+
+        if proc.returncode != 0:
+            error = proc.stdout.decode(errors='replace').strip() or (
+                'gcsfuse exited with status {}'.format(proc.returncode))
+            continue
+
+        remaining = max(timeout - (time.time() - attempt_start), 0)
+        error = wait_until_ready(mountpoint, remaining, is_mounted=is_mounted)
+
+        if error is None:
+            return MountResult(
+                bucket, mountpoint, 'mounted', attempt,
+                time.time() - start, None)
+
+    return MountResult(
+        bucket, mountpoint, 'failed', retries + 1, time.time() - start, error)
+
+
+def mount_all(
+        token_dir=TOKEN_DIR,
+        mount_root=MOUNT_ROOT,
+        gcsfuse=GCSFUSE,
+        timeout=60,
+        retries=2,
+        max_workers=None,
+        mounts_file='/proc/mounts',
+        is_mounted=os.path.ismount):
+    '''
+    Concurrently mount a bucket for each key file in ``token_dir``
+
+    Returns
+    -------
+    results : list of MountResult
+        One result per bucket, in bucket order
+    '''
+    key_files = get_key_files(token_dir)
+    mounted = get_mountpoints(mounts_file)
+
+    results = {}
+    futures = {}
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers or max(len(key_files), 1)) as executor:
+
+        for bucket, key_file in key_files.items():
+            mountpoint = os.path.join(mount_root, bucket)
+
+            if mountpoint in mounted:
+                results[bucket] = MountResult(
+                    bucket, mountpoint, 'already mounted', 0, 0.0, None)
+                continue
+
+            futures[executor.submit(
+                mount_bucket,
+                bucket,
+                key_file,
+                mountpoint,
+                gcsfuse=gcsfuse,
+                timeout=timeout,
+                retries=retries,
+                is_mounted=is_mounted)] = bucket
+
+        for future in concurrent.futures.as_completed(futures):
+            bucket = futures[future]
+
+            try:
+                results[bucket] = future.result()
+            except Exception as e:
+                results[bucket] = MountResult(
+                    bucket, os.path.join(mount_root, bucket), 'failed', 0,
+                    0.0, str(e))
+
+    return [results[b] for b in sorted(results)]
+
+
+def format_results(results):
+    '''
+    Format mount results as one line per bucket
+    '''
+    lines = []
+
+    for r in results:
+        line = '{:<30} {:<16} attempts={} {:.2f}s'.format(
+            r.bucket, r.status, r.attempts, r.seconds)
+
+        if r.error:
+            line += ' ({})'.format(r.error)
+
+        lines.append(line)
+
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument(
+        '--token-dir', default=TOKEN_DIR,
+        help='directory of {bucket}.json service account key files')
+    parser.add_argument(
+        '--mount-root', default=MOUNT_ROOT,
+        help='directory to mount buckets in')
+    parser.add_argument('--gcsfuse', default=GCSFUSE, help='gcsfuse binary')
+    parser.add_argument(
+        '--timeout', type=float, default=60,
+        help='seconds to wait for each mount attempt')
+    parser.add_argument(
+        '--retries', type=int, default=2,
+        help='retries for each failed mount')
+    parser.add_argument(
+        '--max-workers', type=int, default=None,
+        help='maximum concurrent mounts (default: all)')
+    parser.add_argument(
+        '--json', dest='json_path', default=None,
+        help='also write results as JSON to this path')
+
+    args = parser.parse_args(args)
+
+    results = mount_all(
+        token_dir=args.token_dir,
+        mount_root=args.mount_root,
+        gcsfuse=args.gcsfuse,
+        timeout=args.timeout,
+        retries=args.retries,
+        max_workers=args.max_workers)
+
+    if results:
+        print(format_results(results))
+
+    if args.json_path is not None:
+        with open(args.json_path, 'w+') as f:
+            json.dump([r._asdict() for r in results], f, indent=2)
+
+    return int(any(r.status == 'failed' for r in results))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,19 +1,90 @@
-import json, yaml, os, glob
+import json, yaml, os, glob, zlib, base64
 
 
-def add_service_creds():
+PAYLOAD_PREFIX = 'z1:'
+WORKER_TEMPLATE = '/home/jovyan/worker-template.yml'
+SOURCE_TEMPLATE = '/pre-home/worker-template.yml'
 
-    with open('/home/jovyan/worker-template.yml', 'r') as f:
+
+def pack_credentials(creds):
+    '''
+    Pack bucket credentials into a compact GCSFUSE_TOKENS value
+
+    Identical credentials shared by several buckets are stored once. The
+    payload is a JSON index of ``{bucket: [offset, length]}`` on the first
+    line, followed by the concatenated credentials, compressed and base64
+    encoded, so that a worker can decode one bucket's credential without
+    parsing the rest.
+    '''
+    index = {}
+    offsets = {}
+    body = []
+    position = 0
+
+    for bucket in sorted(creds):
+        cred = json.dumps(creds[bucket], sort_keys=True).encode()
+
+        if cred not in offsets:
+            offsets[cred] = [position, len(cred)]
+            body.append(cred)
+            position += len(cred)
+
+        index[bucket] = offsets[cred]
+
+    blob = (
+        json.dumps({'buckets': index}, sort_keys=True).encode()
+        + b'\n' + b''.join(body))
+
+    return PAYLOAD_PREFIX + base64.b64encode(zlib.compress(blob, 9)).decode()
+
+
+def unpack_credentials(value):
+    '''
+    Unpack a GCSFUSE_TOKENS value, packed or plain JSON, into a dict
+    '''
+    if not value:
+        return {}
+
+    if not value.startswith(PAYLOAD_PREFIX):
+        return json.loads(value)
+
+    blob = zlib.decompress(base64.b64decode(value[len(PAYLOAD_PREFIX):]))
+    header, _, body = blob.partition(b'\n')
+
+    return {
+        bucket: json.loads(body[offset:offset + length].decode())
+        for bucket, (offset, length)
+        in json.loads(header.decode())['buckets'].items()}
+
+
+def add_service_creds(worker_template=WORKER_TEMPLATE, source=SOURCE_TEMPLATE):
+    '''
+    Render the worker template with the notebook's bucket credentials
+
+    The template is rendered from ``source``, the copy shipped in the image,
+    so that ``worker_template`` is only rewritten when the rendered output
+    differs from what is already there.
+    '''
+    if not os.path.isfile(source):
+        source = worker_template
+
+    with open(source, 'r') as f:
         WORKER_TEMPLATE = yaml.safe_load(f)
-        
+
+    try:
+        with open(worker_template, 'r') as f:
+            previous = f.read()
+    except (OSError, IOError):
+        previous = None
+
     env_vars = []
     creds = {}
 
     for env in WORKER_TEMPLATE['spec']['containers'][0]['env']:
-        if 'GCSFUSE_TOKEN' in env['name']:
+        if env['name'] == 'GCSFUSE_TOKENS':
+            creds.update(unpack_credentials(env['value']))
+        elif 'GCSFUSE_TOKEN' in env['name']:
             continue
-        elif 'GCSFUSE_TOKENS' in env['name']:
-            creds.update(env['value'])
         else:
             env_vars.append(env)
 
@@ -24,15 +95,22 @@ def add_service_creds():
             creds[bucket] = json.load(f)
 
     env_vars.append(
-        {'name': 'GCSFUSE_TOKENS', 'value': json.dumps(creds)})
-    
+        {'name': 'GCSFUSE_TOKENS', 'value': pack_credentials(creds)})
+
     WORKER_TEMPLATE['spec']['containers'][0]['env'] = env_vars
 
-    with open('/home/jovyan/worker-template.yml', 'w') as f:
-        f.write(yaml.dump(WORKER_TEMPLATE))
+    updated = yaml.dump(WORKER_TEMPLATE)
+
+    # rewriting the template would change its mtime for every consumer
+    if updated == previous:
+        print('worker-template.yml unchanged')
+        return
+
+    with open(worker_template, 'w') as f:
+        f.write(updated)
 
     print('worker-template.yml updated')
 
 
 if __name__ == '__main__':
-    add_service_creds()
\ No newline at end of file
+    add_service_creds()
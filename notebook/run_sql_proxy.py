@@ -11,13 +11,29 @@ To use, create a file at /home/jovyan/setup.cfg with the following contents:
     SQL_TOKEN_FILE = /path/to/credentials-file.json
 
 modifying the `SQL_INSTANCE` and `SQL_TOKEN` values to match your server's
-configuration.
-
-Then, run `python run_sql_proxy.py`. This will start an SQL proxy and will also
-add these credentials to your ~/worker-template.yml file.
-
-When the process is killed (through `^C` or by killing the process) the worker
-template will be returned to its previous state.
+configuration. Several instances may be given in `SQL_INSTANCE`, separated by
+commas.
+
+Then, run `python run_sql_proxy.py`. This will start an SQL proxy for each
+instance and will also add these credentials to your ~/worker-template.yml
+file. Each instance is reported ready, with its connect latency, once its
+local port accepts connections. Proxies which exit, or whose port stops
+accepting connections, are restarted with exponential backoff.
+
+Setting `SQL_GATEWAY_POOL_SIZE` in the same section also starts a pooling
+gateway in front of each TCP proxy, and points workers at the gateway instead
+of having each worker run its own proxies. Sessions waiting longer than
+`SQL_GATEWAY_QUEUE_TIMEOUT` seconds (default 30) for a pooled connection are
+refused, and sessions idle for `SQL_GATEWAY_IDLE_TIMEOUT` seconds (default
+300) are closed. The pool size must cover the number of worker sessions open
+at once. Workers still run their own proxies for instances without a TCP
+port, which the gateway can't relay. The gateway listens on the pod IP on the
+proxy's port, so proxies must listen on a loopback address (the default)
+rather than e.g. `tcp:0.0.0.0:{port}`. See `sql_gateway.py`.
+
+When the process is killed (through `^C` or by killing the process) the
+proxies are stopped and the worker template will be returned to its previous
+state.
 
 '''
 
@@ -25,9 +41,21 @@ import os
 import json
 import yaml
 import configparser
-import subprocess
 import signal
 import time
+import asyncio
+import collections
+
+import sql_gateway
+
+
+CLOUD_SQL_PROXY = '/usr/bin/cloud_sql_proxy'
+
+GATEWAY_QUEUE_TIMEOUT = 30
+GATEWAY_IDLE_TIMEOUT = 300
+
+SqlInstance = collections.namedtuple(
+    'SqlInstance', ['connection_name', 'host', 'port', 'spec'])
 
 
 def get_sql_service_account_token(sql_token_file):
@@ -42,25 +70,302 @@ def get_sql_service_account_token(sql_token_file):
         return
 
 
+def parse_instances(sql_instance):
+    '''
+    Parse a comma-separated ``SQL_INSTANCE`` into one entry per instance
+
+    Each entry has the form ``{project}:{region}:{instance}=tcp:{port}`` or
+    ``...=tcp:{host}:{port}``. Instances without a TCP port have ``port`` set
+    to None.
+    '''
+    instances = []
+
+    for spec in sql_instance.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+
+        connection_name, _, target = spec.partition('=')
+        host, port = '127.0.0.1', None
+
+        if target.startswith('tcp:'):
+            address = target[len('tcp:'):].split(':')
+            if len(address) > 1:
+                host = address[0]
+            port = int(address[-1])
+
+        instances.append(SqlInstance(connection_name, host, port, spec))
+
+    return instances
+
+
+async def check_connection(host, port, timeout=5):
+    '''
+    Open and close a TCP connection, returning the connect latency in seconds
+    '''
+    start = time.monotonic()
+
+    _, writer = await asyncio.wait_for(
+        asyncio.open_connection(host, port), timeout)
+
+    latency = time.monotonic() - start
+    writer.close()
+    await writer.wait_closed()
+
+    return latency
+
+
+class ProxySupervisor(object):
+    '''
+    Run and supervise a cloud_sql_proxy process for each SQL instance
+
+    Parameters
+    ----------
+    instances : list of SqlInstance
+    credential_file : str
+    proxy : str, optional
+        cloud_sql_proxy binary
+    min_backoff, max_backoff : float, optional
+        Bounds, in seconds, on the delay before restarting a proxy which has
+        exited. The delay doubles with each consecutive restart, and resets
+        once a proxy has run for longer than ``max_backoff``.
+    ready_timeout : float, optional
+        Seconds to wait for a proxy's port to accept connections
+    health_interval : float, optional
+        Seconds between connection checks on a ready proxy. Each check makes
+        the proxy dial the instance, so checks are infrequent.
+    max_health_failures : int, optional
+        Consecutive failed checks after which a proxy is restarted. A proxy
+        which never becomes ready within ``ready_timeout`` is also restarted.
+    shutdown_timeout : float, optional
+        Seconds to wait for proxies to exit on shutdown before killing them
+    '''
+
+    def __init__(
+            self,
+            instances,
+            credential_file,
+            proxy=CLOUD_SQL_PROXY,
+            min_backoff=1,
+            max_backoff=60,
+            ready_timeout=60,
+            health_interval=60,
+            max_health_failures=3,
+            shutdown_timeout=2):
+
+        self.instances = instances
+        self.credential_file = credential_file
+        self.proxy = proxy
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.ready_timeout = ready_timeout
+        self.health_interval = health_interval
+        self.max_health_failures = max_health_failures
+        self.shutdown_timeout = shutdown_timeout
+
+        self.status = {
+            i.connection_name: {
+                'state': 'stopped',
+                'restarts': 0,
+                'returncode': None,
+                'ready_seconds': None,
+                'connect_latency': None}
+            for i in instances}
+
+        self._processes = {}
+        self._stop = None
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+
+    async def run(self, handle_signals=True):
+        '''
+        Supervise the proxies until :py:meth:`stop` is called or on signal
+
+        If a proxy cannot be started (e.g. the proxy binary is missing), the
+        other proxies are shut down and the error is raised.
+        '''
+        self._stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        if handle_signals:
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, self.stop)
+
+        tasks = [
+            asyncio.ensure_future(self._supervise(i)) for i in self.instances]
+        stopped = asyncio.ensure_future(self._stop.wait())
+
+        try:
+            # supervisors only return once stopped, so one finishing first
+            # has failed
+            done, _ = await asyncio.wait(
+                [stopped] + tasks, return_when=asyncio.FIRST_COMPLETED)
+
+            self.stop()
+            await self._shutdown()
+
+            for task in done:
+                task.result()
+
+        finally:
+            stopped.cancel()
+
+            for task in tasks:
+                task.cancel()
+
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+            if handle_signals:
+                for sig in (signal.SIGINT, signal.SIGTERM):
+                    loop.remove_signal_handler(sig)
+
+    async def _supervise(self, instance):
+        status = self.status[instance.connection_name]
+        backoff = self.min_backoff
+
+        while not self._stop.is_set():
+            status['state'] = 'starting'
+            started = time.monotonic()
+
+            proc = await asyncio.create_subprocess_exec(
+                self.proxy,
+                '-instances',
+                instance.spec,
+                '-credential_file',
+                self.credential_file)
+
+            self._processes[instance.connection_name] = proc
+
+            monitor = asyncio.ensure_future(
+                self._monitor(instance, status, started, proc))
+
+            status['returncode'] = await proc.wait()
+            monitor.cancel()
+
+            if self._stop.is_set():
+                break
+
+            if time.monotonic() - started > self.max_backoff:
+                backoff = self.min_backoff
+
+            status['state'] = 'restarting'
+            status['restarts'] += 1
+
+            print(
+                '{} proxy exited with status {}; restarting in {:.1f}s'.format(
+                    instance.connection_name, status['returncode'], backoff))
+
+            try:
+                await asyncio.wait_for(self._stop.wait(), backoff)
+            except asyncio.TimeoutError:
+                pass
+
+            backoff = min(backoff * 2, self.max_backoff)
+
+        status['state'] = 'stopped'
+
+    def _restart(self, instance, proc, reason):
+        print('{} proxy {}; restarting'.format(
+            instance.connection_name, reason))
+
+        try:
+            proc.terminate()
+        except ProcessLookupError:
+            pass
+
+    async def _monitor(self, instance, status, started, proc):
+        if instance.port is None:
+            status['state'] = 'ready'
+            return
+
+        deadline = started + self.ready_timeout
+
+        while True:
+            try:
+                latency = await check_connection(instance.host, instance.port)
+                break
+
+            except (OSError, asyncio.TimeoutError):
+                if time.monotonic() > deadline:
+                    status['state'] = 'unhealthy'
+                    self._restart(instance, proc, 'not ready after {}s'.format(
+                        self.ready_timeout))
+                    return
+
+                await asyncio.sleep(0.1)
+
+        status['state'] = 'ready'
+        status['ready_seconds'] = time.monotonic() - started
+        status['connect_latency'] = latency
+
+        print(
+            '{} ready on {}:{} after {:.2f}s (connect latency {:.1f}ms)'.format(
+                instance.connection_name, instance.host, instance.port,
+                status['ready_seconds'], latency * 1000))
+
+        failures = 0
+
+        while True:
+            await asyncio.sleep(self.health_interval)
+
+            try:
+                status['connect_latency'] = await check_connection(
+                    instance.host, instance.port)
+                status['state'] = 'ready'
+                failures = 0
+
+            except (OSError, asyncio.TimeoutError):
+                status['state'] = 'unhealthy'
+                failures += 1
+
+                if failures >= self.max_health_failures:
+                    self._restart(instance, proc, 'failed {} checks'.format(
+                        failures))
+                    return
+
+    async def _shutdown(self):
+        running = [p for p in self._processes.values() if p.returncode is None]
+
+        for proc in running:
+            try:
+                proc.terminate()
+            except ProcessLookupError:
+                pass
+
+        if not running:
+            return
+
+        _, pending = await asyncio.wait(
+            [asyncio.ensure_future(p.wait()) for p in running],
+            timeout=self.shutdown_timeout)
+
+        if pending:
+            for proc in running:
+                if proc.returncode is None:
+                    try:
+                        proc.kill()
+                    except ProcessLookupError:
+                        pass
+
+            await asyncio.wait(pending)
+
+
 class add_sql_proxy_to_worker_spec(object):
-    kill_now = False
 
-    def __init__(self, sql_instance, sql_token):
+    def __init__(self, sql_instance, sql_token, gateway_host=None):
         self.original_worker_template = None
         self.sql_instance = sql_instance
         self.sql_token = sql_token
-
-        self.sql_proxy_process = None
-        
-        # handle sigint
-        signal.signal(signal.SIGINT, self.return_worker_spec_to_original_state)
-        signal.signal(signal.SIGTERM, self.return_worker_spec_to_original_state)
+        self.gateway_host = gateway_host
 
     def __enter__(self):
         sql_instance = self.sql_instance
         sql_token = self.sql_token
 
-        if (sql_instance is None) or (sql_token is None):
+        if (not sql_instance and self.gateway_host is None) or (
+                sql_token is None):
             return
 
         try:
@@ -78,15 +383,25 @@ class add_sql_proxy_to_worker_spec(object):
                 continue
             elif 'SQL_TOKEN' in env['name']:
                 continue
+            elif 'SQL_GATEWAY' in env['name']:
+                continue
             else:
                 env_vars.append(env)
 
-        env_vars.append(
-            {'name': 'SQL_TOKEN', 'value': json.dumps(sql_token)})
+        # with a gateway, workers connect to it rather than running proxies,
+        # except for the instances in sql_instance which it can't relay
+        if self.gateway_host is not None:
+            env_vars.append(
+                {'name': 'SQL_GATEWAY', 'value': self.gateway_host})
+
+        if sql_instance:
+            env_vars.append(
+                {'name': 'SQL_TOKEN', 'value': json.dumps(sql_token)})
+
+            env_vars.append(
+                {'name': 'SQL_INSTANCE', 'value': sql_instance})
+
 
-        env_vars.append(
-            {'name': 'SQL_INSTANCE', 'value': sql_instance})
-        
         worker_template_modified['spec']['containers'][0]['env'] = env_vars
 
         with open('/home/jovyan/worker-template.yml', 'w') as f:
@@ -95,22 +410,6 @@ class add_sql_proxy_to_worker_spec(object):
         print('proxy added to worker-template.yml')
 
 
-    def maybe_start_sql_proxy(self, sql_instance, sql_token_file):
-        if (sql_instance is None) or (sql_token_file is None):
-            return
-        
-        p = subprocess.Popen([
-            '/usr/bin/cloud_sql_proxy',
-            '-instances',
-            sql_instance,
-            '-credential_file',
-            sql_token_file])
-
-        self.sql_proxy_process = p
-
-        p.wait()
-
-
     def return_worker_spec_to_original_state(self, *args):
         if self.original_worker_template is None:
             return
@@ -118,24 +417,61 @@ class add_sql_proxy_to_worker_spec(object):
         with open('/home/jovyan/worker-template.yml', 'w') as f:
             f.write(self.original_worker_template)        
 
-        print('proxy removed from worker-template.yml')
-
-        if (
-                (self.sql_proxy_process is not None)
-                and (self.sql_proxy_process.poll() is None)):
+        self.original_worker_template = None
 
-            try:
-                self.sql_proxy_process.kill()
-            except:
-                pass
-        
-        self.kill_now = True
+        print('proxy removed from worker-template.yml')
 
 
     def __exit__(self, *errs):
         self.return_worker_spec_to_original_state()
 
 
+def get_gateways(
+        instances,
+        gateway_host,
+        pool_size,
+        queue_timeout=None,
+        idle_timeout=None):
+    '''
+    Create a pooling gateway for each instance with a TCP port
+
+    Each gateway listens on ``gateway_host`` on the same port as its proxy.
+
+    Returns
+    -------
+    gateways : list of sql_gateway.PoolingGateway
+    worker_instances : str
+        Comma-separated ``SQL_INSTANCE`` entries of the instances without a
+        TCP port, for which workers must still run their own proxies
+
+    Raises
+    ------
+    ValueError
+        If a proxy listens on an address which includes ``gateway_host``, so
+        the gateway can't bind its port
+    '''
+    for i in instances:
+        if i.port is not None and i.host in ('0.0.0.0', '::', gateway_host):
+            raise ValueError(
+                '{} proxy listens on {}:{}, which the gateway needs to listen '
+                'on {}:{}. Use tcp:{} to have the proxy listen on localhost '
+                'only.'.format(
+                    i.connection_name, i.host, i.port, gateway_host, i.port,
+                    i.port))
+
+    gateways = [
+        sql_gateway.PoolingGateway(
+            gateway_host, i.port, i.host, i.port,
+            pool_size=pool_size,
+            queue_timeout=queue_timeout,
+            idle_timeout=idle_timeout)
+        for i in instances if i.port is not None]
+
+    worker_instances = ','.join(i.spec for i in instances if i.port is None)
+
+    return gateways, worker_instances
+
+
 def handle_sql_config():
     config = configparser.ConfigParser()
 
@@ -151,17 +487,51 @@ def handle_sql_config():
     sql_token_file = config['sql-proxy'].get('SQL_TOKEN_FILE')
     sql_token = get_sql_service_account_token(sql_token_file)
 
-    sql_proxy = add_sql_proxy_to_worker_spec(sql_instance, sql_token)
-    
-    with sql_proxy:
-        sql_proxy.maybe_start_sql_proxy(sql_instance, sql_token_file)
+    pool_size = config['sql-proxy'].getint('SQL_GATEWAY_POOL_SIZE')
+    queue_timeout = config['sql-proxy'].getfloat(
+        'SQL_GATEWAY_QUEUE_TIMEOUT', GATEWAY_QUEUE_TIMEOUT)
+    idle_timeout = config['sql-proxy'].getfloat(
+        'SQL_GATEWAY_IDLE_TIMEOUT', GATEWAY_IDLE_TIMEOUT)
+
+    if (sql_instance is None) or (sql_token_file is None):
+        return
+
+    instances = parse_instances(sql_instance)
+    supervisor = ProxySupervisor(instances, sql_token_file)
+
+    gateways = []
+    gateway_host = None
+    worker_instances = sql_instance
+
+    if pool_size:
+        gateway_host = sql_gateway.get_pod_ip()
+        gateways, worker_instances = get_gateways(
+            instances, gateway_host, pool_size, queue_timeout, idle_timeout)
+
+    with add_sql_proxy_to_worker_spec(
+            worker_instances, sql_token, gateway_host):
+        asyncio.run(run_with_gateways(supervisor, gateways))
+
+
+async def run_with_gateways(supervisor, gateways, report_interval=60):
+    '''
+    Run the proxy supervisor with pooling gateways in front of the proxies
+    '''
+    for gateway in gateways:
+        await gateway.start()
+
+    reporter = asyncio.ensure_future(
+        sql_gateway.report_stats(gateways, report_interval))
+
+    try:
+        await supervisor.run()
 
-    # wait for sql_proxy to exit gracefully
-    while True:
-        if sql_proxy.kill_now:
-            break
+    finally:
+        reporter.cancel()
 
-        time.sleep(1)
+        for gateway in gateways:
+            await gateway.close()
+            print(sql_gateway.format_stats(gateway))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,311 @@
+'''
+Pool dask worker database sessions through a bounded set of connections
+
+Every worker running its own cloud_sql_proxy opens its own connections to the
+database, and a large cluster can exhaust the database's connection limit.
+The gateway accepts worker connections and relays each session over one of at
+most ``pool_size`` upstream connections to a single proxy. Sessions beyond
+the pool size wait in a queue until a connection is released, and are
+refused with a Postgres ``too_many_connections`` error if they wait longer
+than ``queue_timeout``.
+
+A session holds its upstream connection until the client disconnects, and
+dask workers keep their database connections open between tasks, so
+``pool_size`` must cover the number of worker sessions open at once. Sessions
+which send and receive nothing for ``idle_timeout`` seconds are closed to
+free their connection for queued sessions; clients should check pooled
+connections before use (e.g. sqlalchemy's ``pool_pre_ping``), and queries
+running for longer than ``idle_timeout`` without returning rows are cut off.
+
+To run the gateway alongside the proxies started by ``run_sql_proxy.py``, add
+the pool size to the ``[sql-proxy]`` section of /home/jovyan/setup.cfg:
+
+.. code-block:: bash
+
+    [sql-proxy]
+
+    SQL_INSTANCE = {project}:{region}:{instance}=tcp:{port}
+    SQL_TOKEN_FILE = /path/to/credentials-file.json
+    SQL_GATEWAY_POOL_SIZE = 20
+
+The gateway listens on the notebook's pod IP on the same port as each proxy,
+and workers are given the address in ``SQL_GATEWAY`` in place of starting
+their own proxies. To run the gateway on its own, e.g. as a sidecar:
+
+.. code-block:: bash
+
+    $ python sql_gateway.py --listen 0.0.0.0:6432 --upstream 127.0.0.1:5432 \
+        --pool-size 20 --idle-timeout 300
+
+Queueing metrics are printed periodically, on shutdown, and whenever a
+session is refused.
+
+'''
+
+import time
+import struct
+import signal
+import socket
+import asyncio
+import argparse
+
+
+def format_error_response(message, code='53300'):
+    '''
+    Encode a Postgres ``ErrorResponse`` message with severity FATAL
+    '''
+    fields = b''.join(
+        key + value.encode() + b'\0'
+        for key, value in [(b'S', 'FATAL'), (b'C', code), (b'M', message)])
+
+    body = fields + b'\0'
+
+    return b'E' + struct.pack('!I', len(body) + 4) + body
+
+
+def get_pod_ip():
+    '''
+    Get the address workers can use to reach this pod
+    '''
+    return socket.gethostbyname(socket.gethostname())
+
+
+async def _pipe(reader, writer, activity):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+
+            activity[0] = time.monotonic()
+            writer.write(data)
+            await writer.drain()
+
+    except (ConnectionError, OSError):
+        pass
+
+    finally:
+        writer.close()
+
+
+class PoolingGateway(object):
+    '''
+    Relay client sessions over a bounded number of upstream connections
+
+    Parameters
+    ----------
+    listen_host, listen_port : str, int
+        Address to accept client connections on
+    upstream_host, upstream_port : str, int
+        Address of the proxy to relay sessions to
+    pool_size : int, optional
+        Maximum number of concurrent upstream connections
+    queue_timeout : float, optional
+        Seconds a session may wait for an upstream connection before it is
+        refused. Sessions wait indefinitely if None.
+    idle_timeout : float, optional
+        Seconds without traffic in either direction after which a session is
+        closed, releasing its upstream connection. Sessions are never closed
+        by the gateway if None.
+    '''
+
+    def __init__(
+            self,
+            listen_host,
+            listen_port,
+            upstream_host,
+            upstream_port,
+            pool_size=10,
+            queue_timeout=None,
+            idle_timeout=None):
+
+        self.listen_host = listen_host
+        self.listen_port = listen_port
+        self.upstream_host = upstream_host
+        self.upstream_port = upstream_port
+        self.pool_size = pool_size
+        self.queue_timeout = queue_timeout
+        self.idle_timeout = idle_timeout
+
+        self.stats = {
+            'sessions': 0,
+            'active': 0,
+            'max_active': 0,
+            'queued': 0,
+            'max_queued': 0,
+            'rejected': 0,
+            'idle_closed': 0,
+            'upstream_errors': 0,
+            'wait_seconds': 0.0,
+            'max_wait_seconds': 0.0}
+
+        self._slots = None
+        self._server = None
+
+    async def start(self):
+        self._slots = asyncio.Semaphore(self.pool_size)
+        self._server = await asyncio.start_server(
+            self._handle, self.listen_host, self.listen_port)
+
+        print('gateway listening on {}:{} for {}:{} (pool size {})'.format(
+            self.listen_host, self.listen_port, self.upstream_host,
+            self.upstream_port, self.pool_size))
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _acquire(self):
+        stats = self.stats
+        stats['queued'] += 1
+        stats['max_queued'] = max(stats['max_queued'], stats['queued'])
+        start = time.monotonic()
+
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+            return True
+
+        except asyncio.TimeoutError:
+            stats['rejected'] += 1
+            return False
+
+        finally:
+            stats['queued'] -= 1
+            wait = time.monotonic() - start
+            stats['wait_seconds'] += wait
+            stats['max_wait_seconds'] = max(stats['max_wait_seconds'], wait)
+
+    async def _handle(self, reader, writer):
+        stats = self.stats
+
+        if not await self._acquire():
+            print('refused a session after {}s in the queue: {}'.format(
+                self.queue_timeout, format_stats(self)))
+
+            writer.write(format_error_response(
+                'sql gateway: no connection available after {}s'.format(
+                    self.queue_timeout)))
+            writer.close()
+            return
+
+        try:
+            try:
+                upstream_reader, upstream_writer = await asyncio.open_connection(
+                    self.upstream_host, self.upstream_port)
+
+            except OSError as e:
+                stats['upstream_errors'] += 1
+                writer.write(format_error_response(
+                    'sql gateway: upstream unavailable ({})'.format(e),
+                    code='08006'))
+                writer.close()
+                return
+
+            stats['sessions'] += 1
+            stats['active'] += 1
+            stats['max_active'] = max(stats['max_active'], stats['active'])
+
+            activity = [time.monotonic()]
+            relay = asyncio.gather(
+                _pipe(reader, upstream_writer, activity),
+                _pipe(upstream_reader, writer, activity))
+
+            try:
+                await self._relay(relay, activity, writer, upstream_writer)
+
+            finally:
+                stats['active'] -= 1
+
+        finally:
+            self._slots.release()
+
+
+    async def _relay(self, relay, activity, writer, upstream_writer):
+        while self.idle_timeout is not None and not relay.done():
+            remaining = self.idle_timeout - (time.monotonic() - activity[0])
+
+            if remaining <= 0:
+                # closing both ends ends the pipes, which releases the slot
+                self.stats['idle_closed'] += 1
+                writer.close()
+                upstream_writer.close()
+                break
+
+            await asyncio.wait([relay], timeout=remaining)
+
+        await relay
+
+
+def format_stats(gateway):
+    stats = gateway.stats
+    sessions = stats['sessions'] + stats['rejected']
+
+    return (
+        '{}:{} sessions={} active={} max_active={} queued={} max_queued={} '
+        'rejected={} idle_closed={} mean_wait={:.3f}s '
+        'max_wait={:.3f}s'.format(
+            gateway.listen_host, gateway.listen_port, stats['sessions'],
+            stats['active'], stats['max_active'], stats['queued'],
+            stats['max_queued'], stats['rejected'], stats['idle_closed'],
+            stats['wait_seconds'] / max(sessions, 1),
+            stats['max_wait_seconds']))
+
+
+async def report_stats(gateways, interval):
+    while True:
+        await asyncio.sleep(interval)
+
+        for gateway in gateways:
+            print(format_stats(gateway))
+
+
+async def serve(gateway, report_interval):
+    '''
+    Run a gateway until SIGINT or SIGTERM
+    '''
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await gateway.start()
+    reporter = asyncio.ensure_future(report_stats([gateway], report_interval))
+
+    try:
+        await stop.wait()
+    finally:
+        reporter.cancel()
+        await gateway.close()
+        print(format_stats(gateway))
+
+
+def _parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--listen', required=True, help='host:port to accept')
+    parser.add_argument('--upstream', required=True, help='proxy host:port')
+    parser.add_argument('--pool-size', type=int, default=10)
+    parser.add_argument('--queue-timeout', type=float, default=None)
+    parser.add_argument('--idle-timeout', type=float, default=None)
+    parser.add_argument(
+        '--report-interval', type=float, default=60,
+        help='seconds between printing queueing metrics')
+
+    args = parser.parse_args(args)
+
+    gateway = PoolingGateway(
+        *(_parse_address(args.listen) + _parse_address(args.upstream)),
+        pool_size=args.pool_size,
+        queue_timeout=args.queue_timeout,
+        idle_timeout=args.idle_timeout)
+
+    asyncio.run(serve(gateway, args.report_interval))
+
+if __name__ == '__main__':
+    main()
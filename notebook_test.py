@@ -1,5 +1,42 @@
+'''
+Smoke tests and benchmarks for a notebook/worker image pair
+
+Runs a couple of correctness checks across a dask cluster, then measures
+task submission throughput, scheduler round-trip latency, worker-to-worker
+transfer bandwidth and the serialization cost of numpy, pandas and xarray
+objects. Results are merged into a JSON file keyed by image tag, and
+compared against a previous tag in the same file.
+
+.. code-block:: bash
+
+    # against the scheduler started by test_pairing.sh
+    $ python notebook_test.py --scheduler 127.0.0.1:8786 --tag 2020-06-12.01
+
+    # against a LocalCluster, comparing with a previous release
+    $ python notebook_test.py --local --tag dev --baseline 2020-06-12.01
+
+'''
+
+import os
+import json
+import time
+import argparse
+import datetime
+import statistics
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import dask
+import distributed
 import dask.distributed as dd
 import fiona as fiona_notebook
+from distributed.protocol import serialize_bytes, deserialize_bytes
+
+
+RESULTS_FILE = 'benchmarks.json'
+
+HIGHER_IS_BETTER = ('per_second',)
 
 
 def remote_fiona_import(*args):
@@ -11,24 +48,257 @@ def square(x):
     return x**2
 
 
-def test_square():
-    client = dd.Client("127.0.0.1:8786")
+def inc(x):
+    return x + 1
+
+
+def test_square(client):
     futures = client.map(lambda x: x**2, range(10))
     total = client.gather(client.submit(sum, futures))
     assert total == 285, total
 
 
-def test_imports():
-    client = dd.Client("127.0.0.1:8786")
+def test_imports(client):
     futures = client.map(remote_fiona_import, range(10))
     total = client.gather(futures)
 
 
-def main():
-    test_square()
-    test_imports()
+def bench_submission_throughput(client, ntasks=2000):
+    '''
+    Tasks submitted, run and gathered per second
+    '''
+    start = time.perf_counter()
+    futures = client.map(inc, range(ntasks), pure=False)
+    client.gather(futures)
+    elapsed = time.perf_counter() - start
+
+    return {'tasks': ntasks, 'tasks_per_second': ntasks / elapsed}
+
+
+def bench_scheduler_latency(client, rounds=100):
+    '''
+    Round trip time of submitting a trivial task and fetching its result
+    '''
+    latencies = []
+
+    for i in range(rounds):
+        start = time.perf_counter()
+        client.submit(inc, i, pure=False).result()
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+
+    return {
+        'rounds': rounds,
+        'median_ms': statistics.median(latencies) * 1000,
+        'p90_ms': latencies[int(0.9 * (rounds - 1))] * 1000}
+
+
+def _nbytes(x):
+    return x.nbytes
+
+
+def bench_transfer_bandwidth(client, nbytes=64 * 2**20, rounds=3):
+    '''
+    Bandwidth of moving an array from one worker to another
+    '''
+    workers = sorted(client.scheduler_info()['workers'])
+
+    if len(workers) < 2:
+        return {'skipped': 'needs at least two workers'}
+
+    rates = []
+
+    for i in range(rounds):
+        data = client.submit(
+            np.random.random, nbytes // 8, workers=[workers[0]], pure=False)
+        dd.wait(data)
+
+        start = time.perf_counter()
+        moved = client.submit(
+            _nbytes, data, workers=[workers[1]], allow_other_workers=False)
+        moved.result()
+        rates.append(nbytes / 2**20 / (time.perf_counter() - start))
+
+        del data, moved
+
+    return {'mb': nbytes / 2**20, 'mb_per_second': statistics.median(rates)}
+
+
+def _sample_objects():
+    n = 2 * 10**6
+    arr = np.random.random(n)
+
+    return {
+        'numpy': arr,
+        'pandas': pd.DataFrame({
+            'a': arr,
+            'b': np.arange(n),
+            'c': pd.Categorical(np.random.choice(['x', 'y', 'z'], n))}),
+        'xarray': xr.Dataset(
+            {'v': (('time', 'x'), arr.reshape(2000, -1))},
+            coords={
+                'time': pd.date_range('2000-01-01', periods=2000),
+                'x': np.arange(n // 2000)})}
+
+
+def bench_serialization(rounds=5):
+    '''
+    Throughput of dask's serialization of numpy, pandas and xarray objects
+    '''
+    results = {}
+
+    for name, obj in _sample_objects().items():
+        dumps, loads = [], []
+
+        for i in range(rounds):
+            start = time.perf_counter()
+            payload = serialize_bytes(obj)
+            dumps.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            deserialize_bytes(payload)
+            loads.append(time.perf_counter() - start)
+
+        mb = len(payload) / 2**20
+
+        results[name] = {
+            'mb': mb,
+            'serialize_mb_per_second': mb / statistics.median(dumps),
+            'deserialize_mb_per_second': mb / statistics.median(loads)}
+
+    return results
+
+
+def run_benchmarks(client):
+    return {
+        'submission_throughput': bench_submission_throughput(client),
+        'scheduler_latency': bench_scheduler_latency(client),
+        'transfer_bandwidth': bench_transfer_bandwidth(client),
+        'serialization': bench_serialization()}
+
+
+def _flatten(results, prefix=''):
+    flat = {}
+
+    for k, v in results.items():
+        if isinstance(v, dict):
+            flat.update(_flatten(v, prefix + k + '.'))
+        elif isinstance(v, (int, float)):
+            flat[prefix + k] = v
+
+    return flat
+
+
+def save_results(path, tag, results):
+    '''
+    Merge a tag's results into the JSON results file
+    '''
+    try:
+        with open(path, 'r') as f:
+            all_results = json.load(f)
+    except (OSError, IOError, ValueError):
+        all_results = {}
+
+    all_results[tag] = {
+        'timestamp': datetime.datetime.now(
+            datetime.timezone.utc).isoformat(),
+        'versions': {
+            'dask': dask.__version__,
+            'distributed': distributed.__version__,
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'xarray': xr.__version__},
+        'results': results}
+
+    with open(path, 'w+') as f:
+        json.dump(all_results, f, indent=2, sort_keys=True)
+
+    return all_results
+
+
+def compare_results(all_results, tag, baseline=None):
+    '''
+    Format a tag's results alongside a baseline tag's
+
+    The baseline defaults to the most recent other tag in the results. A
+    positive change is an improvement, for both throughputs and latencies.
+    '''
+    if baseline is None:
+        others = sorted(
+            (r['timestamp'], t) for t, r in all_results.items() if t != tag)
+
+        if not others:
+            return
+
+        baseline = others[-1][1]
+
+    old = _flatten(all_results[baseline]['results'])
+    new = _flatten(all_results[tag]['results'])
+
+    lines = ['{:<55} {:>12} {:>12} {:>8}'.format(
+        'metric', baseline[:12], tag[:12], 'change')]
+
+    for metric in sorted(set(old) & set(new)):
+        if not metric.endswith(HIGHER_IS_BETTER + ('_ms',)):
+            continue
+
+        change = (new[metric] - old[metric]) / old[metric] if old[metric] else 0
+        if not metric.endswith(HIGHER_IS_BETTER):
+            change = -change
+
+        lines.append('{:<55} {:>12.2f} {:>12.2f} {:>+7.1%}'.format(
+            metric, old[metric], new[metric], change))
+
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument(
+        '--scheduler', default='127.0.0.1:8786',
+        help='address of the scheduler to benchmark')
+    parser.add_argument(
+        '--local', action='store_true',
+        help='benchmark a LocalCluster instead of connecting to a scheduler')
+    parser.add_argument(
+        '--tag', default=os.environ.get('IMAGE_TAG', 'local'),
+        help='image tag to record results under')
+    parser.add_argument('--output', default=RESULTS_FILE)
+    parser.add_argument(
+        '--baseline', default=None, help='tag to compare results against')
+
+    args = parser.parse_args(args)
+
+    cluster = None
+
+    if args.local:
+        cluster = dd.LocalCluster(n_workers=2, threads_per_worker=1)
+        client = dd.Client(cluster)
+    else:
+        client = dd.Client(args.scheduler)
+
+    try:
+        test_square(client)
+        test_imports(client)
+        print('ran all tests successfully')
+
+        results = run_benchmarks(client)
+
+    finally:
+        client.close()
+
+        if cluster is not None:
+            cluster.close()
+
+    all_results = save_results(args.output, args.tag, results)
+    comparison = compare_results(all_results, args.tag, args.baseline)
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+    if comparison is not None:
+        print(comparison)
 
 
 if __name__ == "__main__":
     main()
-    print('ran all tests successfully')
@@ -10,6 +10,12 @@ Usage
     
     $ python pin.py unpin all
 
+    $ python pin.py lock all
+
+    $ python pin.py diff all
+
+    $ python pin.py align
+
 Use the ``--dry-run`` flag to see the effect of any commands rather than modifying the
 environment files directly. The ``--help`` command provides additional information about
 each command.
@@ -17,23 +23,246 @@ each command.
 '''
 
 import click
+import concurrent.futures
+import glob
+import io
 import json
+import os
 import subprocess
 import re
 import sys
+import tempfile
 
 from ruamel.yaml import YAML
 
+YAML_INDENT = dict(mapping=2, sequence=2, offset=2)
+
+_yaml = None
 
-def get_versions_in_current_environment(envname='base'):
+
+def _get_yaml():
     '''
-    Calls ``conda env export -n {envname} --json`` and returns spec
-    
+    Returns the shared round-trip YAML instance used to read and write env files
+    '''
+    global _yaml
+
+    if _yaml is None:
+        _yaml = YAML(typ='rt')
+        _yaml.indent(**YAML_INDENT)
+        _yaml.default_flow_style = False
+
+    return _yaml
+
+
+def _render_yaml(file_spec):
+    buf = io.StringIO()
+    _get_yaml().dump(file_spec, buf)
+    return buf.getvalue()
+
+
+def _write_env_file(filepath, contents, dry_run=False):
+    '''
+    Write an environment file only if its contents have changed
+
+    Files are replaced atomically, and files whose contents would not change
+    are left untouched so their mtimes (and any docker layer caches keyed on
+    them) are preserved.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the environment file
+    contents : str
+        Rendered file contents
+    dry_run : bool
+        Print the rendered file rather than writing it. Default False.
+
+    Returns
+    -------
+    changed : bool
+        Whether the rendered file differs from the file on disk
+    '''
+    with open(filepath, 'r') as f:
+        changed = (f.read() != contents)
+
+    if dry_run:
+        sys.stdout.write("filename: {}\n{}\n".format(filepath, '-'*50))
+        sys.stdout.write(contents)
+        sys.stdout.write("\n")
+        return changed
+
+    if not changed:
+        return False
+
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filepath)),
+        prefix='.' + os.path.basename(filepath))
+
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+        os.chmod(tmp, os.stat(filepath).st_mode & 0o777)
+        os.replace(tmp, filepath)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+    return True
+
+
+def _get_conda_root_prefix():
+    '''
+    Find the root conda prefix without calling the ``conda`` CLI
+    '''
+    if os.environ.get('CONDA_ROOT'):
+        return os.environ['CONDA_ROOT']
+
+    if os.environ.get('CONDA_EXE'):
+        return os.path.dirname(os.path.dirname(os.environ['CONDA_EXE']))
+
+    if os.path.isdir('/opt/conda/conda-meta'):
+        return '/opt/conda'
+
+    return sys.prefix
+
+
+def _get_env_prefix(envname):
+    root = _get_conda_root_prefix()
+
+    if envname == 'base':
+        return root
+
+    return os.path.join(root, 'envs', envname)
+
+
+def _read_package_metadata(metadata_path):
+    '''
+    Read the Name and Version headers from a pip METADATA or PKG-INFO file
+    '''
+    headers = {}
+    with open(metadata_path, 'r', errors='replace') as f:
+        for line in f:
+            if not line.strip():
+                break
+            key, _, value = line.partition(':')
+            if key in ('Name', 'Version') and key not in headers:
+                headers[key] = value.strip()
+
+    return headers.get('Name'), headers.get('Version')
+
+
+DEFAULT_CHANNELS = re.compile(
+    r'^(https?://repo\.(anaconda\.com|continuum\.io)/)?'
+    r'pkgs/(main|r|free|pro|msys2)$')
+'''
+Channels (without subdir) which ``conda env export`` lists as ``defaults``
+'''
+
+
+def _get_channel_name(channel):
+    '''
+    Reduce a conda-meta channel URL to the name ``conda env export`` lists
+    '''
+    channel = channel.rstrip('/')
+    channel = re.sub(r'^https?://conda\.anaconda\.org/', '', channel)
+    channel = channel.rsplit('/', 1)[0] if '/' in channel else channel
+
+    if DEFAULT_CHANNELS.match(channel):
+        return 'defaults'
+
+    return channel
+
+
+def get_versions_from_conda_meta(envname='base'):
+    '''
+    Reads ``conda-meta`` and pip metadata in an environment prefix directly
+
+    Produces the same spec as ``conda env export -n {envname} --json``
+    without starting conda. Conda packages are read from
+    ``<prefix>/conda-meta/*.json``. Pip packages are the ``*.dist-info`` and
+    ``*.egg-info`` entries in site-packages not owned by a conda package.
+
     Parameters
     ----------
     envname : str
         Name of environment to query (default 'base')
-    
+
+    Returns
+    -------
+    spec : dict
+        Environment spec
+
+    Raises
+    ------
+    IOError
+        If the environment prefix has no ``conda-meta`` directory
+    '''
+    prefix = _get_env_prefix(envname)
+    meta_dir = os.path.join(prefix, 'conda-meta')
+
+    if not os.path.isdir(meta_dir):
+        raise IOError('no conda-meta directory in {}'.format(prefix))
+
+    conda_deps = []
+    channels = []
+    conda_files = set()
+
+    for meta_file in sorted(glob.glob(os.path.join(meta_dir, '*.json'))):
+        with open(meta_file, 'r') as f:
+            record = json.load(f)
+
+        conda_deps.append('{}={}={}'.format(
+            record['name'], record['version'], record['build']))
+
+        channel = _get_channel_name(record.get('channel', ''))
+        if channel and channel not in channels:
+            channels.append(channel)
+
+        conda_files.update(record.get('files', []))
+
+    pip_deps = []
+    metadata_files = (
+        glob.glob(os.path.join(
+            prefix, 'lib', 'python*', 'site-packages', '*.dist-info',
+            'METADATA'))
+        + glob.glob(os.path.join(
+            prefix, 'lib', 'python*', 'site-packages', '*.egg-info',
+            'PKG-INFO')))
+
+    for metadata_path in sorted(metadata_files):
+        if os.path.relpath(metadata_path, prefix) in conda_files:
+            continue
+
+        name, version = _read_package_metadata(metadata_path)
+        if name is not None and version is not None:
+            pip_deps.append('{}=={}'.format(name, version))
+
+    dependencies = sorted(conda_deps)
+    if pip_deps:
+        dependencies.append({'pip': sorted(pip_deps)})
+
+    return {
+        'name': envname,
+        'channels': channels,
+        'dependencies': dependencies,
+        'prefix': prefix}
+
+
+def get_versions_in_current_environment(envname='base', use_conda_meta=True):
+    '''
+    Returns the spec of a local environment
+
+    By default, reads the environment's metadata directly with
+    :py:func:`get_versions_from_conda_meta`, falling back to calling
+    ``conda env export -n {envname} --json`` if the prefix cannot be read.
+
+    Parameters
+    ----------
+    envname : str
+        Name of environment to query (default 'base')
+    use_conda_meta : bool
+        Read ``conda-meta`` directly rather than calling conda (default True)
+
     Returns
     -------
     spec : dict
@@ -42,6 +271,12 @@ def get_versions_in_current_environment(envname='base'):
     assert re.match(r'[a-zA-Z0-9]+$', envname), (
         'illegal environment name "{}"'.format(envname))
 
+    if use_conda_meta:
+        try:
+            return get_versions_from_conda_meta(envname)
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
     conn = subprocess.Popen(
         ['conda', 'env', 'export', '-n', envname, '--json'],
         stdout=subprocess.PIPE,
@@ -105,8 +340,26 @@ def _determine_pinned_version(dependency, pinned_versions):
     return pinned_versions.get(dependency.split('=')[0], dependency), comment
 
 
+def _needs_pinkeep(tree, key, comment):
+    '''
+    Whether a pinned dependency should get a new ``# pinkeep`` comment
+
+    Existing ``# pinkeep`` comments are kept, and dependencies which were
+    already pinned to the version in the environment are left alone, so that
+    pinning an already pinned file is a no-op.
+    '''
+    if comment is None:
+        return False
+
+    ct = tree.ca.items.get(key)
+    if ct and ct[0] is not None and 'pinkeep:' in ct[0].value:
+        return False
+
+    return comment != 'pinkeep: {}'.format(tree[key])
+
+
 def pin_dependencies_in_conda_env_file_from_version_spec(
-        filepath, versions_to_pin, dry_run=False):
+        filepath, versions_to_pin, dry_run=False, pinkeep=True):
     '''
     Pin package versions to a given spec
 
@@ -120,45 +373,40 @@ def pin_dependencies_in_conda_env_file_from_version_spec(
     dry_run : bool
         Print the updated environment files, rather than overwriting them. Default
         False.
-    '''
+    pinkeep : bool
+        Add ``# pinkeep`` comments preserving the specs of dependencies which
+        were pinned in the original file. Use False to update the versions in
+        an already pinned file, keeping its existing comments. Default True.
 
-    indent_config = dict(mapping=2, sequence=2, offset=2)
-    
-    yaml = YAML(typ='rt')
-    yaml.indent(**indent_config)
-    yaml.default_flow_style = False
+    Returns
+    -------
+    changed : bool
+        Whether the pinned file differs from the original
+    '''
 
     with open(filepath, 'r') as f:
-        file_spec = yaml.load(f)
+        file_spec = _get_yaml().load(f)
 
     for di, dep in enumerate(file_spec['dependencies']):
         if isinstance(dep, dict):
             for k, v in dep.items():
                 for si, subdep in enumerate(v):
                     pinned, comment = _determine_pinned_version(
-                        subdep, versions_to_pin[k])
+                        subdep, versions_to_pin.get(k, {}))
 
                     file_spec['dependencies'][di][k][si] = pinned
-                    if comment is not None:
+                    if pinkeep and _needs_pinkeep(v, si, comment):
                         file_spec['dependencies'][di][k].yaml_add_eol_comment(
                             comment, si)
         else:
             pinned, comment = _determine_pinned_version(dep, versions_to_pin['conda'])
             file_spec['dependencies'][di] = pinned
-            
-            if comment is not None:
+
+            if pinkeep and _needs_pinkeep(file_spec['dependencies'], di, comment):
                 file_spec['dependencies'].yaml_add_eol_comment(
                     comment, di)
 
-    if dry_run:
-        sys.stdout.write("filename: {}\n{}\n".format(filepath, '-'*50))
-        with YAML(output=sys.stdout) as yaml:
-            yaml.indent(**indent_config)
-            yaml.dump(file_spec)
-        sys.stdout.write("\n")
-    else:
-        with open(filepath, 'w+') as f:
-            yaml.dump(file_spec, f)
+    return _write_env_file(filepath, _render_yaml(file_spec), dry_run=dry_run)
 
 
 def pin_files(environment_files, dry_run=False):
@@ -174,6 +422,14 @@ def pin_files(environment_files, dry_run=False):
     dry_run : bool
         Print the updated environment files, rather than overwriting them. Default
         False.
+
+    Returns
+    -------
+    changed : list
+        Environment files whose pinned contents differ from the original
+
+    Versions are collected from all source environments concurrently. Files
+    are only rewritten if their pinned contents change.
     '''
     environment_specs = {}
     for envfile, envname in environment_files:
@@ -181,14 +437,23 @@ def pin_files(environment_files, dry_run=False):
             environment_specs[envname] = []
         environment_specs[envname].append(envfile)
 
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+        current_versions = dict(zip(
+            environment_specs,
+            pool.map(get_versions_in_current_environment, environment_specs)))
+
+    changed = []
+
     for envname in environment_specs:
-        current_versions = get_versions_in_current_environment(envname)
         formatted_dependencies = parse_conda_dependencies(
-            current_versions.get('dependencies', []))
+            current_versions[envname].get('dependencies', []))
         
         for envfile in environment_specs[envname]:
-            pin_dependencies_in_conda_env_file_from_version_spec(
-                envfile, formatted_dependencies, dry_run=dry_run)
+            if pin_dependencies_in_conda_env_file_from_version_spec(
+                    envfile, formatted_dependencies, dry_run=dry_run):
+                changed.append(envfile)
+
+    return changed
 
 
 def _unpin_dependency(tree, key):
@@ -225,16 +490,15 @@ def unpin_dependencies_in_conda_env_file(filepath, dry_run=False):
         Path to the environment file to unpin
     dry_run : bool, optional
         Print rather than modify the environment file
+
+    Returns
+    -------
+    changed : bool
+        Whether the unpinned file differs from the original
     '''
-    
-    indent_config = dict(mapping=2, sequence=2, offset=2)
-    
-    yaml = YAML(typ='rt')
-    yaml.indent(**indent_config)
-    yaml.default_flow_style = False
 
     with open(filepath, 'r') as f:
-        file_spec = yaml.load(f)
+        file_spec = _get_yaml().load(f)
 
     for di, dep in enumerate(file_spec['dependencies']):
         if isinstance(dep, dict):
@@ -247,15 +511,7 @@ def unpin_dependencies_in_conda_env_file(filepath, dry_run=False):
             file_spec['dependencies'][di] = _unpin_dependency(
                 file_spec['dependencies'], di)
 
-    if dry_run:
-        sys.stdout.write("filename: {}\n{}\n".format(filepath, '-'*50))
-        with YAML(output=sys.stdout) as yaml:
-            yaml.indent(**indent_config)
-            yaml.dump(file_spec)
-        sys.stdout.write("\n")
-    else:
-        with open(filepath, 'w+') as f:
-            yaml.dump(file_spec, f)
+    return _write_env_file(filepath, _render_yaml(file_spec), dry_run=dry_run)
 
 
 def unpin_files(environment_files, dry_run=False):
@@ -271,9 +527,74 @@ def unpin_files(environment_files, dry_run=False):
     dry_run : bool
         Print the updated environment files, rather than overwriting them. Default
         False.
+
+    Returns
+    -------
+    changed : list
+        Environment files whose unpinned contents differ from the original
     '''
-    for envfile, envname in environment_files:
-        unpin_dependencies_in_conda_env_file(envfile, dry_run=dry_run)
+    return [
+        envfile for envfile, envname in environment_files
+        if unpin_dependencies_in_conda_env_file(envfile, dry_run=dry_run)]
+
+
+SPEC_FILES = [
+    ('base', ('base_environment.yml', 'base')),
+    ('notebook', ('notebook/notebook_environment.yml', 'base')),
+    ('octave', ('octave-worker/octave_environment.yml', 'base')),
+    ('r', ('notebook/r_environment.yml', 'r'))]
+'''
+(env type, (environment file, pin source env name)) for each managed env file
+'''
+
+
+def _select_spec_files(file):
+    if file == 'all':
+        return [spec for _, spec in SPEC_FILES]
+
+    for env_type, spec in SPEC_FILES:
+        if file == env_type:
+            return [spec]
+
+    raise ValueError(
+        'env type not recognized: {}'
+        'choose from "base", "notebook", "octave", "r", or "all".'
+        .format(file))
+
+
+def _import_conda_tools():
+    '''
+    Import conda_tools from maintenance_utilities
+
+    Imported on demand, as conda_tools requires the conda python API, which
+    pinning and unpinning do not.
+    '''
+    utils_dir = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'maintenance_utilities')
+
+    if utils_dir not in sys.path:
+        sys.path.append(utils_dir)
+
+    import conda_tools
+    return conda_tools
+
+
+def _select_images(conda_tools, image):
+    if image == 'all':
+        return sorted(conda_tools.DOCKER_IMAGES)
+
+    if image in conda_tools.DOCKER_IMAGES:
+        return [image]
+
+    raise ValueError(
+        'image not recognized: {}. choose from {} or "all".'
+        .format(image, ', '.join(sorted(conda_tools.DOCKER_IMAGES))))
+
+
+def _report_changed(spec_files, changed):
+    for envfile, _ in spec_files:
+        click.echo('{}: {}'.format(
+            envfile, 'updated' if envfile in changed else 'unchanged'))
 
 
 @click.group()
@@ -293,30 +614,14 @@ def pinversions():
 )
 def pin(file, dry_run):
     '''Pin packages in environment files based on environments on the local machine'''
-    
-    spec_files = [
-            ('base_environment.yml', 'base'),
-            ('notebook/notebook_environment.yml', 'base'),
-            ('octave-worker/octave_environment.yml', 'base'),
-            ('notebook/r_environment.yml', 'r')]
-    
-    if file == 'all':
-        pin_files(spec_files, dry_run=dry_run)
-    elif file == 'base':
-        pin_files([spec_files[0]], dry_run=dry_run)
-    elif file == 'notebook':
-        pin_files([spec_files[1]], dry_run=dry_run)
-    elif file == 'octave':
-        pin_files([spec_files[2]], dry_run=dry_run)
-    elif file == 'r':
-        pin_files([spec_files[3]], dry_run=dry_run)
-    else:
-        raise ValueError(
-            'env type not recognized: {}'
-            'choose from "base", "notebook", "octave", "r", or "all".'
-            .format(file))
 
-        
+    spec_files = _select_spec_files(file)
+    changed = pin_files(spec_files, dry_run=dry_run)
+
+    if not dry_run:
+        _report_changed(spec_files, changed)
+
+
 @pinversions.command()
 @click.argument(
     'file', default='all')
@@ -328,28 +633,130 @@ def pin(file, dry_run):
 )
 def unpin(file, dry_run):
     '''Unpin packages in environment files'''
-    
-    spec_files = [
-            ('base_environment.yml', 'base'),
-            ('notebook/notebook_environment.yml', 'base'),
-            ('octave-worker/octave_environment.yml', 'base'),
-            ('notebook/r_environment.yml', 'r')]
-    
-    if file == 'all':
-        unpin_files(spec_files, dry_run=dry_run)
-    elif file == 'base':
-        unpin_files([spec_files[0]], dry_run=dry_run)
-    elif file == 'notebook':
-        unpin_files([spec_files[1]], dry_run=dry_run)
-    elif file == 'octave':
-        unpin_files([spec_files[2]], dry_run=dry_run)
-    elif file == 'r':
-        unpin_files([spec_files[3]], dry_run=dry_run)
-    else:
-        raise ValueError(
-            'env type not recognized: {}'
-            'choose from "base", "notebook", "octave", "r", or "all".'
-            .format(file))
+
+    spec_files = _select_spec_files(file)
+    changed = unpin_files(spec_files, dry_run=dry_run)
+
+    if not dry_run:
+        _report_changed(spec_files, changed)
+
+
+@pinversions.command()
+@click.argument(
+    'image', default='all')
+@click.option(
+    '--no-cache',
+    is_flag=True,
+    default=False,
+    help='solve environments even if a cached solution is available',
+)
+def lock(image, no_cache):
+    '''Solve image environments and write explicit lock files'''
+
+    conda_tools = _import_conda_tools()
+
+    images = _select_images(conda_tools, image)
+
+    solutions = conda_tools.solve_all(
+        conda_tools.get_image_solvers(images),
+        cache=None if no_cache else conda_tools.SolveCache())
+
+    paths = conda_tools.write_lock_files(solutions)
+
+    for img, envs in sorted(paths.items()):
+        for env, path in sorted(envs.items()):
+            click.echo('{}:{}: {}'.format(img, env, path))
+
+
+@pinversions.command()
+@click.argument(
+    'image', default='all')
+@click.option(
+    '--refresh-index',
+    is_flag=True,
+    default=False,
+    help='fetch fresh repodata rather than using conda\'s cached index',
+)
+def diff(image, refresh_index):
+    '''Show the changes unpinning and re-solving each image would make'''
+
+    if not refresh_index:
+        os.environ['CONDA_USE_INDEX_CACHE'] = 'true'
+
+    conda_tools = _import_conda_tools()
+
+    if not refresh_index:
+        from conda.base.context import reset_context
+        reset_context()
+
+    images = _select_images(conda_tools, image)
+
+    changes = conda_tools.diff_unpinned_solutions(
+        images, cache=conda_tools.SolveCache())
+
+    for img, envs in sorted(changes.items()):
+        for env, env_changes in sorted(envs.items()):
+            click.echo('{}:{}\n{}\n'.format(img, env, '=' * 50))
+            click.echo(conda_tools.format_changelog(env_changes))
+            click.echo('')
+
+
+@pinversions.command()
+@click.option(
+    '--dry-run',
+    is_flag=True,
+    default=False,
+    help='print proposed spec rather than modifying it',
+)
+@click.option(
+    '--keep-pins',
+    is_flag=True,
+    default=False,
+    help='align the currently pinned specs rather than unpinning first',
+)
+def align(dry_run, keep_pins):
+    '''Co-solve paired notebook/worker environments and pin aligned versions'''
+
+    conda_tools = _import_conda_tools()
+
+    manifests = {}
+    solvers = conda_tools.get_image_solvers(manifests=manifests)
+
+    if not keep_pins:
+        for img, envs in solvers.items():
+            for env, solver in envs.items():
+                env_files = [
+                    f for f in manifests[img][env]
+                    if not os.path.basename(f).startswith('Dockerfile')]
+                envs[env] = conda_tools.unpin_solver(
+                    solver, conda_tools.get_pinkeep_specs(env_files))
+
+    solutions = conda_tools.co_solve(
+        solvers, conda_tools.ENV_PAIRINGS, cache=conda_tools.SolveCache())
+
+    env_file_solutions = conda_tools.get_env_file_solutions(
+        manifests, solutions)
+
+    spec_files = []
+    changed = []
+
+    for envfile, _ in _select_spec_files('all'):
+        records = env_file_solutions.get(os.path.abspath(envfile))
+        if records is None:
+            continue
+
+        versions = parse_conda_dependencies([
+            '{}={}={}'.format(r.name, r.version, r.build) for r in records])
+
+        spec_files.append((envfile, None))
+        # the files are already pinned: update versions in place, keeping
+        # existing pinkeep and block comments
+        if pin_dependencies_in_conda_env_file_from_version_spec(
+                envfile, versions, dry_run=dry_run, pinkeep=False):
+            changed.append(envfile)
+
+    if not dry_run:
+        _report_changed(spec_files, changed)
 
 
 if __name__ == "__main__":
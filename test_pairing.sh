@@ -14,8 +14,9 @@ docker run --net="host" -d $NOTEBOOK_TAG start.sh /opt/conda/bin/dask-scheduler
 #
 # you should have a valid connection, but no workers yet
 
-# start worker
+# start workers (two, so worker-to-worker transfers can be benchmarked)
 docker run --net="host" -d $WORKER_TAG dask-worker localhost:8786 --worker-port 8666 --nanny-port 8785 &
+docker run --net="host" -d $WORKER_TAG dask-worker localhost:8786 --worker-port 8667 --nanny-port 8784 &
 
 # at this point, if you run `client` again, you should see
 # a worker connected to the client! You can now run any
@@ -32,8 +33,14 @@ docker cp notebook_test.py tester:/usr/bin
 # start the tester image
 docker start tester
 
-# run test suite
-docker exec tester python /usr/bin/notebook_test.py
+# copy previous benchmark results in, so the new tag is compared against them
+if [ -f benchmarks.json ]; then
+    docker cp benchmarks.json tester:/tmp/benchmarks.json
+fi
+
+# run test suite and benchmarks
+docker exec tester python /usr/bin/notebook_test.py --tag "$NOTEBOOK_TAG" --output /tmp/benchmarks.json
+docker cp tester:/tmp/benchmarks.json benchmarks.json
 
 echo "closing containers"
 docker stop $(docker ps -q);
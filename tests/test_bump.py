@@ -0,0 +1,89 @@
+from __future__ import absolute_import
+
+import os
+import sys
+import json
+
+if os.path.isfile('../bump.py'):
+    sys.path.append('..')
+elif os.path.isfile('bump.py'):
+    sys.path.append('.')
+
+import bump
+
+
+def _make_repo(tmpdir, monkeypatch):
+    tmpdir.join('base_environment.yml').write('name: base\n')
+
+    worker = tmpdir.mkdir('worker')
+    worker.join('Dockerfile').write(
+        'FROM ubuntu\n'
+        'COPY base_environment.yml \\\n'
+        '    prepare.sh /usr/bin/\n'
+        'COPY --from=builder /opt /opt\n')
+    worker.join('prepare.sh').write('#!/bin/bash\n')
+
+    notebook = tmpdir.mkdir('notebook')
+    notebook.join('Dockerfile').write(
+        'FROM jupyter/base-notebook\n'
+        'COPY ["worker-template.yml", "/pre-home"]\n')
+    notebook.join('worker-template.yml').write(
+        'spec:\n  containers:\n  - image: rhodium/worker:2020-06-12.01\n')
+
+    monkeypatch.setattr(bump, 'REPO_ROOT', str(tmpdir))
+    monkeypatch.setattr(bump, 'IMAGES', {
+        'notebook': ['notebook/Dockerfile'],
+        'worker': ['worker/Dockerfile']})
+    monkeypatch.setattr(bump, 'IMAGE_DEPENDENCIES', {'notebook': ['worker']})
+
+
+def test_copy_sources_fall_back_to_repo_root(tmpdir, monkeypatch):
+    _make_repo(tmpdir, monkeypatch)
+
+    sources = bump.get_copy_sources(str(tmpdir.join('worker', 'Dockerfile')))
+
+    assert [os.path.relpath(s, str(tmpdir)) for s in sources] == [
+        'base_environment.yml', os.path.join('worker', 'prepare.sh')]
+
+
+def test_manifest_tracks_changes_and_dependencies(tmpdir, monkeypatch):
+    _make_repo(tmpdir, monkeypatch)
+    manifest_file = str(tmpdir.join('image_manifest.json'))
+
+    manifest, changed = bump.update_image_manifest(
+        '2020-06-12.01', manifest_file)
+    assert changed == {'notebook': True, 'worker': True}
+
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f)
+
+    # bumping the worker tag in the template doesn't change the notebook
+    template = tmpdir.join('notebook', 'worker-template.yml')
+    template.write(template.read().replace('2020-06-12.01', '2020-06-13.01'))
+
+    manifest, changed = bump.update_image_manifest(
+        '2020-06-13.01', manifest_file)
+    assert changed == {'notebook': False, 'worker': False}
+    assert manifest['images']['notebook']['built_tag'] == '2020-06-12.01'
+
+    # a worker change rebuilds the notebook, which launches workers by tag
+    tmpdir.join('worker', 'prepare.sh').write('#!/bin/bash\nexec "$@"\n')
+
+    manifest, changed = bump.update_image_manifest(
+        '2020-06-13.02', manifest_file)
+    assert changed == {'notebook': True, 'worker': True}
+
+
+def test_manifest_without_built_tag_rebuilds(tmpdir, monkeypatch):
+    _make_repo(tmpdir, monkeypatch)
+    manifest_file = str(tmpdir.join('image_manifest.json'))
+
+    with open(manifest_file, 'w') as f:
+        json.dump({'images': {
+            'worker': {'hash': bump.hash_image_inputs('worker')}}}, f)
+
+    manifest, changed = bump.update_image_manifest(
+        '2020-06-13.01', manifest_file)
+
+    assert changed['worker']
+    assert manifest['images']['worker']['built_tag'] == '2020-06-13.01'
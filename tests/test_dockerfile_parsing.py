@@ -0,0 +1,78 @@
+from __future__ import absolute_import
+
+import os
+import sys
+
+if os.path.isdir('../maintenance_utilities'):
+    sys.path.append('../maintenance_utilities')
+elif os.path.isdir('maintenance_utilities'):
+    sys.path.append('maintenance_utilities')
+
+import conda_tools
+
+DOCKERFILE = '''\
+ARG BASE_TAG=latest
+FROM rhodium/worker:${BASE_TAG} AS build
+ENV SPECS=/opt/conda/specs
+
+# comments inside continuations are dropped
+RUN mkdir $SPECS && \\
+  # make the specs directory
+  conda config --add channels conda-forge
+COPY octave_environment.yml ${SPECS}
+RUN sed -ri "s#a#b#" /etc/sudoers && \\
+    conda env update -f /opt/conda/specs/octave_environment.yml
+'''
+
+
+def test_parse_dockerfile(tmpdir):
+    dockerfile = tmpdir.join('Dockerfile')
+    dockerfile.write(DOCKERFILE)
+
+    parsed = conda_tools.parse_dockerfile(
+        str(dockerfile), build_args={'BASE_TAG': 'abc123'})
+
+    assert parsed.global_args == {'BASE_TAG': 'abc123'}
+    assert len(parsed.stages) == 1
+
+    stage = parsed.stages[0]
+    assert (stage.base, stage.name) == ('rhodium/worker:abc123', 'build')
+    assert stage.env['SPECS'] == '/opt/conda/specs'
+
+    instructions = stage.instructions
+    assert [i.instruction for i in instructions] == [
+        'ENV', 'RUN', 'COPY', 'RUN']
+
+    assert instructions[1].lineno == 6
+    assert instructions[1].commands == [
+        ['mkdir', '/opt/conda/specs'],
+        ['conda', 'config', '--add', 'channels', 'conda-forge']]
+
+    assert instructions[2].args == [
+        'octave_environment.yml', '/opt/conda/specs']
+
+    assert instructions[3].commands[0] == [
+        'sed', '-ri', 's#a#b#', '/etc/sudoers']
+
+    # parse results are cached by content hash, and callers get a copy
+    stage.env['SPECS'] = '/tmp'
+    instructions.pop()
+
+    reparsed = conda_tools.parse_dockerfile(
+        str(dockerfile), build_args={'BASE_TAG': 'abc123'})
+
+    assert reparsed.stages[0].env['SPECS'] == '/opt/conda/specs'
+    assert len(reparsed.stages[0].instructions) == 4
+
+
+def test_copy_into_directory_is_in_scope(tmpdir):
+    tmpdir.join('octave_environment.yml').write(
+        'name: base\nchannels:\n  - conda-forge\n'
+        'dependencies:\n  - oct2py=5.0.4=py_0\n')
+
+    dockerfile = tmpdir.join('Dockerfile')
+    dockerfile.write(DOCKERFILE)
+
+    envs = conda_tools.get_conda_specs(str(dockerfile))
+
+    assert [s.name for s in envs['base'].specs_to_add] == ['oct2py']
@@ -0,0 +1,111 @@
+from __future__ import absolute_import
+
+import os
+import sys
+import json
+import time
+
+if os.path.isfile('../entrypoint.py'):
+    sys.path.append('..')
+elif os.path.isfile('entrypoint.py'):
+    sys.path.append('.')
+
+import entrypoint
+
+
+def test_worker_phases_follow_env_contract():
+    env = {
+        'EXTRA_PIP_PACKAGES': 'rhg_compute_tools',
+        'GCSFUSE_TOKENS': '{}',
+        'EXTRA_PACKAGES_DIR': '/gcs/bucket/extra/0123',
+        'SQL_TOKEN': '{}',
+        'GOOGLE_APPLICATION_CREDENTIALS': '/opt/creds.json'}
+
+    phases = {p.name: p.requires for p in entrypoint.get_worker_phases(env)}
+
+    # SQL_TOKEN without SQL_INSTANCE doesn't start a proxy
+    assert sorted(phases) == [
+        'extra_packages_cache',
+        'extra_pip_packages',
+        'gcloud_auth',
+        'gcsfuse_credentials',
+        'gcsfuse_mounts']
+
+    assert phases['gcsfuse_mounts'] == ('gcsfuse_credentials',)
+    assert 'gcsfuse_mounts' in phases['extra_packages_cache']
+    assert entrypoint.get_worker_phases({}) == []
+
+
+def test_run_phases_concurrently_in_dependency_order(tmpdir):
+    finished = []
+
+    def phase(name, seconds=0.2, fail=False):
+        def func():
+            time.sleep(seconds)
+            finished.append(name)
+            if fail:
+                raise RuntimeError('{} failed'.format(name))
+        return func
+
+    phases = [
+        entrypoint.Phase('credentials', phase('credentials', fail=True), ()),
+        entrypoint.Phase('mounts', phase('mounts'), ('credentials',)),
+        entrypoint.Phase('packages', phase('packages'), ('mounts',)),
+        entrypoint.Phase('sql_proxy', phase('sql_proxy'), ()),
+        entrypoint.Phase('gcloud_auth', phase('gcloud_auth'), ('missing',)),
+        entrypoint.Phase('worker_template', phase('worker_template'), (
+            'sql_proxy',))]
+
+    timings = entrypoint.run_phases(phases)
+
+    # phases which depend on a failed phase, directly or not, are skipped
+    assert timings['credentials']['status'] == 'error'
+    assert timings['mounts']['status'] == 'skipped'
+    assert timings['packages']['status'] == 'skipped'
+    assert 'mounts' not in finished
+    assert 'packages' not in finished
+
+    assert finished.index('sql_proxy') < finished.index('worker_template')
+    assert timings['worker_template']['status'] == 'ok'
+    assert timings['worker_template']['start'] >= timings[
+        'sql_proxy']['seconds']
+
+    # independent phases overlap
+    assert timings['sql_proxy']['start'] < 0.1
+    assert timings['gcloud_auth']['start'] < 0.1
+
+
+def test_prepare_writes_timing_record(tmpdir, capsys):
+    timing_file = tmpdir.join('timing.json')
+
+    record = entrypoint.prepare('worker', env={}, timing_file=str(timing_file))
+
+    stdout = capsys.readouterr().out
+    assert json.loads(stdout) == json.loads(timing_file.read())
+    assert json.loads(stdout)['startup_timing']['phases'] == {}
+    assert record['image'] == 'worker'
+    assert record['started'].endswith('Z')
+
+
+def test_notebook_restart_without_dask_config(tmpdir, monkeypatch):
+    pre_home = tmpdir.mkdir('pre-home')
+    home = tmpdir.mkdir('home')
+    pre_home.join('worker-template.yml').write('{}\n')
+
+    commands = []
+    monkeypatch.setattr(entrypoint, 'PRE_HOME', str(pre_home))
+    monkeypatch.setattr(entrypoint, 'HOME', str(home))
+    monkeypatch.setattr(entrypoint, 'run', lambda *args: commands.append(args))
+
+    # a restarted container's /pre-home/config.yaml was removed on first start
+    phases = [
+        p for p in entrypoint.get_notebook_phases({})
+        if p.name in ('dask_config', 'pre_home', 'worker_template_credentials')]
+
+    timings = entrypoint.run_phases(phases)
+
+    assert all(t['status'] == 'ok' for t in timings.values())
+    assert ('cp', '--update', '-r', '-v', str(pre_home) + '/.', str(home)) in (
+        commands)
+    assert not any(c[0] == 'sudo' for c in commands)
+    assert commands[-1][0] == sys.executable
@@ -0,0 +1,112 @@
+from __future__ import absolute_import
+
+import os
+import sys
+import json
+
+if os.path.isfile('../extra_packages.py'):
+    sys.path.append('..')
+elif os.path.isfile('extra_packages.py'):
+    sys.path.append('.')
+
+import extra_packages
+
+EXPLICIT = '''\
+@EXPLICIT
+https://conda.anaconda.org/conda-forge/linux-64/numpy-1.17.3-py37h95a1406_0.tar.bz2#def
+https://conda.anaconda.org/conda-forge/noarch/zarr-2.4.0-py_0.tar.bz2#abc
+'''
+
+
+def test_cache_key_tracks_list_and_requirements():
+    key = extra_packages.get_cache_key(EXPLICIT, ['foo==1.0'])
+
+    assert key == extra_packages.get_cache_key(EXPLICIT, ['foo==1.0'])
+    assert key != extra_packages.get_cache_key(EXPLICIT, ['foo==1.1'])
+    assert key != extra_packages.get_cache_key(
+        EXPLICIT.replace('#abc', '#abd'), ['foo==1.0'])
+
+
+def test_install_skips_installed_packages(tmpdir):
+    meta = tmpdir.mkdir('conda-meta')
+    meta.join('numpy-1.17.3-py37h95a1406_0.json').write(json.dumps({
+        'fn': 'numpy-1.17.3-py37h95a1406_0.tar.bz2'}))
+
+    installed = extra_packages.get_installed_filenames(str(tmpdir))
+    assert installed == {'numpy-1.17.3-py37h95a1406_0.tar.bz2'}
+
+    missing = extra_packages.get_missing_packages(
+        EXPLICIT, '/gcs/bucket/extra/0123', installed)
+
+    assert missing == (
+        '@EXPLICIT\n'
+        'file:///gcs/bucket/extra/0123/pkgs/zarr-2.4.0-py_0.tar.bz2#abc\n')
+
+    installed.add('zarr-2.4.0-py_0.tar.bz2')
+
+    assert extra_packages.get_missing_packages(
+        EXPLICIT, '/gcs/bucket/extra/0123', installed) is None
+
+
+def test_conda_only_resolve_keeps_pip_extras(tmpdir):
+    import yaml
+
+    template = tmpdir.join('worker-template.yml')
+    template.write(yaml.dump({'spec': {'containers': [{'env': [
+        {'name': 'EXTRA_CONDA_PACKAGES', 'value': 'zarr'},
+        {'name': 'EXTRA_PIP_PACKAGES', 'value': 'rhg_compute_tools'},
+        {'name': 'EXTRA_PACKAGES_DIR', 'value': '/gcs/bucket/extra/old'}]}]}}))
+
+    extra_packages.add_to_worker_template(
+        '/gcs/bucket/extra/0123', str(template), conda=True, pip=False)
+
+    env = yaml.safe_load(template.read())['spec']['containers'][0]['env']
+
+    assert env == [
+        {'name': 'EXTRA_PIP_PACKAGES', 'value': 'rhg_compute_tools'},
+        {'name': 'EXTRA_PACKAGES_DIR', 'value': '/gcs/bucket/extra/0123'}]
+
+
+def test_explicit_list_keeps_record_order():
+    import collections
+
+    Record = collections.namedtuple('Record', ['name', 'url', 'md5'])
+    records = [
+        Record('zarr', 'https://conda.anaconda.org/conda-forge/noarch/'
+               'zarr-2.4.0-py_0.tar.bz2', 'abc'),
+        Record('numpy', 'https://conda.anaconda.org/conda-forge/linux-64/'
+               'numpy-1.17.3-py37h95a1406_0.tar.bz2', 'def')]
+
+    assert [u for u, _ in extra_packages.parse_explicit(
+        extra_packages.format_explicit(records))] == [r.url for r in records]
+
+
+def test_resolve_writes_entry_in_place(tmpdir, monkeypatch):
+    cache_dir = tmpdir.mkdir('extra')
+    key = extra_packages.get_cache_key(
+        extra_packages.format_explicit([]), [])
+
+    # left by an interrupted resolve
+    cache_dir.mkdir(key).join(extra_packages.EXPLICIT_FILE).write('partial')
+
+    def populate(target, records, requirements):
+        assert records == [] and requirements == []
+        os.makedirs(os.path.join(target, extra_packages.PKGS_DIR))
+
+    monkeypatch.setattr(extra_packages, '_populate_cache', populate)
+
+    entry = extra_packages.resolve([], [], str(cache_dir))
+
+    assert entry == str(cache_dir.join(key))
+    assert sorted(os.listdir(entry)) == [
+        extra_packages.COMPLETE_FILE, extra_packages.EXPLICIT_FILE,
+        extra_packages.PKGS_DIR, extra_packages.REQUIREMENTS_FILE]
+    assert cache_dir.join(key, extra_packages.EXPLICIT_FILE).read() == (
+        '@EXPLICIT\n')
+
+    def populate_again(*args):
+        raise AssertionError('complete entries are reused')
+
+    monkeypatch.setattr(extra_packages, '_populate_cache', populate_again)
+
+    assert extra_packages.resolve([], [], str(cache_dir)) == entry
@@ -0,0 +1,46 @@
+from __future__ import absolute_import
+
+import os
+import sys
+
+from conda.models.records import PackageRecord
+
+if os.path.isdir('../maintenance_utilities'):
+    sys.path.append('../maintenance_utilities')
+elif os.path.isdir('maintenance_utilities'):
+    sys.path.append('maintenance_utilities')
+
+import conda_tools
+
+
+def _record(name, size, depends=()):
+    return PackageRecord(
+        name=name, version='1.0', build='0', build_number=0,
+        channel='conda-forge', subdir='linux-64', size=size,
+        depends=list(depends), fn='{}-1.0-0.tar.bz2'.format(name))
+
+
+def test_spec_weights(tmpdir):
+    records = [
+        _record('xarray', 10, ['numpy', 'pandas']),
+        _record('pandas', 20, ['numpy >=1.13']),
+        _record('numpy', 40, ['libblas']),
+        _record('libblas', 80),
+        _record('fiona', 160, ['gdal']),
+        _record('gdal', 320, ['numpy'])]
+
+    weights = conda_tools.get_spec_weights(
+        records, ['xarray', 'fiona=1.0'], pkgs_dirs=[str(tmpdir)])
+
+    assert [w['name'] for w in weights] == ['fiona', 'xarray']
+
+    fiona, xarray = weights
+
+    assert fiona['download_size'] == 160 + 320 + 40 + 80
+    assert fiona['exclusive'] == ['fiona', 'gdal']
+    assert fiona['exclusive_download_size'] == 480
+    assert fiona['shared'] == ['libblas', 'numpy']
+    assert fiona['installed_size'] is None
+
+    assert xarray['exclusive'] == ['pandas', 'xarray']
+    assert xarray['exclusive_download_size'] == 30
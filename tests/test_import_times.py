@@ -0,0 +1,71 @@
+from __future__ import absolute_import
+
+import os
+import sys
+
+if os.path.isdir('../maintenance_utilities'):
+    sys.path.append('../maintenance_utilities')
+elif os.path.isdir('maintenance_utilities'):
+    sys.path.append('maintenance_utilities')
+
+import import_times
+
+IMPORTTIME = '''\
+import time: self [us] | cumulative | imported package
+import time:       120 |        120 |   _json
+import time:      1500 |       1620 | json
+import time:       300 |        300 |     numbers
+import time:      4000 |       4300 |   decimal
+import time:       200 |       4500 | fractions
+'''
+
+
+def test_parse_importtime_keeps_top_level_imports():
+    assert import_times.parse_importtime(IMPORTTIME) == {
+        'json': 1620, 'fractions': 4500}
+
+
+def test_check_regressions():
+    baseline = {
+        'dask': {'cumulative_ms': 200.0},
+        'xarray': {'cumulative_ms': 400.0},
+        'tiny': {'cumulative_ms': 1.0},
+        'broken': {'error': 'ImportError'}}
+
+    results = {
+        'dask': {'cumulative_ms': 210.0},
+        'xarray': {'cumulative_ms': 500.0},
+        'tiny': {'cumulative_ms': 3.0},
+        'broken': {'cumulative_ms': 50.0}}
+
+    # tiny is 200% slower, but by less than min_ms
+    assert import_times.check_regressions(results, baseline) == [
+        ('xarray', 400.0, 500.0, 0.25)]
+
+    assert import_times.check_regressions(
+        results, baseline, threshold=0.1) == [
+            ('xarray', 400.0, 500.0, 0.25),
+            ('(total)', 601.0, 713.0, 112.0 / 601.0)]
+
+
+def test_new_import_errors_fail_the_check():
+    baseline = {
+        'dask': {'cumulative_ms': 200.0},
+        'broken': {'error': 'ImportError'}}
+
+    results = {
+        'dask': {'error': 'ImportError: cannot import name tokenize'},
+        'broken': {'error': 'ImportError'},
+        'new': {'error': 'ModuleNotFoundError'}}
+
+    assert import_times.check_regressions(results, baseline) == []
+    assert import_times.check_errors(results, baseline) == [
+        ('dask', 'ImportError: cannot import name tokenize'),
+        ('new', 'ModuleNotFoundError')]
+
+
+def test_time_import_reports_silent_failures():
+    # exits 1 without writing to stderr, as when killed by a signal
+    result = import_times.time_import(['json'], python='false', repeat=1)
+
+    assert result == {'modules': ['json'], 'error': 'exited with 1'}
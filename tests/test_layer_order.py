@@ -0,0 +1,63 @@
+from __future__ import absolute_import
+
+import os
+import sys
+
+if os.path.isdir('../maintenance_utilities'):
+    sys.path.append('../maintenance_utilities')
+elif os.path.isdir('maintenance_utilities'):
+    sys.path.append('maintenance_utilities')
+
+import layer_order
+
+DOCKERFILE = '''\
+FROM rhodium/worker:latest
+RUN mkdir /tempdir
+COPY common.sh /tempdir
+COPY prepare.sh /usr/bin
+COPY environment.yml /opt/conda/specs/environment.yml
+
+# perform a bunch of common actions
+RUN bash /tempdir/common.sh
+RUN conda env update -f /opt/conda/specs/environment.yml
+RUN conda clean --all -f
+
+ENTRYPOINT ["tini", "--", "/usr/bin/prepare.sh"]
+'''
+
+
+def test_volatile_copies_move_after_heavy_layers(tmpdir, monkeypatch):
+    tmpdir.join('common.sh').write('chmod +x /usr/bin/prepare.sh\n')
+    tmpdir.join('prepare.sh').write('$@\n')
+    tmpdir.join('environment.yml').write('name: base\n')
+    dockerfile = tmpdir.join('Dockerfile')
+    dockerfile.write(DOCKERFILE)
+
+    monkeypatch.setattr(
+        layer_order, 'get_change_counts',
+        lambda root, max_commits: {
+            'common.sh': 1, 'prepare.sh': 10, 'environment.yml': 5})
+
+    proposed, before, after = layer_order.optimize_dockerfile(
+        str(dockerfile), root=str(tmpdir))
+
+    # prepare.sh is chmod-ed by common.sh, so it cannot move past it, and the
+    # environment file must be copied in before it is used
+    assert proposed == '''\
+FROM rhodium/worker:latest
+RUN mkdir /tempdir
+COPY common.sh /tempdir
+COPY prepare.sh /usr/bin
+
+# perform a bunch of common actions
+RUN bash /tempdir/common.sh
+COPY environment.yml /opt/conda/specs/environment.yml
+RUN conda env update -f /opt/conda/specs/environment.yml
+RUN conda clean --all -f
+
+ENTRYPOINT ["tini", "--", "/usr/bin/prepare.sh"]
+'''
+
+    assert (
+        layer_order.get_rebuild_cost(after)
+        < layer_order.get_rebuild_cost(before))
@@ -0,0 +1,41 @@
+from __future__ import absolute_import
+
+import os
+import sys
+import collections
+
+if os.path.isdir('../maintenance_utilities'):
+    sys.path.append('../maintenance_utilities')
+elif os.path.isdir('maintenance_utilities'):
+    sys.path.append('maintenance_utilities')
+
+import conda_tools
+
+Record = collections.namedtuple('Record', ['name', 'url', 'md5'])
+
+# records without an md5 attribute, as for package records from sources
+# other than the solver
+UnhashedRecord = collections.namedtuple('UnhashedRecord', ['name', 'url'])
+
+
+def _url(name, version):
+    return (
+        'https://conda.anaconda.org/conda-forge/noarch/'
+        '{}-{}-py_0.tar.bz2'.format(name, version))
+
+
+def test_lock_keeps_solver_order():
+    records = [
+        Record('python', _url('python', '3.7.6'), 'abc'),
+        Record('toolz', _url('toolz', '0.11.1'), None),
+        UnhashedRecord('dask', _url('dask', '2.8.1'))]
+
+    lock = conda_tools.format_explicit_lock(records, platform='linux-64')
+
+    assert lock.splitlines()[-4:] == [
+        '@EXPLICIT',
+        _url('python', '3.7.6') + '#abc',
+        _url('toolz', '0.11.1'),
+        _url('dask', '2.8.1')]
+
+    assert '# platform: linux-64' in lock.splitlines()
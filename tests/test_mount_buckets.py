@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+
+import os
+import sys
+
+if os.path.isfile('../mount_buckets.py'):
+    sys.path.append('..')
+elif os.path.isfile('mount_buckets.py'):
+    sys.path.append('.')
+
+import mount_buckets
+
+# stands in for gcsfuse: "mounts" by dropping a marker in the mount point, and
+# fails its first attempt for buckets named flaky-*
+FAKE_GCSFUSE = '''\
+#!/bin/sh
+bucket="$2"
+mountpoint="$3"
+case "$bucket" in
+    flaky-*)
+        if [ ! -f "$mountpoint.tried" ]; then
+            touch "$mountpoint.tried"
+            echo "transient error"
+            exit 1
+        fi;;
+    hung-*)
+        sleep 10;;
+esac
+touch "$mountpoint/.mounted"
+'''
+
+
+def _is_mounted(mountpoint):
+    return os.path.isfile(os.path.join(mountpoint, '.mounted'))
+
+
+def _setup(tmpdir, buckets):
+    gcsfuse = tmpdir.join('gcsfuse')
+    gcsfuse.write(FAKE_GCSFUSE)
+    gcsfuse.chmod(0o755)
+
+    tokens = tmpdir.mkdir('tokens')
+    for bucket in buckets:
+        tokens.join('{}.json'.format(bucket)).write('{}')
+
+    return str(gcsfuse), str(tokens), str(tmpdir.mkdir('gcs'))
+
+
+def test_mount_all(tmpdir):
+    gcsfuse, tokens, gcs = _setup(
+        tmpdir, ['bucket-a', 'bucket-b', 'flaky-c', 'hung-d', 'existing'])
+
+    mounts = tmpdir.join('mounts')
+    mounts.write(
+        'gcsfuse {} fuse.gcsfuse rw,nosuid,nodev 0 0\n'.format(
+            os.path.join(gcs, 'existing')))
+
+    results = mount_buckets.mount_all(
+        token_dir=tokens,
+        mount_root=gcs,
+        gcsfuse=gcsfuse,
+        timeout=1,
+        retries=1,
+        mounts_file=str(mounts),
+        is_mounted=_is_mounted)
+
+    status = {r.bucket: (r.status, r.attempts) for r in results}
+
+    assert status == {
+        'bucket-a': ('mounted', 1),
+        'bucket-b': ('mounted', 1),
+        'existing': ('already mounted', 0),
+        'flaky-c': ('mounted', 2),
+        'hung-d': ('failed', 2)}
+
+    # timeouts for the hung bucket overlap with the other mounts
+    assert max(r.seconds for r in results) < 4
+
+
+def test_get_mountpoints_unescapes_paths(tmpdir):
+    mounts = tmpdir.join('mounts')
+    mounts.write(
+        'proc /proc proc rw 0 0\n'
+        'gcsfuse /gcs/my\\040bucket fuse.gcsfuse rw 0 0\n')
+
+    assert mount_buckets.get_mountpoints(str(mounts)) == {
+        '/proc', '/gcs/my bucket'}
@@ -0,0 +1,72 @@
+from __future__ import absolute_import
+
+import os
+import sys
+import json
+
+if os.path.isfile('../notebook_test.py'):
+    sys.path.append('..')
+elif os.path.isfile('notebook_test.py'):
+    sys.path.append('.')
+
+import notebook_test
+
+
+def _results(throughput, latency):
+    return {
+        'submission_throughput': {'tasks_per_second': throughput},
+        'scheduler_latency': {'mean_ms': latency, 'samples': 100}}
+
+
+def test_save_results_merges_tags(tmpdir):
+    path = str(tmpdir.join('benchmarks.json'))
+
+    notebook_test.save_results(path, 'old', _results(100.0, 2.0))
+    all_results = notebook_test.save_results(path, 'new', _results(1, 1))
+
+    with open(path, 'r') as f:
+        assert json.load(f) == all_results
+
+    assert sorted(all_results) == ['new', 'old']
+    assert all_results['old']['results'] == _results(100.0, 2.0)
+    assert all_results['new']['versions']['dask'] == (
+        notebook_test.dask.__version__)
+
+    # a corrupt results file is started over
+    tmpdir.join('benchmarks.json').write('{')
+    assert sorted(notebook_test.save_results(
+        path, 'new', _results(1, 1))) == ['new']
+
+
+def test_compare_results():
+    all_results = {
+        'first': {
+            'timestamp': '2020-06-12T00:00:00+00:00',
+            'results': _results(50.0, 1.0)},
+        'previous': {
+            'timestamp': '2020-06-13T00:00:00+00:00',
+            'results': _results(100.0, 2.0)},
+        'current': {
+            'timestamp': '2020-06-14T00:00:00+00:00',
+            'results': _results(150.0, 3.0)}}
+
+    assert notebook_test.compare_results(
+        {'current': all_results['current']}, 'current') is None
+
+    # compared with the most recent other tag by default
+    lines = notebook_test.compare_results(all_results, 'current').splitlines()
+
+    assert lines[0].split() == ['metric', 'previous', 'current', 'change']
+
+    # higher throughput is an improvement, higher latency a regression, and
+    # counts aren't compared
+    assert [line.split() for line in lines[1:]] == [
+        ['scheduler_latency.mean_ms', '2.00', '3.00', '-50.0%'],
+        ['submission_throughput.tasks_per_second', '100.00', '150.00',
+         '+50.0%']]
+
+    lines = notebook_test.compare_results(
+        all_results, 'current', baseline='first').splitlines()
+
+    assert lines[0].split()[1] == 'first'
+    assert lines[1].split()[-1] == '-200.0%'
@@ -5,7 +5,9 @@ import os
 import re
 import sys
 import pprint
+import warnings
 import conda.core.solve
+import conda.models.records
 import pytest
 
 if os.path.isdir('../maintenance_utilities'):
@@ -20,7 +22,7 @@ PKG_ROOT = os.path.dirname(os.path.dirname(__file__))
 IMAGES_TO_CHECK = {
     'notebook': ['notebook/Dockerfile'],
     'worker': ['worker/Dockerfile'],
-    'octave': ['octave-worker/Dockerfile'],
+    'octave-worker': ['worker/Dockerfile', 'octave-worker/Dockerfile'],
     }
 
 
@@ -33,7 +35,8 @@ PAIRINGS
 
 A  list of tuples of (notebook image, notebook env, worker image, worker env)
 pairings. For each pairing, all packages will be tested against each other to
-ensure we don't have any dependency conflicts.
+ensure we don't have any dependency conflicts. All pairings are checked in a
+single pass by :py:func:`conda_tools.align_environments`.
 
 '''
 
@@ -53,6 +56,15 @@ def package_spec():
     This solution is time consuming and catches package specification errors,
     dependency and build conflicts, channel specification errors, and other
     things that can go wrong in the process of specifying environments.
+    Solutions are stored in a :py:class:`conda_tools.SolveCache`, so unchanged
+    environments are only solved once per repodata update, and all cache
+    misses are solved concurrently with :py:func:`conda_tools.solve_all`.
+    Images whose Dockerfiles and environment files are unchanged since their
+    last successful solve are not solved at all (see
+    :py:class:`conda_tools.ManifestStore`).
+    If ``CONDA_TOOLS_REPODATA_SNAPSHOT`` is set, environments are solved
+    against that pruned local snapshot of the channels, with no network (see
+    :py:class:`conda_tools.RepodataSnapshot`).
 
     Once all image environments have been solved, the resulting nested dict
     is yielded as a package spec that can be used in other unit tests, such
@@ -80,51 +92,189 @@ def package_spec():
 
     '''
 
+    solvers = {}
+    manifests = {}
     specs = {}
 
+    store = conda_tools.ManifestStore()
+
     for img_name, dockerfiles in IMAGES_TO_CHECK.items():
         dockerfiles = [os.path.join(PKG_ROOT, fp) for fp in dockerfiles]
-        specs[img_name] = {}
+        manifests[img_name] = {}
 
         envs = (
             conda_tools
-            .build_final_envs_for_multiple_docker_files(dockerfiles))
+            .build_final_envs_for_multiple_docker_files(
+                dockerfiles, manifest=manifests[img_name]))
+
+        previous = store.get(img_name, manifests[img_name])
+        if previous is not None:
+            specs[img_name] = previous
+        else:
+            solvers[img_name] = envs
+
+    # solve offline against a pruned repodata snapshot, if one is configured
+    if conda_tools.REPODATA_SNAPSHOT_DIR is not None:
+        solvers = conda_tools.RepodataSnapshot().use(solvers)
 
-        for env, solver in envs.items():
-            specs[img_name][env] = solver.solve_final_state()
+    solved = conda_tools.solve_all(solvers, cache=conda_tools.SolveCache())
+
+    for img_name, envs in solved.items():
+        store.put(img_name, manifests[img_name], envs)
+
+    specs.update(solved)
 
     yield specs
 
 
-def assert_pairing_match(base_name, base_spec, paired_name, paired_spec):
-    failures = []
-    for pkg in base_spec:
-        for pair in paired_spec:
-            if pkg.name == pair.name:
-                if pkg.version != pair.version:
-                    failures.append((pkg, pair))
+@pytest.fixture(scope='module')
+def pip_spec(package_spec):
+    '''
+    Returns a nested dictionary of images and resolved pip packages
+
+    The ``pip:`` sections of each environment's files are resolved offline
+    against a :py:class:`conda_tools.WheelIndex` of the wheels in
+    :py:data:`conda_tools.WHEEL_DIRS`. If no wheels have been downloaded, pip
+    packages are not checked.
+    '''
+    index = conda_tools.WheelIndex()
+    index.update()
+
+    if len(index) == 0:
+        warnings.warn(
+            'no wheels found in {}; pip packages are not aligned'.format(
+                os.pathsep.join(conda_tools.WHEEL_DIRS)))
+        yield {}
+        return
+
+    manifests = {}
+    for img_name, dockerfiles in IMAGES_TO_CHECK.items():
+        manifests[img_name] = {}
+        conda_tools.build_final_envs_for_multiple_docker_files(
+            [os.path.join(PKG_ROOT, fp) for fp in dockerfiles],
+            manifest=manifests[img_name])
+
+    yield conda_tools.solve_pip(manifests, package_spec, index)
+
+
+@pytest.fixture(scope='module')
+def package_alignment(package_spec, pip_spec):
+    '''
+    Returns the mismatch table of conda and pip packages for all PAIRINGS
+    '''
+    yield conda_tools.align_environments(
+        conda_tools.merge_pip_solutions(package_spec, pip_spec), PAIRINGS)
+
+
+def assert_pairing_match(base_name, paired_name, mismatches):
+    failures = [
+        m for m in mismatches
+        if (m.base, m.paired, m.kind) == (base_name, paired_name, 'version')]
 
     if len(failures) > 0:
         raise ValueError(
-            'Package versions mis-aligned in {} <> {} pairing:\n\t{}'
+            'Package versions mis-aligned in {} <> {} pairing:\n{}'
             .format(
                 base_name,
                 paired_name,
-                '\n\t'.join([
-                    'package {}: {} != {}'
-                    .format(n.name, n.version, w.version)
-                    for n, w in failures]))
-        )
+                conda_tools.format_mismatch_table(failures)))
 
 
 @pytest.mark.parametrize('pairing', PAIRINGS)
-def test_package_pairing(package_spec, pairing):
+def test_package_pairing(package_alignment, pairing):
     notebook_image, notebook_env, worker_image, worker_env = pairing
-    notebook_spec = package_spec[notebook_image][notebook_env]
-    worker_spec = package_spec[worker_image][worker_env]
 
     assert_pairing_match(
         notebook_image + ':' + notebook_env,
-        notebook_spec,
         worker_image + ':' + worker_env,
-        worker_spec)
+        package_alignment)
+
+
+def test_align_environments_reports_version_and_build_mismatches():
+    def record(name, version, build):
+        return conda.models.records.PackageRecord(
+            name=name, version=version, build=build, build_number=0,
+            channel='conda-forge', subdir='noarch',
+            fn='{}-{}-{}.tar.bz2'.format(name, version, build))
+
+    solutions = {
+        'notebook': {'base': [
+            record('dask', '2.8.1', 'py_0'),
+            record('numpy', '1.17', 'py37_0'),
+            record('xarray', '0.16.0', 'py_0')]},
+        'worker': {'base': [
+            record('dask', '2.9.0', 'py_0'),
+            record('numpy', '1.17.0', 'py37_0'),
+            record('xarray', '0.16.0', 'py_1')]},
+        'octave-worker': {'base': [
+            record('dask', '2.8.1', 'py_0')]}}
+
+    mismatches = conda_tools.align_environments(solutions, PAIRINGS)
+
+    assert [(m.package, m.paired, m.kind) for m in mismatches] == [
+        ('dask', 'worker:base', 'version'),
+        ('xarray', 'worker:base', 'build')]
+
+    with pytest.raises(ValueError):
+        assert_pairing_match('notebook:base', 'worker:base', mismatches)
+
+    assert_pairing_match('notebook:base', 'octave-worker:base', mismatches)
+
+
+def test_pairing_groups():
+    groups = conda_tools.get_pairing_groups(
+        PAIRINGS + [('notebook', 'r', 'r-worker', 'r')])
+
+    assert groups == [
+        [('notebook', 'base'), ('octave-worker', 'base'), ('worker', 'base')],
+        [('notebook', 'r'), ('r-worker', 'r')]]
+
+
+def test_co_solve_locks_shared_packages(monkeypatch):
+    def record(name, version, depends=()):
+        return conda.models.records.PackageRecord(
+            name=name, version=version, build='py_0', build_number=0,
+            channel='conda-forge', subdir='noarch', depends=list(depends),
+            fn='{}-{}-py_0.tar.bz2'.format(name, version))
+
+    union = (
+        record('xarray', '0.16.0', ['numpy >=1.15']),
+        record('numpy', '1.18.5'),
+        record('jupyterlab', '2.1.5'))
+
+    calls = []
+
+    def solve_all(solvers, max_workers=None, cache=None):
+        calls.append(solvers)
+        if 'group0' in solvers:
+            return {'group0': {'union': union}}
+        return {img: {env: () for env in envs} for img, envs in solvers.items()}
+
+    monkeypatch.setattr(conda_tools, 'solve_all', solve_all)
+
+    solvers = {
+        'notebook': {'base': conda.core.solve.Solver(
+            'base', ['conda-forge'], specs_to_add=['xarray', 'jupyterlab'])},
+        'worker': {'base': conda.core.solve.Solver(
+            'base', ['conda-forge'], specs_to_add=['xarray'])}}
+
+    conda_tools.co_solve(solvers, PAIRINGS)
+
+    union_solver = calls[0]['group0']['union']
+    assert sorted(s.name for s in union_solver.specs_to_add) == [
+        'jupyterlab', 'xarray']
+
+    locked = calls[1]
+    notebook_specs = {
+        s.name: str(s) for s in locked['notebook']['base'].specs_to_add}
+    worker_specs = {
+        s.name: str(s) for s in locked['worker']['base'].specs_to_add}
+
+    # shared packages and their dependencies are locked to the union solution
+    assert sorted(worker_specs) == ['numpy', 'xarray']
+    assert notebook_specs['xarray'] == worker_specs['xarray']
+    assert '0.16.0' in worker_specs['xarray']
+    assert '1.18.5' in notebook_specs['numpy']
+
+    # packages only in one environment are solved from its own specs
+    assert notebook_specs['jupyterlab'] == 'jupyterlab'
@@ -0,0 +1,136 @@
+from __future__ import absolute_import
+
+import json
+import os
+import sys
+
+import pytest
+
+if os.path.isfile('../pin.py'):
+    sys.path.append('..')
+elif os.path.isfile('pin.py'):
+    sys.path.append('.')
+
+import pin
+
+PINNED_ENV = '''name: base
+channels:
+  - conda-forge
+dependencies:
+  - dask=2.8.1=py_0
+  # for regridding
+  - esmpy=7.1.0=py37h1ce8a63_6
+  - python=3.7.3=h357f687_2 # pinkeep: python=3.7
+  - pip:
+    - mapbox==0.18.0
+'''
+
+
+def test_repin_keeps_comments(tmpdir):
+    envfile = tmpdir.join('environment.yml')
+    envfile.write(PINNED_ENV)
+
+    versions = pin.parse_conda_dependencies([
+        'dask=2.9.0=py_0',
+        'esmpy=7.1.0=py37h1ce8a63_6',
+        'python=3.7.6=h357f687_2'])
+
+    assert pin.pin_dependencies_in_conda_env_file_from_version_spec(
+        str(envfile), versions, pinkeep=False)
+
+    assert envfile.read() == PINNED_ENV.replace(
+        'dask=2.8.1=py_0', 'dask=2.9.0=py_0').replace(
+        'python=3.7.3=', 'python=3.7.6=')
+
+
+UNPINNED_ENV = '''name: base
+channels:
+  - conda-forge
+dependencies:
+  - dask
+  - python=3.7
+  - pip:
+    - mapbox
+'''
+
+
+def test_pin_files_only_rewrites_changed_files(tmpdir, monkeypatch):
+    versions = {
+        'base': ['dask=2.8.1=py_0', 'python=3.7.3=h357f687_2',
+                 {'pip': ['mapbox==0.18.0']}],
+        'worker': ['dask=2.8.1=py_0', 'python=3.7.3=h357f687_2',
+                   {'pip': ['mapbox==0.18.0']}]}
+
+    monkeypatch.setattr(
+        pin, 'get_versions_in_current_environment',
+        lambda envname: {'dependencies': versions[envname]})
+
+    notebook = tmpdir.join('notebook.yml')
+    worker = tmpdir.join('worker.yml')
+    notebook.write(UNPINNED_ENV)
+    worker.write(UNPINNED_ENV)
+
+    environment_files = [(str(notebook), 'base'), (str(worker), 'worker')]
+
+    assert pin.pin_files(environment_files) == [str(notebook), str(worker)]
+    assert 'dask=2.8.1=py_0' in notebook.read()
+    assert 'python=3.7.3=h357f687_2  # pinkeep: python=3.7' in notebook.read()
+
+    for envfile in (notebook, worker):
+        os.utime(str(envfile), (1000000000, 1000000000))
+
+    pinned_notebook = notebook.read()
+    versions['worker'][0] = 'dask=2.9.0=py_0'
+
+    assert pin.pin_files(environment_files) == [str(worker)]
+    assert notebook.read() == pinned_notebook
+    assert notebook.mtime() == 1000000000
+    assert 'dask=2.9.0=py_0' in worker.read()
+    assert 'python=3.7.3=h357f687_2  # pinkeep: python=3.7' in worker.read()
+    assert worker.mtime() != 1000000000
+
+
+def test_get_versions_from_conda_meta(tmpdir, monkeypatch):
+    prefix = tmpdir.mkdir('envs').mkdir('worker')
+    monkeypatch.setattr(pin, '_get_env_prefix', lambda envname: str(prefix))
+
+    meta = prefix.mkdir('conda-meta')
+    meta.join('dask-2.8.1-py_0.json').write(json.dumps({
+        'name': 'dask', 'version': '2.8.1', 'build': 'py_0',
+        'channel': 'https://conda.anaconda.org/conda-forge/noarch',
+        'files': []}))
+    meta.join('pip-19.3.1-py37_0.json').write(json.dumps({
+        'name': 'pip', 'version': '19.3.1', 'build': 'py37_0',
+        'channel': 'https://conda.anaconda.org/conda-forge/linux-64',
+        'files': [
+            'lib/python3.7/site-packages/pip-19.3.1.dist-info/METADATA']}))
+    meta.join('openssl-1.1.1d-h7b6447c_4.json').write(json.dumps({
+        'name': 'openssl', 'version': '1.1.1d', 'build': 'h7b6447c_4',
+        'channel': 'https://repo.anaconda.com/pkgs/main/linux-64',
+        'files': []}))
+    meta.join('history').write('')
+
+    site_packages = prefix.mkdir('lib').mkdir('python3.7').mkdir(
+        'site-packages')
+    site_packages.mkdir('pip-19.3.1.dist-info').join('METADATA').write(
+        'Metadata-Version: 2.1\nName: pip\nVersion: 19.3.1\n')
+    site_packages.mkdir('mapbox-0.18.0.dist-info').join('METADATA').write(
+        'Metadata-Version: 2.1\nName: mapbox\nVersion: 0.18.0\n\n'
+        'Version: not a header\n')
+    site_packages.mkdir('rhg_compute_tools-0.2.1-py3.7.egg-info').join(
+        'PKG-INFO').write(
+        'Metadata-Version: 1.0\nName: rhg_compute_tools\nVersion: 0.2.1\n')
+
+    assert pin.get_versions_from_conda_meta('worker') == {
+        'name': 'worker',
+        'channels': ['conda-forge', 'defaults'],
+        'dependencies': [
+            'dask=2.8.1=py_0',
+            'openssl=1.1.1d=h7b6447c_4',
+            'pip=19.3.1=py37_0',
+            {'pip': ['mapbox==0.18.0', 'rhg_compute_tools==0.2.1']}],
+        'prefix': str(prefix)}
+
+    meta.remove()
+    with pytest.raises(IOError):
+        pin.get_versions_from_conda_meta('worker')
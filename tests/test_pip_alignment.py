@@ -0,0 +1,128 @@
+from __future__ import absolute_import
+
+import os
+import sys
+import zipfile
+
+import pytest
+
+if os.path.isdir('../maintenance_utilities'):
+    sys.path.append('../maintenance_utilities')
+elif os.path.isdir('maintenance_utilities'):
+    sys.path.append('maintenance_utilities')
+
+import conda_tools
+
+
+def _write_wheel(wheel_dir, name, version, requires=()):
+    dist = name.replace('-', '_')
+    path = os.path.join(
+        str(wheel_dir), '{}-{}-py3-none-any.whl'.format(dist, version))
+
+    metadata = '\n'.join(
+        ['Metadata-Version: 2.1', 'Name: {}'.format(name),
+         'Version: {}'.format(version)]
+        + ['Requires-Dist: {}'.format(r) for r in requires]) + '\n'
+
+    with zipfile.ZipFile(path, 'w') as whl:
+        whl.writestr('{}/__init__.py'.format(dist), '')
+        whl.writestr(
+            '{}-{}.dist-info/METADATA'.format(dist, version), metadata)
+
+    return path
+
+
+@pytest.fixture
+def index(tmpdir):
+    wheels = tmpdir.mkdir('wheels')
+
+    _write_wheel(wheels, 'rhg_compute_tools', '0.2.2', [
+        'dask-kubernetes (>=0.10)', 'toolz',
+        'pytest ; extra == "test"',
+        'futures ; python_version < "3.0"'])
+    _write_wheel(wheels, 'rhg_compute_tools', '0.2.1', ['toolz'])
+    _write_wheel(wheels, 'dask_kubernetes', '0.10.1', ['dask (>=2.5)'])
+    _write_wheel(wheels, 'dask_kubernetes', '0.11.0', ['dask (>=2.9)'])
+    _write_wheel(wheels, 'toolz', '0.10.0')
+    _write_wheel(wheels, 'toolz', '1.0.0a1')
+
+    index = conda_tools.WheelIndex(path=str(tmpdir.join('index.json')))
+    index.update([str(wheels)])
+
+    return index
+
+
+def test_wheel_index_updates_incrementally(index, tmpdir):
+    wheels = str(tmpdir.join('wheels'))
+
+    assert [r.version for r in index.candidates('RHG-Compute-Tools')] == [
+        '0.2.2', '0.2.1']
+
+    reloaded = conda_tools.WheelIndex(path=index.path)
+    assert len(reloaded) == 6
+    assert reloaded.update([wheels]) == 0
+
+    os.remove(_write_wheel(wheels, 'toolz', '1.0.0a1'))
+    _write_wheel(wheels, 'toolz', '0.11.0')
+
+    assert reloaded.update([wheels]) == 1
+    assert [r.version for r in reloaded.candidates('toolz')] == [
+        '0.11.0', '0.10.0']
+
+
+def test_resolve_pip(index):
+    records = conda_tools.resolve_pip(
+        ['rhg_compute_tools==0.2.2', 'dask_kubernetes==0.10.1'],
+        index,
+        installed={'dask': '2.8.1', 'python': '3.7.3'})
+
+    assert [(r.name, r.version) for r in records] == [
+        ('dask-kubernetes', '0.10.1'),
+        ('rhg-compute-tools', '0.2.2'),
+        ('toolz', '0.10.0')]
+
+    with pytest.raises(ValueError, match='conda installs dask 2.8.1'):
+        conda_tools.resolve_pip(
+            ['dask_kubernetes==0.11.0'], index, installed={'dask': '2.8.1'})
+
+    with pytest.raises(ValueError, match='no indexed wheel of pytest'):
+        conda_tools.resolve_pip(['rhg_compute_tools[test]'], index)
+
+
+def test_pip_mismatches_are_aligned(index):
+    solutions = {
+        'notebook': {'base': ()},
+        'worker': {'base': ()}}
+
+    pip_solutions = {
+        'notebook': {'base': conda_tools.resolve_pip(
+            ['rhg_compute_tools'], index, installed={'dask': '2.9.0'})},
+        'worker': {'base': conda_tools.resolve_pip(
+            ['rhg_compute_tools==0.2.1'], index)}}
+
+    mismatches = conda_tools.align_environments(
+        conda_tools.merge_pip_solutions(solutions, pip_solutions),
+        [('notebook', 'base', 'worker', 'base')])
+
+    assert [(m.package, m.base_version, m.paired_version, m.kind)
+            for m in mismatches] == [
+        ('rhg-compute-tools', '0.2.2', '0.2.1', 'version')]
+
+    assert solutions['notebook']['base'] == ()
+
+
+def test_resolve_pip_drops_replaced_requirements(index, tmpdir):
+    wheels = str(tmpdir.join('wheels'))
+    _write_wheel(wheels, 'pinner', '1.0', [
+        'rhg_compute_tools (==0.2.1)', 'not a requirement ((('])
+    index.update([wheels])
+
+    records = conda_tools.resolve_pip(
+        ['rhg_compute_tools', 'pinner', 'futures ; python_version < "3.0"'],
+        index,
+        installed={'dask': '2.9.0'})
+
+    assert [(r.name, r.version) for r in records] == [
+        ('pinner', '1.0'),
+        ('rhg-compute-tools', '0.2.1'),
+        ('toolz', '0.10.0')]
@@ -0,0 +1,108 @@
+from __future__ import absolute_import
+
+import os
+import sys
+import json
+
+if os.path.isdir('../maintenance_utilities'):
+    sys.path.append('../maintenance_utilities')
+elif os.path.isdir('maintenance_utilities'):
+    sys.path.append('maintenance_utilities')
+
+import conda_tools
+
+
+def _repodata(etag, *records):
+    packages = {}
+    for name, version, depends in records:
+        packages['{}-{}-0.tar.bz2'.format(name, version)] = {
+            'name': name, 'version': version, 'build': '0',
+            'build_number': 0, 'depends': depends}
+
+    return {'_etag': etag, 'info': {}, 'packages': packages}
+
+
+UPSTREAM = {
+    ('conda-forge', 'linux-64'): _repodata(
+        'a',
+        ('xarray', '0.16.0', ['numpy >=1.15', 'pandas >=0.25']),
+        ('pandas', '1.0.5', ['numpy', 'python >=3.7,<3.8.0a0']),
+        ('numpy', '1.18.5', ['libblas >=3.8.0,<4.0a0', '__glibc >=2.17']),
+        ('python', '3.7.6', []),
+        ('tensorflow', '2.2.0', ['numpy'])),
+    ('conda-forge', 'noarch'): _repodata(
+        'b',
+        ('pip', '20.1.1', ['setuptools', 'wheel']),
+        ('setuptools', '49.1.0', []),
+        ('wheel', '0.34.2', []),
+        ('libblas', '3.8.0', []),
+        ('dask', '2.20.0', [])),
+}
+
+
+def test_repodata_closure():
+    closure = conda_tools.get_repodata_closure(
+        UPSTREAM.values(), ['xarray'])
+
+    assert closure == {
+        'xarray', 'pandas', 'numpy', 'python', 'pip', 'setuptools', 'wheel',
+        'libblas', '__glibc'}
+
+
+def test_snapshot_updates_with_deltas(tmpdir):
+    upstream = dict(UPSTREAM)
+    loads = []
+
+    def load_repodata(channel, subdir):
+        loads.append((channel, subdir))
+        return upstream[(channel, subdir)]
+
+    snapshot = conda_tools.RepodataSnapshot(str(tmpdir))
+    channels, subdirs = ['conda-forge'], ['linux-64', 'noarch']
+
+    deltas = snapshot.build(channels, subdirs, ['xarray'], load_repodata)
+
+    assert deltas == {
+        'conda-forge/linux-64': {'added': 4, 'removed': 0, 'patched': 0},
+        'conda-forge/noarch': {'added': 4, 'removed': 0, 'patched': 0}}
+
+    with open(str(tmpdir.join(
+            'conda-forge', 'linux-64', 'repodata.json'))) as f:
+        pruned = json.load(f)
+
+    assert sorted(r['name'] for r in pruned['packages'].values()) == [
+        'numpy', 'pandas', 'python', 'xarray']
+    assert pruned['info']['subdir'] == 'linux-64'
+
+    # unchanged upstream repodata and names: nothing to do
+    reloaded = conda_tools.RepodataSnapshot(str(tmpdir))
+    assert reloaded.build(channels, subdirs, ['xarray'], load_repodata) == {}
+
+    # only the subdir whose pruned records change is rewritten
+    assert reloaded.build(
+        channels, subdirs, ['xarray', 'dask'], load_repodata) == {
+            'conda-forge/noarch': {'added': 1, 'removed': 0, 'patched': 0}}
+
+    with open(str(tmpdir.join('conda-forge', 'noarch', 'deltas.jsonl'))) as f:
+        deltas = [json.loads(line) for line in f]
+
+    assert [d['added'] for d in deltas][-1] == ['dask-2.20.0-0.tar.bz2']
+    assert reloaded.state['closure_size'] == 10
+
+    # a repodata patch edits an existing record without changing filenames
+    patched = json.loads(json.dumps(upstream[('conda-forge', 'linux-64')]))
+    patched['_etag'] = 'c'
+    patched['packages']['pandas-1.0.5-0.tar.bz2']['depends'].append(
+        'numpy <1.19')
+    upstream[('conda-forge', 'linux-64')] = patched
+
+    assert reloaded.build(
+        channels, subdirs, ['xarray', 'dask'], load_repodata) == {
+            'conda-forge/linux-64': {'added': 0, 'removed': 0, 'patched': 1}}
+
+    with open(str(tmpdir.join(
+            'conda-forge', 'linux-64', 'repodata.json'))) as f:
+        pruned = json.load(f)
+
+    assert 'numpy <1.19' in (
+        pruned['packages']['pandas-1.0.5-0.tar.bz2']['depends'])
@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+
+import os
+import json
+import importlib.util
+
+if os.path.isdir('../notebook'):
+    ROOT = '..'
+else:
+    ROOT = '.'
+
+
+def _load(image):
+    spec = importlib.util.spec_from_file_location(
+        '{}_add_service_creds'.format(image),
+        os.path.join(ROOT, image, 'add_service_creds.py'))
+
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def test_packed_credentials_round_trip(tmpdir):
+    notebook = _load('notebook')
+    worker = _load('worker')
+
+    shared = {'type': 'service_account', 'private_key': 'k' * 1700}
+    creds = {'bucket-{}'.format(i): shared for i in range(10)}
+    creds['other'] = {'type': 'service_account', 'private_key': 'other'}
+
+    packed = notebook.pack_credentials(creds)
+
+    # the shared key is stored once
+    assert len(packed) < len(json.dumps(shared)) * 2
+    assert packed == notebook.pack_credentials(dict(creds))
+    assert notebook.unpack_credentials(packed) == creds
+
+    token_strings = tmpdir.join('gcsfuse_token_strings.json')
+    token_strings.write(packed + '\n')
+
+    assert worker.get_bucket_credential(
+        'other', str(token_strings)) == creds['other']
+
+    token_dir = tmpdir.mkdir('tokens')
+    worker.create_service_cred_files(str(token_strings), str(token_dir))
+
+    assert json.loads(token_dir.join('bucket-3.json').read()) == shared
+
+    # plain JSON values from older notebooks are still understood
+    token_strings.write(json.dumps(creds))
+    assert worker.get_bucket_credential(
+        'bucket-3', str(token_strings)) == shared
+
+
+def test_worker_template_only_rewritten_when_changed(tmpdir):
+    notebook = _load('notebook')
+
+    source = tmpdir.join('source-template.yml')
+    source.write(
+        'spec:\n'
+        '  containers:\n'
+        '  - image: rhodium/worker:dev\n'
+        '    env:\n'
+        '    - name: GCSFUSE_TOKENS\n'
+        '      value: \'{"bucket": {"private_key": "k"}}\'\n')
+
+    template = tmpdir.join('worker-template.yml')
+
+    notebook.add_service_creds(str(template), str(source))
+    rendered = template.read()
+
+    assert notebook.unpack_credentials(
+        notebook.yaml.safe_load(rendered)['spec']['containers'][0]['env'][0][
+            'value']) == {'bucket': {'private_key': 'k'}}
+
+    os.utime(str(template), (0, 0))
+    notebook.add_service_creds(str(template), str(source))
+
+    assert template.read() == rendered
+    assert os.stat(str(template)).st_mtime == 0
+
+    # a changed source is rendered again
+    source.write(source.read().replace('worker:dev', 'worker:latest'))
+    notebook.add_service_creds(str(template), str(source))
+
+    assert 'worker:latest' in template.read()
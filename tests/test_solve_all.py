@@ -0,0 +1,98 @@
+from __future__ import absolute_import
+
+import os
+import sys
+
+import pytest
+
+if os.path.isdir('../maintenance_utilities'):
+    sys.path.append('../maintenance_utilities')
+elif os.path.isdir('maintenance_utilities'):
+    sys.path.append('maintenance_utilities')
+
+import conda_tools
+
+
+class StubSolver(object):
+    '''
+    Stands in for :py:class:`conda.core.solve.Solver`, solving each spec to a
+    single package. Solver processes are forked, so the stub needs no import
+    path in the workers.
+    '''
+
+    def __init__(
+            self, prefix, channels=('conda-forge', ), subdirs=('noarch', ),
+            specs_to_add=(), specs_to_remove=()):
+
+        self.prefix = prefix
+        self.channels = list(channels)
+        self.subdirs = list(subdirs)
+        self.specs_to_add = list(specs_to_add)
+        self.specs_to_remove = list(specs_to_remove)
+
+    def solve_final_state(self):
+        records = []
+
+        for spec in self.specs_to_add:
+            if spec == 'unsatisfiable':
+                raise ValueError('no solution for {}'.format(spec))
+
+            records.append(conda_tools.PackageRecord(
+                name=spec,
+                version='1.0',
+                build='py_0',
+                build_number=0,
+                channel='conda-forge',
+                subdir='noarch',
+                fn='{}-1.0-py_0.tar.bz2'.format(spec)))
+
+        return records
+
+
+class UnusedSolver(StubSolver):
+    def solve_final_state(self):
+        raise AssertionError('cached solutions are not solved again')
+
+
+@pytest.fixture
+def stub_solver(monkeypatch):
+    monkeypatch.setattr(conda_tools, 'Solver', StubSolver)
+    monkeypatch.setattr(conda_tools, '_preload_repodata', lambda args: None)
+
+
+def test_solve_all(stub_solver, tmpdir, monkeypatch):
+    solvers = {
+        'notebook': {
+            'base': StubSolver('/opt/conda', specs_to_add=['xarray']),
+            'r': StubSolver('/opt/conda/envs/r', specs_to_add=['r-base'])},
+        'worker': {
+            'base': StubSolver('/opt/conda', specs_to_add=['xarray'])}}
+
+    cache = conda_tools.SolveCache(cache_dir=str(tmpdir))
+    solutions = conda_tools.solve_all(solvers, max_workers=2, cache=cache)
+
+    assert {img: {env: [r.name for r in records]
+                  for env, records in envs.items()}
+            for img, envs in solutions.items()} == {
+        'notebook': {'base': ['xarray'], 'r': ['r-base']},
+        'worker': {'base': ['xarray']}}
+
+    # identical environments are solved once
+    assert solutions['notebook']['base'] is solutions['worker']['base']
+
+    monkeypatch.setattr(conda_tools, 'Solver', UnusedSolver)
+
+    cached = conda_tools.solve_all(solvers, max_workers=2, cache=cache)
+
+    assert [r.name for r in cached['notebook']['r']] == ['r-base']
+
+
+def test_solve_all_raises_solver_errors(stub_solver):
+    solvers = {
+        'notebook': {'base': StubSolver(
+            '/opt/conda', specs_to_add=['xarray'])},
+        'worker': {'base': StubSolver(
+            '/opt/conda', specs_to_add=['unsatisfiable'])}}
+
+    with pytest.raises(ValueError, match='no solution for unsatisfiable'):
+        conda_tools.solve_all(solvers, max_workers=2)
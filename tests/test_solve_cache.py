@@ -0,0 +1,134 @@
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+
+from conda.models.records import PackageRecord
+
+if os.path.isdir('../maintenance_utilities'):
+    sys.path.append('../maintenance_utilities')
+elif os.path.isdir('maintenance_utilities'):
+    sys.path.append('maintenance_utilities')
+
+import conda_tools
+
+
+def _record(name, version):
+    return PackageRecord(
+        name=name,
+        version=version,
+        build='py_0',
+        build_number=0,
+        channel='conda-forge',
+        subdir='noarch',
+        fn='{}-{}-py_0.tar.bz2'.format(name, version))
+
+
+def test_solve_cache_roundtrip(tmpdir):
+    cache = conda_tools.SolveCache(cache_dir=str(tmpdir))
+    records = (_record('xarray', '0.16.0'), _record('dask', '2.8.1'))
+
+    assert cache.get('abc') is None
+
+    cache.put('abc', records)
+    cached = cache.get('abc')
+
+    assert [(r.name, r.version) for r in cached] == [
+        ('xarray', '0.16.0'), ('dask', '2.8.1')]
+
+
+def test_solve_cache_eviction(tmpdir):
+    cache = conda_tools.SolveCache(
+        cache_dir=str(tmpdir), max_age=60, max_size=10 ** 9)
+
+    cache.put('old', (_record('xarray', '0.16.0'), ))
+    cache.put('new', (_record('xarray', '0.16.0'), ))
+
+    stale = time.time() - 120
+    os.utime(os.path.join(str(tmpdir), 'old.json'), (stale, stale))
+
+    cache.evict()
+
+    assert cache.get('old') is None
+    assert cache.get('new') is not None
+
+    # another process's solution being written is left alone
+    in_flight = os.path.join(str(tmpdir), 'other.json.123.tmp')
+    with open(in_flight, 'w') as f:
+        f.write('{}')
+    os.utime(in_flight, (stale, stale))
+
+    cache.max_size = 0
+    cache.evict()
+
+    assert cache.get('new') is None
+    assert os.path.exists(in_flight)
+
+    abandoned = time.time() - 2 * conda_tools.SOLVE_CACHE_TMP_MAX_AGE
+    os.utime(in_flight, (abandoned, abandoned))
+    cache.evict()
+
+    assert not os.path.exists(in_flight)
+
+
+class FakeSolver(object):
+    def __init__(self, records):
+        self.records = records
+        self.solves = 0
+
+    def solve_final_state(self):
+        self.solves += 1
+        return self.records
+
+
+def test_solve_cache_stores_under_refreshed_key(tmpdir, monkeypatch):
+    cache = conda_tools.SolveCache(cache_dir=str(tmpdir))
+    solver = FakeSolver((_record('xarray', '0.16.0'), ))
+
+    # a cold run: the solve fetches repodata, changing the key
+    keys = iter(['cold', 'fetched'])
+    monkeypatch.setattr(
+        conda_tools, 'get_solver_cache_key',
+        lambda solver, repodata_snapshot=None: next(keys))
+
+    cache.solve(solver)
+
+    monkeypatch.setattr(
+        conda_tools, 'get_solver_cache_key',
+        lambda solver, repodata_snapshot=None: 'fetched')
+
+    assert cache.solve(solver)[0].name == 'xarray'
+    assert solver.solves == 1
+
+
+def test_manifest_store_invalidated_by_input_change(tmpdir):
+    env_file = tmpdir.join('octave_environment.yml')
+    env_file.write(
+        'name: base\nchannels:\n  - conda-forge\n'
+        'dependencies:\n  - oct2py=5.0.4=py_0\n')
+
+    dockerfile = tmpdir.join('Dockerfile')
+    dockerfile.write(
+        'FROM rhodium/worker:latest\n'
+        'COPY octave_environment.yml /opt/conda/specs/octave_environment.yml\n'
+        'RUN conda env update -f /opt/conda/specs/octave_environment.yml\n')
+
+    manifest = {}
+    conda_tools.get_conda_specs(str(dockerfile), manifest=manifest)
+
+    assert sorted(manifest['base']) == sorted([str(dockerfile), str(env_file)])
+
+    store = conda_tools.ManifestStore(store_dir=str(tmpdir.join('store')))
+    store.put('octave', manifest, {'base': (_record('oct2py', '5.0.4'), )})
+
+    assert store.get('octave', manifest)['base'][0].version == '5.0.4'
+
+    env_file.write(
+        'name: base\nchannels:\n  - conda-forge\n'
+        'dependencies:\n  - oct2py=5.0.5=py_0\n')
+
+    changed = {}
+    conda_tools.get_conda_specs(str(dockerfile), manifest=changed)
+
+    assert store.get('octave', changed) is None
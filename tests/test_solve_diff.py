@@ -0,0 +1,57 @@
+from __future__ import absolute_import
+
+import os
+import sys
+
+if os.path.isdir('../maintenance_utilities'):
+    sys.path.append('../maintenance_utilities')
+elif os.path.isdir('maintenance_utilities'):
+    sys.path.append('maintenance_utilities')
+
+import conda_tools
+
+LOCK = '''\
+# platform: linux-64
+@EXPLICIT
+https://conda.anaconda.org/conda-forge/noarch/dask-2.8.1-py_0.tar.bz2#abc
+https://conda.anaconda.org/conda-forge/linux-64/numpy-1.17.3-py37h95a1406_0.tar.bz2#def
+https://conda.anaconda.org/conda-forge/noarch/xarray-0.16.0-py_0.tar.bz2#012
+https://conda.anaconda.org/conda-forge/linux-64/scipy-1.3.2-py37h921218d_0.tar.bz2#345
+https://conda.anaconda.org/conda-forge/noarch/zict-1.0.0-py_0.tar.bz2#678
+'''
+
+
+def test_diff_against_lock_file(tmpdir):
+    lock = tmpdir.join('base-linux-64.lock')
+    lock.write(LOCK)
+
+    old = conda_tools.read_lock_file(str(lock))
+
+    assert old[1] == conda_tools.LockedPackage(
+        'numpy', '1.17.3', 'py37h95a1406_0',
+        'https://conda.anaconda.org/conda-forge/linux-64/'
+        'numpy-1.17.3-py37h95a1406_0.tar.bz2',
+        'def')
+
+    new = [
+        conda_tools.LockedPackage('dask', '2021.1.0', 'py_0', None, None),
+        conda_tools.LockedPackage('numpy', '1.17.3', 'py37h8b7e1a4_1', None, None),
+        conda_tools.LockedPackage('xarray', '0.16.1', 'py_0', None, None),
+        conda_tools.LockedPackage('scipy', '1.3.1', 'py37h0_0', None, None),
+        conda_tools.LockedPackage('toolz', '0.11.1', 'py_0', None, None)]
+
+    changes = conda_tools.diff_solutions(old, new)
+
+    assert [(c.name, c.change, c.major) for c in changes] == [
+        ('dask', 'upgrade', True),
+        ('xarray', 'upgrade', False),
+        ('scipy', 'downgrade', False),
+        ('numpy', 'build', False),
+        ('toolz', 'add', False),
+        ('zict', 'remove', False)]
+
+    changelog = conda_tools.format_changelog(changes)
+
+    assert 'Major version upgrades (1)\n  dask: 2.8.1=py_0 -> 2021.1.0=py_0' in (
+        changelog)
+
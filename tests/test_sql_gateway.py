@@ -0,0 +1,188 @@
+from __future__ import absolute_import
+
+import os
+import sys
+import struct
+import asyncio
+
+if os.path.isdir('../notebook'):
+    sys.path.append('../notebook')
+elif os.path.isdir('notebook'):
+    sys.path.append('notebook')
+
+import sql_gateway
+
+SSL_REQUEST = 80877103
+
+
+class FakePostgres(object):
+    '''
+    Minimal Postgres-protocol server: trusts every startup and answers each
+    simple query with CommandComplete and ReadyForQuery
+    '''
+
+    def __init__(self):
+        self.connections = 0
+        self.max_connections = 0
+        self.queries = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        self.max_connections = max(self.max_connections, self.connections)
+
+        try:
+            while True:
+                length, code = struct.unpack('!II', await reader.readexactly(8))
+                await reader.readexactly(length - 8)
+
+                if code != SSL_REQUEST:
+                    break
+
+                writer.write(b'N')
+
+            writer.write(b'R' + struct.pack('!II', 8, 0))
+            writer.write(b'Z' + struct.pack('!I', 5) + b'I')
+
+            while True:
+                kind = await reader.readexactly(1)
+                length, = struct.unpack('!I', await reader.readexactly(4))
+                await reader.readexactly(length - 4)
+
+                if kind == b'X':
+                    break
+
+                self.queries += 1
+                await asyncio.sleep(0.1)
+
+                tag = b'SELECT 1\0'
+                writer.write(b'C' + struct.pack('!I', len(tag) + 4) + tag)
+                writer.write(b'Z' + struct.pack('!I', 5) + b'I')
+
+        except asyncio.IncompleteReadError:
+            pass
+
+        finally:
+            self.connections -= 1
+            writer.close()
+
+
+async def _session(port):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+    writer.write(struct.pack('!II', 8, SSL_REQUEST))
+    assert await reader.readexactly(1) == b'N'
+
+    params = b'user\0worker\0\0'
+    writer.write(struct.pack('!II', len(params) + 8, 196608) + params)
+    assert (await reader.readexactly(9))[:1] == b'R'
+    assert await reader.readexactly(6) == b'Z\0\0\0\x05I'
+
+    query = b'select 1\0'
+    writer.write(b'Q' + struct.pack('!I', len(query) + 4) + query)
+    assert (await reader.readexactly(14))[:1] == b'C'
+    assert await reader.readexactly(6) == b'Z\0\0\0\x05I'
+
+    writer.write(b'X' + struct.pack('!I', 4))
+    await writer.drain()
+    assert await reader.read() == b''
+    writer.close()
+
+
+async def _start(pool_size, queue_timeout=None, idle_timeout=None):
+    backend = FakePostgres()
+    server = await asyncio.start_server(backend.handle, '127.0.0.1', 0)
+    upstream_port = server.sockets[0].getsockname()[1]
+
+    gateway = sql_gateway.PoolingGateway(
+        '127.0.0.1', 0, '127.0.0.1', upstream_port,
+        pool_size=pool_size, queue_timeout=queue_timeout,
+        idle_timeout=idle_timeout)
+    await gateway.start()
+
+    return backend, server, gateway, gateway._server.sockets[0].getsockname()[1]
+
+
+def _run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_sessions_share_bounded_pool():
+    async def scenario():
+        backend, server, gateway, port = await _start(pool_size=2)
+
+        await asyncio.gather(*[_session(port) for _ in range(6)])
+
+        await gateway.close()
+        server.close()
+
+        return backend, gateway
+
+    backend, gateway = _run(scenario())
+
+    assert backend.queries == 6
+    assert backend.max_connections == 2
+
+    assert gateway.stats['sessions'] == 6
+    assert gateway.stats['max_active'] == 2
+    assert gateway.stats['max_queued'] >= 4
+    assert gateway.stats['active'] == 0
+    assert gateway.stats['queued'] == 0
+    assert gateway.stats['max_wait_seconds'] > 0.1
+
+
+def test_queue_timeout_refuses_with_postgres_error():
+    async def scenario():
+        backend, server, gateway, port = await _start(
+            pool_size=1, queue_timeout=0.05)
+
+        holder = asyncio.ensure_future(_session(port))
+        await asyncio.sleep(0.02)
+
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        response = await reader.read()
+        writer.close()
+
+        await holder
+        await gateway.close()
+        server.close()
+
+        return gateway, response
+
+    gateway, response = _run(scenario())
+
+    assert response[:1] == b'E'
+    assert b'C53300\0' in response
+    assert gateway.stats['rejected'] == 1
+
+
+def test_idle_sessions_release_their_connection():
+    async def scenario():
+        backend, server, gateway, port = await _start(
+            pool_size=1, queue_timeout=2, idle_timeout=0.2)
+
+        # a worker holding its connection open without using it
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(struct.pack('!II', 8, SSL_REQUEST))
+        assert await reader.readexactly(1) == b'N'
+
+        await _session(port)
+
+        # the idle session was closed to let the second one through
+        assert await reader.read() == b''
+        writer.close()
+
+        await gateway.close()
+        server.close()
+
+        return backend, gateway
+
+    backend, gateway = _run(scenario())
+
+    assert backend.queries == 1
+    assert gateway.stats['idle_closed'] == 1
+    assert gateway.stats['rejected'] == 0
+    assert gateway.stats['active'] == 0
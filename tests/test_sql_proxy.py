@@ -0,0 +1,229 @@
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import importlib.util
+
+import pytest
+
+if os.path.isdir('../notebook'):
+    ROOT = '..'
+else:
+    ROOT = '.'
+
+sys.path.append(os.path.join(ROOT, 'notebook'))
+
+spec = importlib.util.spec_from_file_location(
+    'run_sql_proxy', os.path.join(ROOT, 'notebook', 'run_sql_proxy.py'))
+run_sql_proxy = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(run_sql_proxy)
+
+# stands in for cloud_sql_proxy: exits on its first start for each port,
+# then listens on the instance's port until terminated
+STUB_PROXY = '''\
+import os
+import sys
+import socket
+
+spec = sys.argv[sys.argv.index('-instances') + 1]
+port = int(spec.rsplit(':', 1)[1])
+marker = '{}.{}.started'.format(
+    sys.argv[sys.argv.index('-credential_file') + 1], port)
+
+if not os.path.exists(marker):
+    open(marker, 'w').close()
+    sys.exit(3)
+
+server = socket.socket()
+server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+server.bind(('127.0.0.1', port))
+server.listen(5)
+
+while True:
+    conn, _ = server.accept()
+    conn.close()
+'''
+
+
+def _free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def test_parse_instances():
+    instances = run_sql_proxy.parse_instances(
+        'proj:us-west1:db=tcp:5432, proj:us-west1:other=tcp:0.0.0.0:5433,'
+        'proj:us-west1:sock')
+
+    assert [(i.connection_name, i.host, i.port) for i in instances] == [
+        ('proj:us-west1:db', '127.0.0.1', 5432),
+        ('proj:us-west1:other', '0.0.0.0', 5433),
+        ('proj:us-west1:sock', '127.0.0.1', None)]
+
+
+def test_gateways_only_for_tcp_instances():
+    instances = run_sql_proxy.parse_instances(
+        'proj:us-west1:db=tcp:5432,proj:us-west1:sock')
+
+    gateways, worker_instances = run_sql_proxy.get_gateways(
+        instances, '10.0.0.5', pool_size=4, queue_timeout=30)
+
+    assert [(g.listen_host, g.listen_port, g.upstream_port, g.queue_timeout)
+            for g in gateways] == [('10.0.0.5', 5432, 5432, 30)]
+
+    # workers still proxy the instance the gateway can't relay
+    assert worker_instances == 'proj:us-west1:sock'
+
+    # the gateway can't share the port of a proxy listening on all interfaces
+    with pytest.raises(ValueError, match='tcp:5433'):
+        run_sql_proxy.get_gateways(
+            run_sql_proxy.parse_instances(
+                'proj:us-west1:db=tcp:0.0.0.0:5433'),
+            '10.0.0.5', pool_size=4)
+
+
+def test_supervisor_restarts_and_stops(tmpdir):
+    stub = tmpdir.join('cloud_sql_proxy')
+    stub.write('#!{}\n'.format(sys.executable) + STUB_PROXY)
+    stub.chmod(0o755)
+
+    instances = [
+        run_sql_proxy.parse_instances(
+            'proj:region:db{}=tcp:{}'.format(i, _free_port()))[0]
+        for i in range(2)]
+
+    supervisor = run_sql_proxy.ProxySupervisor(
+        instances,
+        str(tmpdir.join('creds.json')),
+        proxy=str(stub),
+        min_backoff=0.1,
+        ready_timeout=10)
+
+    async def scenario():
+        task = asyncio.ensure_future(supervisor.run(handle_signals=False))
+        deadline = time.monotonic() + 10
+
+        while any(
+                s['state'] != 'ready' for s in supervisor.status.values()):
+            assert time.monotonic() < deadline
+            await asyncio.sleep(0.05)
+
+        start = time.monotonic()
+        supervisor.stop()
+        await task
+
+        return time.monotonic() - start
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    try:
+        shutdown_seconds = loop.run_until_complete(scenario())
+    finally:
+        loop.close()
+
+    assert shutdown_seconds < 2
+
+    for status in supervisor.status.values():
+        assert status['restarts'] == 1
+        assert status['state'] == 'stopped'
+        assert status['connect_latency'] is not None
+
+
+def test_supervisor_raises_if_proxy_cannot_start(tmpdir):
+    instances = run_sql_proxy.parse_instances(
+        'proj:region:db0=tcp:{}'.format(_free_port()))
+
+    supervisor = run_sql_proxy.ProxySupervisor(
+        instances,
+        str(tmpdir.join('creds.json')),
+        proxy=str(tmpdir.join('missing')))
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    try:
+        with pytest.raises(OSError):
+            loop.run_until_complete(asyncio.wait_for(
+                supervisor.run(handle_signals=False), 5))
+    finally:
+        loop.close()
+
+    assert supervisor.status['proj:region:db0']['state'] == 'starting'
+
+
+# stands in for a cloud_sql_proxy which stops accepting connections after its
+# first start becomes ready, without exiting
+HANGING_PROXY = '''\
+import os
+import sys
+import time
+import socket
+
+spec = sys.argv[sys.argv.index('-instances') + 1]
+port = int(spec.rsplit(':', 1)[1])
+marker = '{}.{}.started'.format(
+    sys.argv[sys.argv.index('-credential_file') + 1], port)
+
+server = socket.socket()
+server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+server.bind(('127.0.0.1', port))
+server.listen(5)
+
+if not os.path.exists(marker):
+    open(marker, 'w').close()
+    server.accept()[0].close()
+    server.close()
+    time.sleep(60)
+
+while True:
+    conn, _ = server.accept()
+    conn.close()
+'''
+
+
+def test_supervisor_restarts_unhealthy_proxy(tmpdir):
+    stub = tmpdir.join('cloud_sql_proxy')
+    stub.write('#!{}\n'.format(sys.executable) + HANGING_PROXY)
+    stub.chmod(0o755)
+
+    instances = run_sql_proxy.parse_instances(
+        'proj:region:db0=tcp:{}'.format(_free_port()))
+
+    supervisor = run_sql_proxy.ProxySupervisor(
+        instances,
+        str(tmpdir.join('creds.json')),
+        proxy=str(stub),
+        min_backoff=0.1,
+        health_interval=0.05,
+        max_health_failures=2)
+
+    status = supervisor.status['proj:region:db0']
+
+    async def scenario():
+        task = asyncio.ensure_future(supervisor.run(handle_signals=False))
+        deadline = time.monotonic() + 10
+
+        while status['restarts'] == 0 or status['state'] != 'ready':
+            assert time.monotonic() < deadline
+            await asyncio.sleep(0.05)
+
+        supervisor.stop()
+        await task
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    try:
+        loop.run_until_complete(scenario())
+    finally:
+        loop.close()
+
+    assert status['restarts'] == 1
+    assert status['state'] == 'stopped'
@@ -0,0 +1,91 @@
+from __future__ import absolute_import
+
+import os
+import sys
+
+if os.path.isfile('../thread_tuning.py'):
+    sys.path.append('..')
+elif os.path.isfile('thread_tuning.py'):
+    sys.path.append('.')
+
+import thread_tuning
+
+
+def test_cgroup_cpu_limit(tmpdir):
+    v2 = tmpdir.mkdir('v2')
+    v2.join('cpu.max').write('175000 100000\n')
+    assert thread_tuning.get_cgroup_cpu_limit(str(v2)) == 1.75
+
+    v2.join('cpu.max').write('max 100000\n')
+    assert thread_tuning.get_cgroup_cpu_limit(str(v2)) is None
+
+    v1 = tmpdir.mkdir('v1').mkdir('cpu,cpuacct')
+    v1.join('cpu.cfs_quota_us').write('350000\n')
+    v1.join('cpu.cfs_period_us').write('100000\n')
+    assert thread_tuning.get_cgroup_cpu_limit(str(tmpdir.join('v1'))) == 3.5
+
+    v1.join('cpu.cfs_quota_us').write('-1\n')
+    assert thread_tuning.get_cgroup_cpu_limit(str(tmpdir.join('v1'))) is None
+
+
+def test_thread_layout():
+    assert thread_tuning.get_thread_layout(1.75, 1).blas_threads == 1
+    assert thread_tuning.get_thread_layout(7.5, 2).blas_threads == 3
+    assert thread_tuning.get_thread_layout(2, 4).blas_threads == 1
+
+    command = ['dask-worker', 'tcp://scheduler:8786', '--nthreads', '2']
+    assert thread_tuning.get_worker_nthreads(command, 8) == 2
+    assert thread_tuning.get_worker_nthreads(['dask-worker'], 7.5) == 8
+    assert thread_tuning.get_worker_nthreads(
+        ['dask-worker', '--nprocs=2'], 8) == 4
+
+
+def test_blas_env_respects_pod_spec(tmpdir):
+    tmpdir.join('cpu.max').write('400000 100000\n')
+
+    command = ['/opt/conda/bin/dask-worker', '--nthreads', '2']
+    # the image sets every variable to 1; the pod spec overrides MKL
+    layout, env = thread_tuning.get_blas_env(
+        command,
+        {'OMP_NUM_THREADS': '1', 'MKL_NUM_THREADS': '3',
+         'OPENBLAS_NUM_THREADS': '1'},
+        root=str(tmpdir))
+
+    cpus = min(4.0, thread_tuning.get_cpu_count())
+    assert layout == thread_tuning.get_thread_layout(cpus, 2)
+    assert env == {
+        'OMP_NUM_THREADS': str(layout.blas_threads),
+        'OPENBLAS_NUM_THREADS': str(layout.blas_threads)}
+
+    layout, env = thread_tuning.get_blas_env(
+        ['python', 'job.py'], {}, root=str(tmpdir))
+    assert layout.nthreads == 1
+
+
+class FakeLoop(object):
+    def add_callback(self, callback, *args, **kwargs):
+        callback(*args, **kwargs)
+
+
+class FakeWorker(object):
+    nthreads = 2
+
+    def __init__(self):
+        self.loop = FakeLoop()
+        self.plugins = {}
+
+    def plugin_add(self, plugin=None, name=None):
+        self.plugins[name] = plugin
+        plugin.setup(worker=self)
+
+
+def test_preload_registers_plugin():
+    worker = FakeWorker()
+    thread_tuning.dask_setup(worker)
+
+    plugin = worker.plugins[thread_tuning.PRELOAD_PLUGIN_NAME]
+    assert isinstance(plugin, thread_tuning.ThreadTuningPlugin)
+    assert plugin.layout.nthreads == 2
+
+    plugin.teardown(worker)
+    assert plugin._limits is None
@@ -0,0 +1,72 @@
+from __future__ import absolute_import
+
+import os
+import sys
+
+if os.path.isdir('../maintenance_utilities'):
+    sys.path.append('../maintenance_utilities')
+elif os.path.isdir('maintenance_utilities'):
+    sys.path.append('maintenance_utilities')
+
+import worker_sizer
+
+
+def test_parse_quantities():
+    assert worker_sizer.parse_cpu('1.75') == 1750
+    assert worker_sizer.parse_cpu('3920m') == 3920
+    assert worker_sizer.parse_memory('11.5G') == 11500000000
+    assert worker_sizer.parse_memory('11.5GB') == 11500000000
+    assert worker_sizer.parse_memory('13Gi') == 13 * 2**30
+    assert worker_sizer.parse_memory('512MiB') == 512 * 2**20
+
+
+def test_size_workers_packs_node():
+    node_cpu = 3920
+    node_memory = 26 * 2**30
+
+    size = worker_sizer.size_workers(
+        node_cpu, node_memory, 2, 4 * 2**30, reserve_cpu=100)
+
+    # cpu bound: 3820m / 2000m per worker
+    assert size.workers == 1
+    assert size.cpu == 3820
+    assert size.blas_threads == 1
+
+    size = worker_sizer.size_workers(node_cpu, node_memory, 1, 10 * 2**30)
+
+    # memory bound: 26Gi / 10Gi per worker
+    assert size.workers == 2
+    assert size.cpu == 1960
+    assert size.memory == 13 * 2**30
+    assert size.memory_efficiency == 1.0
+    assert size.workers * size.cpu <= node_cpu
+
+
+def test_apply_worker_size_keeps_template_consistent():
+    template = {'spec': {'containers': [{
+        'args': ['dask-worker', '--nthreads', '1', '--memory-limit', '11.5GB'],
+        'env': [{'name': 'OMP_NUM_THREADS', 'value': '1'}],
+        'resources': {
+            'limits': {'cpu': '1.75', 'memory': '11.5G'},
+            'requests': {'cpu': '1.75', 'memory': '11.5G'}}}]}}
+
+    current = worker_sizer.get_template_size(template, 3920, 26 * 2**30)
+    assert (current.workers, current.cpu, current.nthreads) == (2, 1750, 1)
+
+    size = worker_sizer.size_workers(3920, 26 * 2**30, 1, 12 * 2**30)
+    worker_sizer.apply_worker_size(template, size)
+
+    container = template['spec']['containers'][0]
+
+    assert container['args'] == [
+        'dask-worker', '--nthreads', '1', '--memory-limit', '13312MiB']
+
+    assert container['resources']['limits'] == {
+        'cpu': '1960m', 'memory': '13312Mi'}
+    assert container['resources']['requests'] == (
+        container['resources']['limits'])
+
+    assert {e['name']: e['value'] for e in container['env']} == {
+        'OMP_NUM_THREADS': '1',
+        'MKL_NUM_THREADS': '1',
+        'OPENBLAS_NUM_THREADS': '1'}
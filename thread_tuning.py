@@ -0,0 +1,268 @@
+'''
+Size BLAS and OpenMP thread pools to the worker's CPU allotment
+
+Each dask worker thread running numpy, scipy or other BLAS/OpenMP code starts
+its own pool of threads. Pools sized to the node's cores oversubscribe a pod
+limited by a cgroup CPU quota, while pools of one thread leave the allotment
+idle when a worker runs fewer threads than it has CPUs. The pool size for
+each worker thread is the pod's CPU quota divided by the worker's
+``--nthreads``, rounded down, and at least one.
+
+The layout is applied twice. The worker image sets ``OMP_NUM_THREADS``,
+``MKL_NUM_THREADS`` and ``OPENBLAS_NUM_THREADS`` to 1 as defaults for
+processes not started by the entrypoint. The container entrypoint replaces
+these defaults with the layout before running the container command; values
+set in the pod spec other than the image default are kept. Then
+:py:class:`ThreadTuningPlugin`, registered on every worker by a preload,
+applies the same limits through threadpoolctl, and can be registered from a
+client to change them at runtime:
+
+.. code-block:: python
+
+    >>> client.register_worker_plugin(ThreadTuningPlugin(blas_threads=2))
+    >>> client.run(get_threadpool_info)
+
+threadpoolctl can only limit libraries which are already loaded. The plugin
+imports numpy first so that its BLAS is limited; libraries loaded later, e.g.
+by a task importing another compiled package, only follow the environment
+variables set by the entrypoint.
+
+'''
+
+import os
+import math
+import logging
+import collections
+
+logger = logging.getLogger('distributed.worker')
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+BLAS_THREAD_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+
+IMAGE_DEFAULT_THREADS = '1'
+'''
+Value of the BLAS thread variables set by ``ENV`` in the worker Dockerfile
+'''
+
+ThreadLayout = collections.namedtuple(
+    'ThreadLayout', ['cpus', 'nthreads', 'blas_threads'])
+'''
+CPUs available to the worker, dask worker threads, and BLAS/OpenMP threads
+per worker thread
+'''
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except (OSError, IOError):
+        return
+
+
+def get_cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def get_cgroup_cpu_limit(root=CGROUP_ROOT):
+    '''
+    Get the CPU quota of the container's cgroup, in CPUs
+
+    Reads ``cpu.max`` (cgroup v2) or ``cpu.cfs_quota_us`` and
+    ``cpu.cfs_period_us`` (cgroup v1). Returns None if there is no quota.
+    '''
+    cpu_max = _read(os.path.join(root, 'cpu.max'))
+
+    if cpu_max is not None:
+        quota, _, period = cpu_max.partition(' ')
+        if quota == 'max':
+            return
+        return float(quota) / float(period or 100000)
+
+    for cpu_dir in ('cpu', 'cpu,cpuacct'):
+        quota = _read(os.path.join(root, cpu_dir, 'cpu.cfs_quota_us'))
+        period = _read(os.path.join(root, cpu_dir, 'cpu.cfs_period_us'))
+
+        if quota is None or period is None:
+            continue
+
+        if int(quota) <= 0:
+            return
+
+        return float(quota) / float(period)
+
+
+def get_available_cpus(root=CGROUP_ROOT):
+    '''
+    Get the CPUs available to the container: its quota, capped by its cores
+    '''
+    limit = get_cgroup_cpu_limit(root)
+    cpus = get_cpu_count()
+
+    return cpus if limit is None else min(limit, cpus)
+
+
+def get_thread_layout(cpus, nthreads):
+    '''
+    Divide a CPU allotment between dask worker threads
+
+    Parameters
+    ----------
+    cpus : float
+        CPUs available to the worker
+    nthreads : int
+        dask worker threads
+
+    Returns
+    -------
+    layout : ThreadLayout
+    '''
+    nthreads = max(int(nthreads), 1)
+
+    return ThreadLayout(
+        cpus=cpus,
+        nthreads=nthreads,
+        blas_threads=max(1, int(math.floor(float(cpus) / nthreads))))
+
+
+def get_worker_nthreads(command, cpus):
+    '''
+    Get ``--nthreads`` from a dask-worker command line
+
+    dask-worker defaults to one thread per core, divided between ``--nprocs``
+    processes.
+    '''
+    def get_option(name):
+        for i, arg in enumerate(command):
+            if arg == name and i + 1 < len(command):
+                return command[i + 1]
+            if arg.startswith(name + '='):
+                return arg.split('=', 1)[1]
+
+    nthreads = get_option('--nthreads')
+    if nthreads is not None:
+        return int(nthreads)
+
+    nprocs = int(get_option('--nprocs') or 1)
+
+    return max(int(math.ceil(cpus)) // nprocs, 1)
+
+
+def get_blas_env(command, env, root=CGROUP_ROOT):
+    '''
+    Get BLAS/OpenMP thread environment variables for a container command
+
+    The CPUs are divided between the threads of a ``dask-worker`` command;
+    any other command gets a single pool using all of them.
+
+    Returns
+    -------
+    layout : ThreadLayout
+    blas_env : dict
+        Variables to set, omitting any set in ``env`` to a value other than
+        the image default
+    '''
+    cpus = get_available_cpus(root)
+
+    if command and os.path.basename(command[0]) == 'dask-worker':
+        nthreads = get_worker_nthreads(command, cpus)
+    else:
+        nthreads = 1
+
+    layout = get_thread_layout(cpus, nthreads)
+
+    return layout, {
+        var: str(layout.blas_threads)
+        for var in BLAS_THREAD_VARS
+        if env.get(var, IMAGE_DEFAULT_THREADS) == IMAGE_DEFAULT_THREADS}
+
+
+def get_threadpool_info():
+    '''
+    Describe the thread pools loaded in this process, for ``client.run``
+    '''
+    from threadpoolctl import threadpool_info
+
+    return threadpool_info()
+
+
+try:
+    from distributed.diagnostics.plugin import WorkerPlugin
+except ImportError:
+    WorkerPlugin = object
+
+
+PRELOAD_PLUGIN_NAME = 'thread-tuning'
+'''
+Name of the plugin registered by the :py:func:`dask_setup` preload
+'''
+
+
+class ThreadTuningPlugin(WorkerPlugin):
+    '''
+    Limit BLAS/OpenMP thread pools on a worker with threadpoolctl
+
+    Parameters
+    ----------
+    blas_threads : int, optional
+        Threads per pool. By default, ``OMP_NUM_THREADS`` if set, otherwise
+        the worker's CPU quota divided by its number of threads.
+    '''
+
+    def __init__(self, blas_threads=None):
+        self.blas_threads = blas_threads
+        self.layout = None
+        self._limits = None
+
+    def setup(self, worker):
+        cpus = get_available_cpus()
+        layout = get_thread_layout(cpus, worker.nthreads)
+
+        # the entrypoint sets the environment from the same layout, unless
+        # the pod spec overrides it
+        blas_threads = self.blas_threads or os.environ.get('OMP_NUM_THREADS')
+
+        if blas_threads is not None:
+            layout = layout._replace(blas_threads=int(blas_threads))
+
+        try:
+            # threadpoolctl only limits libraries which are already loaded
+            import numpy  # noqa: F401
+        except ImportError:
+            pass
+
+        try:
+            from threadpoolctl import threadpool_limits
+        except ImportError:
+            logger.warning(
+                'threadpoolctl is not installed; BLAS/OpenMP pools are sized '
+                'by environment variables only')
+        else:
+            self._limits = threadpool_limits(limits=layout.blas_threads)
+
+        self.layout = layout
+
+        logger.info(
+            'Thread layout: %.2f CPUs, %d worker threads, %d BLAS/OpenMP '
+            'threads each', layout.cpus, layout.nthreads, layout.blas_threads)
+
+    def teardown(self, worker):
+        if self._limits is not None:
+            self._limits.unregister()
+            self._limits = None
+
+
+def dask_setup(worker):
+    '''
+    Preload hook, registering the default layout on the worker
+
+    The plugin is added through the worker's event loop, so that it is set
+    up like a plugin registered from a client and torn down when the worker
+    closes.
+    '''
+    worker.loop.add_callback(
+        worker.plugin_add, plugin=ThreadTuningPlugin(), name=PRELOAD_PLUGIN_NAME)
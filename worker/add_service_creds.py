@@ -1,15 +1,60 @@
-import json, os
+import json, os, sys, zlib, base64
 
 
-def create_service_cred_files():
+PAYLOAD_PREFIX = 'z1:'
+TOKEN_STRINGS = '/opt/gcsfuse_token_strings.json'
 
-    with open("/opt/gcsfuse_token_strings.json", 'r') as f:
-        creds = json.load(f)
 
-    for k, v in creds.items():
-        with open('/opt/gcsfuse_tokens/{}.json'.format(k), 'w+') as f:
-            f.write(json.dumps(v))
+def read_payload(path=TOKEN_STRINGS):
+    '''
+    Read a GCSFUSE_TOKENS value, returning ``(index, body)``
+
+    ``index`` maps bucket names to ``(offset, length)`` of each credential in
+    ``body``. Plain JSON values from older notebooks are indexed the same way.
+    '''
+    with open(path, 'r') as f:
+        value = f.read().strip()
+
+    if not value.startswith(PAYLOAD_PREFIX):
+        index = {}
+        body = []
+        position = 0
+
+        for bucket, cred in json.loads(value).items():
+            cred = json.dumps(cred).encode()
+            index[bucket] = (position, len(cred))
+            body.append(cred)
+            position += len(cred)
+
+        return index, b''.join(body)
+
+    blob = zlib.decompress(base64.b64decode(value[len(PAYLOAD_PREFIX):]))
+    header, _, body = blob.partition(b'\n')
+
+    return json.loads(header.decode())['buckets'], body
+
+
+def get_bucket_credential(bucket, path=TOKEN_STRINGS):
+    '''
+    Get the credential for a single bucket without parsing the others
+    '''
+    index, body = read_payload(path)
+    offset, length = index[bucket]
+
+    return json.loads(body[offset:offset + length].decode())
+
+
+def create_service_cred_files(path=TOKEN_STRINGS, token_dir='/opt/gcsfuse_tokens'):
+
+    index, body = read_payload(path)
+
+    for k, (offset, length) in index.items():
+        with open(os.path.join(token_dir, '{}.json'.format(k)), 'w+') as f:
+            f.write(body[offset:offset + length].decode())
 
 
 if __name__ == '__main__':
-    create_service_cred_files()
+    if len(sys.argv) > 1:
+        print(json.dumps(get_bucket_credential(sys.argv[1])))
+    else:
+        create_service_cred_files()